@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark emr_package, zip_recursive, emr_upload_to_s3 and emr_release on a synthetic project
+
+Uploads run against moto in server mode, so real HTTP requests are made, but nothing leaves the
+machine: the S3 client is created with the endpoint of the moto server and dummy credentials.
+Each task result also carries the phases of the plugin metrics report (dependencies, scan, compress,
+upload, copy, ...), so a regression can be traced to a phase. Results are written as JSON to compare
+runs over time and between configurations, e.g.
+
+    python src/benchmark/python/emr_plugin_benchmark.py --files 2000 --workers 1,8 --output bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from unittest import mock
+
+from pybuilder.core import Logger, Project
+
+from pybuilder_emr_plugin import emr_package, emr_release, emr_tasks, emr_upload_to_s3, helpers, initialize_plugin
+from pybuilder_emr_plugin.transfer import FaultInjectingClient
+
+_WORDS = ["def", "class", "return", "import", "self", "value", "result", "spark", "frame", "column", "if", "else",
+          "for", "in", "None", "True", "False", "data", "row", "key"]
+
+
+class QuietLogger(Logger):
+    def _do_log(self, level, message, *arguments):
+        pass
+
+
+def write_synthetic_file(filename, size, rnd, random_fraction):
+    """Write size bytes of mostly text-like content, random_fraction of it incompressible"""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    random_size = int(size * random_fraction)
+    words = []
+    length = 0
+    while length < size - random_size:
+        word = rnd.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    with open(filename, "wb") as fp:
+        fp.write(" ".join(words).encode("ascii")[:size - random_size])
+        fp.write(bytes(rnd.getrandbits(8) for _ in range(random_size)))
+
+
+def create_project(basedir, args, rnd):
+    """Create a synthetic project with sources, scripts and an installed dependency tree"""
+    project = Project(basedir=basedir, name="benchmark", version="1")
+    initialize_plugin(project)
+    project.set_property("dir_target", "target")
+    project.set_property("dir_source_main_python", "src/main/python")
+    project.set_property("dir_source_main_scripts", "src/main/scripts")
+    for index in range(args.files):
+        package = "package{0}".format(index % max(1, args.files // 20))
+        write_synthetic_file(os.path.join(basedir, "src/main/python", package, "module{0}.py".format(index)),
+                             args.file_size, rnd, args.random_fraction)
+    for index in range(args.scripts):
+        write_synthetic_file(os.path.join(basedir, "src/main/scripts", "script{0}.py".format(index)),
+                             args.file_size, rnd, args.random_fraction)
+    dependencies = os.path.join(basedir, "dependencies-template")
+    for package in range(args.dependency_packages):
+        for index in range(args.dependency_files):
+            depth = index % (args.dependency_depth + 1)
+            subfolders = ["sub{0}".format(d) for d in range(depth)]
+            folder = os.path.join(dependencies, "dependency{0}".format(package), *subfolders)
+            write_synthetic_file(os.path.join(folder, "module{0}.py".format(index)), args.dependency_file_size, rnd,
+                                 args.random_fraction)
+    return project, dependencies
+
+
+def timed(results, phase, configuration, function, *arguments, **details):
+    """Time function and record the phases of its metrics report (dependencies, scan, compress, upload, ...)"""
+    task_metrics = details.pop("task_metrics", {})
+    task_metrics.pop(phase, None)
+    started = time.time()
+    function(*arguments)
+    seconds = time.time() - started
+    result = {"phase": phase, "configuration": configuration, "seconds": seconds}
+    if phase in task_metrics:
+        result["phases"] = task_metrics.pop(phase)["phases"]
+    result.update(details)
+    results.append(result)
+    return seconds
+
+
+def tree_size(directory):
+    files = 0
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def run_configuration(project, dependencies, workers, bucket_name, results, repeat):
+    configuration = {"workers": workers}
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_WORKERS, workers)
+    project.set_property(emr_tasks.PROPERTY_S3_BUCKET_NAME, bucket_name)
+    logger = QuietLogger()
+    package_dir = emr_tasks.get_emr_package_dir(project)
+    # the metrics of every plugin task, as written to the metrics report
+    task_metrics = {}
+    project.set_property(emr_tasks.PROPERTY_METRICS_HOOK, lambda task, metrics: task_metrics.update({task: metrics}))
+
+    def prepare_dependencies(logger, project, target_directory, excludes=None):
+        shutil.copytree(dependencies, target_directory)
+
+    for _ in range(repeat):
+        shutil.rmtree(project.expand_path("$dir_target"), ignore_errors=True)
+        with mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir", prepare_dependencies):
+            timed(results, "emr_package", configuration, emr_package, project, logger, task_metrics=task_metrics)
+        files, size = tree_size(package_dir)
+        zip_size = os.path.getsize(emr_tasks.get_path_to_zipfile(project))
+
+        zip_file = os.path.join(package_dir, "zip_recursive.zip")
+        with zipfile.ZipFile(zip_file, "w") as archive:
+            timed(results, "zip_recursive", configuration, emr_tasks.zip_recursive, archive,
+                  project.expand_path("$dir_source_main_python"))
+        os.remove(zip_file)
+
+        timed(results, "emr_upload_to_s3", configuration, emr_upload_to_s3, project, logger,
+              files=files, bytes=size, zip_bytes=zip_size, task_metrics=task_metrics)
+        timed(results, "emr_release", configuration, emr_release, project, logger, task_metrics=task_metrics)
+
+
+def summarize(results):
+    """min and median seconds per task and per phase of a task (e.g. 'emr_package/compress') and configuration"""
+    summary = {}
+    for result in results:
+        configuration = json.dumps(result["configuration"], sort_keys=True)
+        summary.setdefault("{0} {1}".format(result["phase"], configuration), []).append(result["seconds"])
+        phases = {}
+        for record in result.get("phases", []):
+            phases[record["name"]] = phases.get(record["name"], 0.0) + record["seconds"]
+        for name, seconds in phases.items():
+            summary.setdefault("{0}/{1} {2}".format(result["phase"], name, configuration), []).append(seconds)
+    return {key: {"runs": len(values), "min": min(values), "median": statistics.median(values)}
+            for key, values in sorted(summary.items())}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=500, help="number of source modules")
+    parser.add_argument("--file-size", type=int, default=8 * 1024, help="size of each source module in bytes")
+    parser.add_argument("--scripts", type=int, default=10, help="number of scripts next to the zip")
+    parser.add_argument("--dependency-packages", type=int, default=20, help="number of installed dependencies")
+    parser.add_argument("--dependency-files", type=int, default=100, help="files per dependency")
+    parser.add_argument("--dependency-file-size", type=int, default=16 * 1024, help="size of a dependency file")
+    parser.add_argument("--dependency-depth", type=int, default=3, help="maximum nesting within a dependency")
+    parser.add_argument("--random-fraction", type=float, default=0.2, help="incompressible fraction of each file")
+    parser.add_argument("--workers", default="1", help="comma separated emr.package.workers values to compare")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per configuration")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of S3 write requests failing with SlowDown")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON result file, default: stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from moto.server import ThreadedMotoServer
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server.start()
+    # dummy credentials replace real ones, a request missing the endpoint below must never reach AWS
+    for variable in ["AWS_PROFILE", "AWS_SESSION_TOKEN", "AWS_SECURITY_TOKEN"]:
+        os.environ.pop(variable, None)
+    for variable in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        os.environ[variable] = "benchmark"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    from botocore.config import Config
+    client = helpers.get_session().client("s3", endpoint_url="http://127.0.0.1:{0}".format(port),
+                                          config=Config(max_pool_connections=256, retries={"max_attempts": 0}))
+    bucket_name = "emr-plugin-benchmark"
+    client.create_bucket(Bucket=bucket_name)
+
+    basedir = tempfile.mkdtemp(prefix="emr-benchmark-")
+    results = []
+    try:
+        project, dependencies = create_project(basedir, args, random.Random(args.seed))
+        if args.throttle_rate:
+            client = FaultInjectingClient(client, failure_rate=args.throttle_rate, seed=args.seed)
+        with mock.patch("pybuilder_emr_plugin.helpers.get_s3_client", return_value=client), \
+                mock.patch("pybuilder_emr_plugin.emr_tasks.get_s3_client", return_value=client):
+            for workers in [int(w) for w in args.workers.split(",")]:
+                run_configuration(project, dependencies, workers, bucket_name, results, args.repeat)
+    finally:
+        shutil.rmtree(basedir, ignore_errors=True)
+        server.stop()
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "cpu_count": os.cpu_count()},
+              "arguments": vars(args),
+              "results": results,
+              "summary": summarize(results)}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 # flake8: noqa
 
+import os
+
 from pybuilder.core import init
 
+from . import archive, helpers, optimize, transfer
 from .emr_tasks import emr_upload_to_s3, emr_package, emr_release
 
 
@@ -13,3 +16,44 @@ def initialize_plugin(project):
     project.set_property(emr_tasks.PROPERTY_S3_FILE_ACCESS_CONTROL, "bucket-owner-full-control")
     project.set_property(emr_tasks.PROPERTY_S3_RELEASE_PREFIX, emr_tasks.RELEASE_PREFIX_DEFAULT)
     project.set_property(emr_tasks.PROPERTY_S3_BUCKET_PREFIX, "")
+    project.set_property(emr_tasks.PROPERTY_S3_UPLOAD_PART_SIZE, helpers.DEFAULT_PART_SIZE)
+    project.set_property(emr_tasks.PROPERTY_S3_UPLOAD_CONCURRENCY, helpers.DEFAULT_CONCURRENCY)
+    project.set_property(emr_tasks.PROPERTY_S3_UPLOAD_FILES_CONCURRENCY, helpers.DEFAULT_FILES_CONCURRENCY)
+    project.set_property(emr_tasks.PROPERTY_S3_UPLOAD_SKIP_UNCHANGED, False)
+    project.set_property(emr_tasks.PROPERTY_S3_RETRY_MAX_ATTEMPTS, transfer.DEFAULT_MAX_ATTEMPTS)
+    project.set_property(emr_tasks.PROPERTY_S3_RETRY_BASE_DELAY, transfer.DEFAULT_BASE_DELAY)
+    project.set_property(emr_tasks.PROPERTY_S3_RETRY_MAX_DELAY, transfer.DEFAULT_MAX_DELAY)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_BATCH_INSTALL, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_INSTALL_WORKERS, 1)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR, "")
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_CACHE_LINK, True)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_ENTRIES, 10)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_WORKERS, os.cpu_count() or 1)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_DETERMINISTIC, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_COMPRESSION_RULES, list(archive.DEFAULT_COMPRESSION_RULES))
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_COMPRESSION_SAMPLE, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_PRECOMPILE, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_SOURCELESS, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_BYTECODE_PYTHON, "")
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_PRUNE, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_PRUNE_PATTERNS, list(optimize.DEFAULT_PRUNE_PATTERNS))
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_EXCLUDES, list(emr_tasks.DEFAULT_DEPENDENCY_EXCLUDES))
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_FILE_EXCLUDES, [])
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_SOURCE_INCLUDES, [])
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_SOURCE_EXCLUDES, list(emr_tasks.DEFAULT_SOURCE_EXCLUDES))
+    project.set_property(emr_tasks.PROPERTY_METRICS_HOOK, None)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_LAYERED, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV_PYTHON, "")
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV_PYTHON_HOME, emr_tasks.DEFAULT_VENV_PYTHON_HOME)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV_MEASURE_STARTUP, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGETS, [])
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGET_PYTHONS, {})
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGET_WORKERS, 0)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_STREAM_UPLOAD, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_STREAM_KEEP_LOCAL, True)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_SCRIPTS_LINK, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_SCRIPTS_CHECKSUM, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT, False)
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_HOT_MODULES, [])
+    project.set_property(emr_tasks.PROPERTY_PACKAGE_PROFILE_IMPORTS, False)
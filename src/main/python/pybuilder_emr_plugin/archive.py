@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat as stat_module
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .patterns import glob_to_regex, PathMatcher
+from .zipcompat import get_compresslevel, get_compressor, read_raw_entry, set_compresslevel, \
+    supports_raw_entries, write_raw_entry
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+# larger files are compressed streaming in the calling thread instead of in memory by the pool
+_PARALLEL_MAX_FILE_SIZE = 64 * 1024 * 1024
+# earliest timestamp a zip file can represent
+_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+DETERMINISTIC_COMPRESSLEVEL = 6
+_SAMPLE_SIZE = 64 * 1024
+_SAMPLE_RATIO = 0.95
+
+COMPRESS_TYPES = {"stored": zipfile.ZIP_STORED,
+                  "deflated": zipfile.ZIP_DEFLATED,
+                  "bzip2": zipfile.ZIP_BZIP2,
+                  "lzma": zipfile.ZIP_LZMA}
+# zipimport only decompresses these, modules written with bzip2 or lzma can not be imported
+ZIPIMPORT_COMPRESS_TYPES = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+ZIPIMPORT_MODULE_SUFFIXES = (".py", ".pyc", ".pyo")
+# entries zipimport never reads: bytecode caches (only .pyc files next to the module are used) and the
+# .pth files of setuptools namespace packages, which are only processed in site-packages
+ZIPIMPORT_UNUSED_PATTERNS = ["**/__pycache__/**", "*-nspkg.pth"]
+HOT_CATEGORY = "zipimport-hot"
+# file types which are compressed already, deflating them costs CPU without saving space
+DEFAULT_COMPRESSION_RULES = ["*.{0}=stored".format(extension) for extension in
+                             ["whl", "egg", "jar", "zip", "gz", "tgz", "bz2", "xz", "zst", "lz4", "snappy",
+                              "parquet", "orc", "avro", "png", "jpg", "jpeg", "gif", "webp"]]
+
+
+def get_deterministic_date_time():
+    """Timestamp for all entries of a deterministic archive, honors SOURCE_DATE_EPOCH"""
+    source_date_epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if source_date_epoch:
+        return max(_ZIP_EPOCH, time.gmtime(int(source_date_epoch))[:6])
+    return _ZIP_EPOCH
+
+
+def zipinfo_from_stat(arcname, stat):
+    """ZipInfo for a regular file like ZipInfo.from_file, but from an existing stat result"""
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime_ns // 1000000000)[0:6])
+    zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+    zinfo.file_size = stat.st_size
+    return zinfo
+
+
+def file_sha256(filename):
+    """Hex sha256 digest of the content of filename"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(filename):
+    """Load an archive manifest, returns an empty manifest if filename does not exist"""
+    if not filename or not os.path.isfile(filename):
+        return {}
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def save_manifest(filename, manifest):
+    with open(filename, "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+
+
+def compress_file(filename, compress_type, compresslevel=None, with_sha256=False):
+    """Compress the content of filename the way ZipFile.write does
+
+    Returns a tuple (compressed data, CRC, file_size, sha256 or None).
+    """
+    compressor = get_compressor(compress_type, compresslevel)
+    digest = hashlib.sha256() if with_sha256 else None
+    crc = 0
+    file_size = 0
+    chunks = []
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(_HASH_BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            if digest:
+                digest.update(block)
+            chunks.append(compressor.compress(block) if compressor else block)
+    if compressor:
+        chunks.append(compressor.flush())
+    return b"".join(chunks), crc, file_size, digest.hexdigest() if digest else None
+
+
+def _timed(function, *args):
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+
+def module_name(arcname):
+    """Dotted name of the module of an archive entry (.py or .pyc), a package for __init__, else None"""
+    for suffix in (".py", ".pyc"):
+        if arcname.endswith(suffix):
+            name = arcname[:-len(suffix)].replace("/", ".")
+            return name[:-len(".__init__")] if name.endswith(".__init__") else name
+    return None
+
+
+class ZipimportLayout(object):
+    """Orders the entries of an archive for imports with zipimport
+
+    The __init__ modules of the top level packages, the modules whose dotted name matches one of
+    the globs hot_modules (e.g. "mypackage.jobs.*") and the parent packages of those are stored
+    uncompressed at the start of the archive, all other entries follow in their original order.
+    Directory entries and entries matching drop_patterns (globs like the excludes of a PathMatcher)
+    are never read by zipimport and dropped.
+    """
+
+    def __init__(self, hot_modules=None, drop_patterns=None):
+        self.hot_modules = list(hot_modules or [])
+        self._drop = PathMatcher(excludes=ZIPIMPORT_UNUSED_PATTERNS if drop_patterns is None else drop_patterns)
+        self._parents = set()
+        for pattern in self.hot_modules:
+            complete = []
+            for segment in pattern.split(".")[:-1]:
+                if any(char in segment for char in "*?["):
+                    break
+                complete.append(segment)
+                self._parents.add(".".join(complete))
+
+    def drops(self, arcname):
+        return arcname.endswith("/") or not self._drop.includes_file(arcname)
+
+    def is_hot(self, arcname):
+        name = module_name(arcname)
+        if not name:
+            return False
+        if "." not in name and arcname.rsplit("/", 1)[-1].startswith("__init__."):
+            return True
+        return name in self._parents or any(fnmatch.fnmatchcase(name, pattern) for pattern in self.hot_modules)
+
+
+class CompressionPolicy(object):
+    """Chooses compression method and level for each archive entry
+
+    rules is a list of strings "<glob>=<method>[:<level>]" with method one of stored, deflated,
+    bzip2 or lzma, e.g. "*.parquet=stored" or "data/**/*.json=deflated:9". The globs work like the
+    patterns of a PathMatcher. The first rule whose glob matches the archive name of an entry applies,
+    rules with bzip2 or lzma are skipped for modules, which zipimport could not read. With sample,
+    entries not matched by any rule are stored if the first block of the file does not compress.
+    """
+
+    def __init__(self, rules=None, sample=False):
+        self.rules = [parse_compression_rule(rule) for rule in rules or []]
+        self._regexes = [re.compile(glob_to_regex(pattern) + "\\Z") for pattern, _, _ in self.rules]
+        self.sample = sample
+
+    def choose(self, filename, arcname, compress_type):
+        """Return (category, compress_type, compresslevel) for an entry"""
+        module = arcname.endswith(ZIPIMPORT_MODULE_SUFFIXES)
+        for regex, (pattern, rule_compress_type, compresslevel) in zip(self._regexes, self.rules):
+            if module and rule_compress_type not in ZIPIMPORT_COMPRESS_TYPES:
+                continue
+            if regex.match(arcname):
+                return pattern, rule_compress_type, compresslevel
+        if self.sample and compress_type != zipfile.ZIP_STORED and not is_compressible(filename):
+            return "incompressible", zipfile.ZIP_STORED, None
+        return "default", compress_type, None
+
+
+def parse_compression_rule(rule):
+    pattern, separator, method = rule.rpartition("=")
+    method, _, level = method.partition(":")
+    if not separator or not pattern or method not in COMPRESS_TYPES:
+        raise ValueError("Invalid compression rule '{0}', expected <glob>=<{1}>[:<level>]".format(
+            rule, "|".join(sorted(COMPRESS_TYPES))))
+    if COMPRESS_TYPES[method] not in ZIPIMPORT_COMPRESS_TYPES and pattern.endswith(ZIPIMPORT_MODULE_SUFFIXES):
+        raise ValueError("Invalid compression rule '{0}', zipimport can not read modules compressed with {1}".format(
+            rule, method))
+    return pattern, COMPRESS_TYPES[method], int(level) if level else None
+
+
+def is_compressible(filename, threshold=_SAMPLE_RATIO):
+    """Sample the first block of filename, True if it shrinks by compressing it"""
+    with open(filename, "rb") as fp:
+        sample = fp.read(_SAMPLE_SIZE)
+    if not sample:
+        return True
+    return len(zlib.compress(sample, 1)) < threshold * len(sample)
+
+
+class PackageArchive(object):
+    """Drop-in replacement for a writable ZipFile used to assemble the emr-package-zip
+
+    If a previous archive and its manifest are given, entries whose content did not change
+    are copied from the previous archive without compressing them again. With record_manifest
+    the manifest for the next incremental build is collected in self.manifest.
+
+    With more than one worker, entries are compressed by a thread pool and appended to the
+    archive in the order write() was called, so the result does not depend on the worker count.
+    Both need zipfile internals (see zipcompat), without them self.raw_entries is False and every
+    entry is compressed by ZipFile.open in the calling thread.
+
+    A deterministic archive uses a fixed timestamp, normalized permissions and a fixed
+    compression level for all entries, so it only depends on the content and order of the files.
+
+    The archive is written to fileobj (e.g. a StreamBuffer) instead of filename if given.
+
+    With a ZipimportLayout all entries are collected and written on close(), hot modules first
+    and uncompressed (category zipimport-hot), unused entries are dropped and counted in self.dropped.
+
+    An optional CompressionPolicy overrides the compress_type given to write(). Sizes and
+    compression times per policy category are collected in self.statistics.
+    """
+
+    def __init__(self, filename, previous_archive=None, previous_manifest=None, record_manifest=False,
+                 workers=1, deterministic=False, policy=None, fileobj=None, layout=None):
+        self.filename = filename
+        if fileobj is None and os.path.lexists(filename):
+            # the previous archive may be a hardlink to filename, never truncate it in place
+            os.remove(filename)
+        self.zipfile = zipfile.ZipFile(fileobj or filename, "w")
+        self.manifest = {} if record_manifest else None
+        self.statistics = {}
+        self.reused = 0
+        self.compressed = 0
+        self.dropped = 0
+        self._policy = policy
+        self._layout = layout
+        self._deferred = []
+        # without the zipfile internals entries are neither compressed in parallel nor reused
+        self.raw_entries = supports_raw_entries(self.zipfile)
+        self._previous_manifest = load_manifest(previous_manifest) if previous_archive and self.raw_entries else {}
+        self._previous = None
+        if self._previous_manifest and os.path.isfile(previous_archive):
+            self._previous = zipfile.ZipFile(previous_archive, "r")
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 and self.raw_entries else None
+        self._max_pending = 2 * workers
+        self._pending = collections.deque()
+        self._date_time = get_deterministic_date_time() if deterministic else None
+        self._compresslevel = DETERMINISTIC_COMPRESSLEVEL if deterministic else None
+
+    def _find_reusable(self, filename, zinfo, stat):
+        """Return (previous ZipInfo, sha256) if the previous archive holds the same content for zinfo"""
+        if self._previous is None:
+            return None, None
+        previous = self._previous_manifest.get(zinfo.filename)
+        if (not previous or previous["size"] != stat.st_size or previous["compress_type"] != zinfo.compress_type
+                or previous.get("compresslevel") != get_compresslevel(zinfo)):
+            return None, None
+        if previous["mtime_ns"] == stat.st_mtime_ns:
+            sha256 = previous["sha256"]
+        else:
+            sha256 = file_sha256(filename)
+            if sha256 != previous["sha256"]:
+                return None, sha256
+        try:
+            return self._previous.getinfo(zinfo.filename), sha256
+        except KeyError:
+            return None, sha256
+
+    def _record(self, zinfo, stat, sha256, category, seconds):
+        statistics = self.statistics.setdefault(category, {"files": 0, "size": 0, "compressed_size": 0,
+                                                           "seconds": 0.0})
+        statistics["files"] += 1
+        statistics["size"] += zinfo.file_size
+        statistics["compressed_size"] += zinfo.compress_size
+        statistics["seconds"] += seconds
+        if self.manifest is not None:
+            self.manifest[zinfo.filename] = {"size": stat.st_size,
+                                             "mtime_ns": stat.st_mtime_ns,
+                                             "sha256": sha256,
+                                             "compress_type": zinfo.compress_type,
+                                             "compresslevel": get_compresslevel(zinfo)}
+
+    def _write_pending(self, count=None):
+        """Append the oldest count (default all) pending entries to the archive"""
+        while self._pending and (count is None or count > 0):
+            zinfo, stat, future, sha256, category = self._pending.popleft()
+            (data, zinfo.CRC, zinfo.file_size, computed_sha256), seconds = future.result()
+            zinfo.compress_size = len(data)
+            write_raw_entry(self.zipfile, zinfo, data)
+            self._record(zinfo, stat, sha256 or computed_sha256, category, seconds)
+            if count is not None:
+                count -= 1
+
+    def write(self, filename, arcname=None, compress_type=None, stat=None):
+        """Add filename as arcname, stat (e.g. a scanned FileEntry) avoids another stat of the file"""
+        if arcname is None:
+            arcname = filename
+        if compress_type is None:
+            compress_type = self.zipfile.compression
+        if stat is None:
+            stat = os.stat(filename)
+        if self._layout is None:
+            self._write(filename, arcname, compress_type, stat)
+        elif stat_module.S_ISDIR(stat.st_mode) or self._layout.drops(zipinfo_from_stat(arcname, stat).filename):
+            self.dropped += 1
+        else:
+            self._deferred.append((filename, arcname, compress_type, stat))
+
+    def _write_layout(self):
+        """Write the entries collected with a ZipimportLayout, hot modules first"""
+        deferred, self._deferred = self._deferred, []
+        hot = [self._layout.is_hot(zipinfo_from_stat(arcname, stat).filename) for _, arcname, _, stat in deferred]
+        for is_hot in (True, False):
+            for entry, entry_is_hot in zip(deferred, hot):
+                if entry_is_hot == is_hot:
+                    self._write(*entry, hot=is_hot)
+
+    def _write(self, filename, arcname, compress_type, stat, hot=False):
+        zinfo = zipinfo_from_stat(arcname, stat)
+        category, compresslevel = "default", None
+        if hot:
+            # zipimport reads them without decompressing
+            category, compress_type = HOT_CATEGORY, zipfile.ZIP_STORED
+        elif self._policy is not None:
+            category, compress_type, compresslevel = self._policy.choose(filename, zinfo.filename, compress_type)
+        zinfo.compress_type = compress_type
+        set_compresslevel(zinfo, compresslevel if compresslevel is not None else self._compresslevel)
+        if self._date_time:
+            zinfo.date_time = self._date_time
+            mode = 0o755 if stat.st_mode & 0o111 else 0o644
+            zinfo.external_attr = (stat_module.S_IFREG | mode) << 16
+        previous, sha256 = self._find_reusable(filename, zinfo, stat)
+        if previous is None and self._executor is not None and stat.st_size <= _PARALLEL_MAX_FILE_SIZE:
+            with_sha256 = self.manifest is not None and sha256 is None
+            future = self._executor.submit(_timed, compress_file, filename, compress_type,
+                                           get_compresslevel(zinfo), with_sha256)
+            self._pending.append((zinfo, stat, future, sha256, category))
+            self.compressed += 1
+            if len(self._pending) > self._max_pending:
+                self._write_pending(len(self._pending) - self._max_pending)
+            return
+
+        self._write_pending()
+        started = time.time()
+        if previous is not None:
+            zinfo.CRC = previous.CRC
+            zinfo.file_size = previous.file_size
+            zinfo.compress_size = previous.compress_size
+            write_raw_entry(self.zipfile, zinfo, read_raw_entry(self._previous.fp, previous))
+            self.reused += 1
+        else:
+            with open(filename, "rb") as src, self.zipfile.open(zinfo, "w") as dest:
+                shutil.copyfileobj(src, dest, 1024 * 8)
+            self.compressed += 1
+        seconds = time.time() - started
+        if self.manifest is not None and sha256 is None:
+            sha256 = file_sha256(filename)
+        self._record(zinfo, stat, sha256, category, seconds)
+
+    def namelist(self):
+        return self.zipfile.namelist() + [zipinfo_from_stat(arcname, stat).filename
+                                          for _, arcname, _, stat in self._deferred]
+
+    def close(self):
+        try:
+            if self._layout is not None:
+                self._write_layout()
+            self._write_pending()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+        self.zipfile.close()
+        if self._previous is not None:
+            self._previous.close()
+            self._previous = None
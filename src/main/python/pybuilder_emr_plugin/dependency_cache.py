@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import sysconfig
+import tempfile
+import time
+
+_METADATA_SUFFIX = ".json"
+# ioctl cloning a file on Linux
+_FICLONE = 0x40049409
+
+
+def get_platform_tag():
+    """Interpreter and platform tag the installed dependencies are valid for"""
+    return "{0}-{1}".format(sys.implementation.cache_tag, sysconfig.get_platform())
+
+
+def dependency_cache_key(dependencies, index_url="", platform_tag=None, options=None):
+    """Hash of the requirement set, the index url, the interpreter/platform tag and further options"""
+    content = {"dependencies": sorted(dependencies),
+               "index_url": index_url or "",
+               "platform": platform_tag or get_platform_tag()}
+    if options:
+        content["options"] = options
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def reflink_file(source, target):
+    """Copy source to target as copy-on-write clone (btrfs, xfs), returns False if not supported"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dest:
+            fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+    except (IOError, OSError):
+        if os.path.lexists(target):
+            os.remove(target)
+        return False
+    shutil.copystat(source, target)
+    return True
+
+
+def link_or_copy_file(source, target, link=True):
+    """Hardlink source to target, falling back to a reflink or a copy if hardlinks are not supported"""
+    if os.path.lexists(target):
+        os.remove(target)
+    if link:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    if not reflink_file(source, target):
+        shutil.copy2(source, target)
+
+
+def link_or_copy_tree(source_directory, target_directory, link=True):
+    """Replicate source_directory in target_directory using hardlinks where possible, else copies"""
+    for root, _, files in os.walk(source_directory):
+        destination = os.path.join(target_directory, os.path.relpath(root, source_directory))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            link_or_copy_file(os.path.join(root, name), os.path.join(destination, name), link=link)
+
+
+def _tree_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+def _metadata_path(cache_dir, key):
+    return os.path.join(cache_dir, key + _METADATA_SUFFIX)
+
+
+def restore_dependencies(logger, cache_dir, key, target_directory, link=True):
+    """Fill target_directory from the cache entry for key. Returns False on a cache miss"""
+    entry = os.path.join(cache_dir, key)
+    metadata = _metadata_path(cache_dir, key)
+    if not (os.path.isdir(entry) and os.path.isfile(metadata)):
+        logger.debug("Dependency cache miss for {0}".format(key))
+        return False
+    logger.info("Reusing cached dependencies {0} from {1}".format(key, cache_dir))
+    if os.path.isdir(target_directory):
+        shutil.rmtree(target_directory)
+    os.makedirs(target_directory)
+    link_or_copy_tree(entry, target_directory, link=link)
+    os.utime(metadata, None)
+    return True
+
+
+def store_dependencies(logger, cache_dir, key, source_directory, dependencies, link=True):
+    """Add the installed dependencies in source_directory to the cache as entry key"""
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=cache_dir)
+    try:
+        if os.path.isdir(source_directory):
+            link_or_copy_tree(source_directory, staging, link=link)
+        os.rename(staging, entry)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        if not os.path.isdir(entry):
+            raise
+        return
+    with open(_metadata_path(cache_dir, key), "w") as metadata_file:
+        json.dump({"dependencies": sorted(dependencies),
+                   "size": _tree_size(entry),
+                   "created": time.time()}, metadata_file)
+    logger.debug("Stored dependencies {0} in cache {1}".format(key, cache_dir))
+
+
+def evict_dependency_cache(logger, cache_dir, max_entries=None, max_size=None, keep=None):
+    """Remove least recently used cache entries until max_entries and max_size (bytes) are met"""
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for item in os.listdir(cache_dir):
+        if not item.endswith(_METADATA_SUFFIX):
+            continue
+        key = item[:-len(_METADATA_SUFFIX)]
+        metadata = os.path.join(cache_dir, item)
+        try:
+            with open(metadata) as metadata_file:
+                size = json.load(metadata_file).get("size", 0)
+        except ValueError:
+            size = 0
+        entries.append((os.path.getmtime(metadata), key, size))
+    entries.sort()
+
+    evicted = []
+    total_size = sum(size for _, _, size in entries)
+    count = len(entries)
+    for _, key, size in entries:
+        if key == keep:
+            continue
+        too_many = max_entries is not None and count > max_entries
+        too_big = max_size is not None and total_size > max_size
+        if not (too_many or too_big):
+            break
+        logger.debug("Evicting dependency cache entry {0}".format(key))
+        os.remove(_metadata_path(cache_dir, key))
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total_size -= size
+        count -= 1
+        evicted.append(key)
+    return evicted
@@ -2,51 +2,303 @@
 # -*- coding: utf-8 -*-
 
 import ast
+import json
 import os
+import re
+import shutil
 import subprocess
+import tempfile
+import time
 import zipfile
-from distutils import dir_util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from pybuilder.core import depends, task
+from pybuilder.errors import BuildFailedException
 from pybuilder.plugins.python.distutils_plugin import build_install_dependencies_string
 
-from .helpers import upload_helper, check_acl_parameter_validity, check_sse_parameter_validity
+from .archive import file_sha256, CompressionPolicy, PackageArchive, ZipimportLayout, save_manifest
+from .dependency_cache import dependency_cache_key, evict_dependency_cache, link_or_copy_file, \
+    restore_dependencies, store_dependencies
+from .helpers import copy_prefix_helper, delete_objects_helper, get_s3_client, object_exists, upload_files_helper, \
+    upload_helper, check_acl_parameter_validity, check_sse_parameter_validity, DEFAULT_CONCURRENCY, \
+    DEFAULT_FILES_CONCURRENCY, DEFAULT_PART_SIZE
+from .metrics import write_report, TaskMetrics
+from .optimize import compile_tree, profile_zip_imports, prune_tree, top_level_modules, DEFAULT_PRUNE_PATTERNS
+from .patterns import excluded_distributions, is_excluded_requirement, requirement_name, BytecodeMatcher, \
+    PathMatcher
+from .streaming import StreamBuffer
+from .targets import parse_targets, pip_target_options, replay_messages, PropertySnapshot, RecordingLogger
+from .transfer import TransferController, DEFAULT_BASE_DELAY, DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_DELAY
+from .venv import create_venv, measure_venv_startup, pack_venv, relocate_venv
+from .walker import entries_statistics, load_file_manifest, save_file_manifest, scan_tree, sync_entries, FileEntry
 
+PROPERTY_METRICS_HOOK = "emr.metrics.hook"
+PROPERTY_PACKAGE_BYTECODE_PYTHON = "emr.package.bytecode-python"
+PROPERTY_PACKAGE_BATCH_INSTALL = "emr.package.batch-install"
+PROPERTY_PACKAGE_COMPRESSION_RULES = "emr.package.compression-rules"
+PROPERTY_PACKAGE_COMPRESSION_SAMPLE = "emr.package.compression-sample"
+PROPERTY_PACKAGE_DEPENDENCY_EXCLUDES = "emr.package.dependency-excludes"
+PROPERTY_PACKAGE_DEPENDENCY_FILE_EXCLUDES = "emr.package.dependency-file-excludes"
+PROPERTY_PACKAGE_DETERMINISTIC = "emr.package.deterministic"
+PROPERTY_PACKAGE_HOT_MODULES = "emr.package.hot-modules"
+PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR = "emr.package.dependency-cache-dir"
+PROPERTY_PACKAGE_DEPENDENCY_CACHE_LINK = "emr.package.dependency-cache-link"
+PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_ENTRIES = "emr.package.dependency-cache-max-entries"
+PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_SIZE = "emr.package.dependency-cache-max-size"
+PROPERTY_PACKAGE_INCREMENTAL_DIR = "emr.package.incremental-dir"
+PROPERTY_PACKAGE_INSTALL_WORKERS = "emr.package.install-workers"
+PROPERTY_PACKAGE_LAYERED = "emr.package.layered"
+PROPERTY_PACKAGE_PRECOMPILE = "emr.package.precompile"
+PROPERTY_PACKAGE_PROFILE_IMPORTS = "emr.package.profile-imports"
+PROPERTY_PACKAGE_PRUNE = "emr.package.prune"
+PROPERTY_PACKAGE_PRUNE_PATTERNS = "emr.package.prune-patterns"
+PROPERTY_PACKAGE_SCRIPTS_CHECKSUM = "emr.package.scripts-checksum"
+PROPERTY_PACKAGE_SCRIPTS_LINK = "emr.package.scripts-link"
+PROPERTY_PACKAGE_SOURCE_EXCLUDES = "emr.package.source-excludes"
+PROPERTY_PACKAGE_SOURCE_INCLUDES = "emr.package.source-includes"
+PROPERTY_PACKAGE_SOURCELESS = "emr.package.sourceless"
+PROPERTY_PACKAGE_STREAM_KEEP_LOCAL = "emr.package.stream-keep-local"
+PROPERTY_PACKAGE_STREAM_UPLOAD = "emr.package.stream-upload"
+PROPERTY_PACKAGE_TARGETS = "emr.package.targets"
+PROPERTY_PACKAGE_TARGET_PYTHONS = "emr.package.target-pythons"
+PROPERTY_PACKAGE_TARGET_WORKERS = "emr.package.target-workers"
+PROPERTY_PACKAGE_VENV = "emr.package.venv"
+PROPERTY_PACKAGE_VENV_MEASURE_STARTUP = "emr.package.venv-measure-startup"
+PROPERTY_PACKAGE_VENV_PYTHON = "emr.package.venv-python"
+PROPERTY_PACKAGE_VENV_PYTHON_HOME = "emr.package.venv-python-home"
+PROPERTY_PACKAGE_WORKERS = "emr.package.workers"
+PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT = "emr.package.zipimport-layout"
 PROPERTY_S3_BUCKET_NAME = "emr.s3.bucket-name"
 PROPERTY_S3_BUCKET_PREFIX = "emr.s3.bucket-prefix"
 PROPERTY_S3_FILE_ACCESS_CONTROL = "emr.s3.file-access-control"
 PROPERTY_S3_RELEASE_PREFIX = "emr.s3.release-prefix"
+PROPERTY_S3_RETRY_BASE_DELAY = "emr.s3.retry-base-delay"
+PROPERTY_S3_RETRY_MAX_ATTEMPTS = "emr.s3.retry-max-attempts"
+PROPERTY_S3_RETRY_MAX_DELAY = "emr.s3.retry-max-delay"
 PROPERTY_S3_SERVER_SIDE_ENCRYPTION = "emr.s3.server-side-encryption"
 PROPERTY_S3_SSE_KMS_KEY_ID = "emr.s3.sse-kms-keyid"
+PROPERTY_S3_UPLOAD_CONCURRENCY = "emr.s3.upload-concurrency"
+PROPERTY_S3_UPLOAD_FILES_CONCURRENCY = "emr.s3.upload-files-concurrency"
+PROPERTY_S3_UPLOAD_PART_SIZE = "emr.s3.upload-part-size"
+PROPERTY_S3_UPLOAD_SKIP_UNCHANGED = "emr.s3.upload-skip-unchanged"
 RELEASE_PREFIX_DEFAULT = "latest"
+# provided by EMR, never installed or packaged
+DEFAULT_DEPENDENCY_EXCLUDES = ["boto", "boto3", "pyspark"]
+DEFAULT_SOURCE_EXCLUDES = ["spark-warehouse"]
+# interpreter directory of the EMR cluster nodes
+DEFAULT_VENV_PYTHON_HOME = "/usr/bin"
+DEPENDENCY_LAYER_PREFIX = "dependencies"
+# properties which change the content of the dependency layer besides the requirements
+_DEPENDENCY_LAYER_PROPERTIES = [PROPERTY_PACKAGE_DEPENDENCY_EXCLUDES,
+                                PROPERTY_PACKAGE_DEPENDENCY_FILE_EXCLUDES,
+                                PROPERTY_PACKAGE_PRUNE,
+                                PROPERTY_PACKAGE_PRUNE_PATTERNS,
+                                PROPERTY_PACKAGE_PRECOMPILE,
+                                PROPERTY_PACKAGE_SOURCELESS,
+                                PROPERTY_PACKAGE_BYTECODE_PYTHON,
+                                PROPERTY_PACKAGE_COMPRESSION_RULES,
+                                PROPERTY_PACKAGE_COMPRESSION_SAMPLE,
+                                PROPERTY_PACKAGE_DETERMINISTIC,
+                                PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT,
+                                PROPERTY_PACKAGE_HOT_MODULES]
+# properties used by build_target in the worker processes of a multi-target build
+_TARGET_PROPERTIES = ["install_dependencies_index_url",
+                      PROPERTY_PACKAGE_COMPRESSION_RULES,
+                      PROPERTY_PACKAGE_COMPRESSION_SAMPLE,
+                      PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR,
+                      PROPERTY_PACKAGE_DEPENDENCY_CACHE_LINK,
+                      PROPERTY_PACKAGE_DEPENDENCY_EXCLUDES,
+                      PROPERTY_PACKAGE_DEPENDENCY_FILE_EXCLUDES,
+                      PROPERTY_PACKAGE_DETERMINISTIC,
+                      PROPERTY_PACKAGE_HOT_MODULES,
+                      PROPERTY_PACKAGE_INSTALL_WORKERS,
+                      PROPERTY_PACKAGE_PRECOMPILE,
+                      PROPERTY_PACKAGE_PRUNE,
+                      PROPERTY_PACKAGE_PRUNE_PATTERNS,
+                      PROPERTY_PACKAGE_SOURCE_EXCLUDES,
+                      PROPERTY_PACKAGE_SOURCE_INCLUDES,
+                      PROPERTY_PACKAGE_SOURCELESS,
+                      PROPERTY_PACKAGE_WORKERS,
+                      PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT]
 _EMR_PACKAGE_DIR = "emr-package"
+_LAYERS_DIR = "layers"
+_PIP_FAILED_REQUIREMENT = re.compile(r"(?:No matching distribution found for|"
+                                     r"Could not find a version that satisfies the requirement|"
+                                     r"Failed building wheel for|"
+                                     r"Failed to build) ([^\s(;]+)")
 
 
-def zip_recursive(archive, directory, folder="", excludes=None):
-    """Zip directories recursively"""
-    for item in os.listdir(directory):
-        if excludes and item in excludes:
+def write_entries(archive, entries, file_filter=None):
+    """Add the scanned FileEntry entries to archive (a PackageArchive or ZipFile) by their relative path"""
+    for entry in entries:
+        if file_filter and not file_filter(entry.relpath):
             continue
-        if os.path.isfile(os.path.join(directory, item)):
-            archive.write(os.path.join(directory, item), os.path.join(folder, item), zipfile.ZIP_DEFLATED)
-        elif os.path.isdir(os.path.join(directory, item)):
-            zip_recursive(archive, os.path.join(directory, item), folder=os.path.join(folder, item), excludes=excludes)
+        if isinstance(archive, PackageArchive):
+            archive.write(entry.path, entry.relpath, zipfile.ZIP_DEFLATED, stat=entry)
+        else:
+            archive.write(entry.path, entry.relpath, zipfile.ZIP_DEFLATED)
+
+
+def zip_recursive(archive, directory, folder="", excludes=None, file_filter=None, matcher=None):
+    """Zip directories recursively
+
+    excludes are glob patterns (see PathMatcher) matched against the path inside the archive,
+    excluded directories are not traversed. file_filter(arcname) may return False to skip a file.
+    """
+    if matcher is None:
+        matcher = PathMatcher(excludes=excludes)
+    prefix = folder.rstrip("/") + "/" if folder else ""
+    write_entries(archive, scan_tree(directory, matcher, prefix=prefix), file_filter=file_filter)
+
+
+def zip_python_tree(logger, project, archive, directory, bytecode_directory, matcher=None, entries=None):
+    """Zip directory and, if precompiling is enabled, the compiled modules via bytecode_directory
+
+    entries may be the result of an earlier scan_tree of directory with matcher.
+    """
+    matcher = matcher or PathMatcher()
+    if entries is None:
+        entries = scan_tree(directory, matcher)
+    if not project.get_property(PROPERTY_PACKAGE_PRECOMPILE, False):
+        write_entries(archive, entries)
+        return
+    failed = compile_tree(logger, directory, bytecode_directory, project.get_property(PROPERTY_PACKAGE_BYTECODE_PYTHON))
+    if failed:
+        logger.warn("Could not compile {0} modules in {1}, see debug log.".format(len(failed), directory))
+    bytecode_entries = scan_tree(bytecode_directory, BytecodeMatcher(matcher))
+    file_filter = None
+    if project.get_property(PROPERTY_PACKAGE_SOURCELESS, False):
+        compiled = set(entry.relpath[:-1] for entry in bytecode_entries)
+
+        def is_not_compiled(arcname):
+            return arcname not in compiled
+        file_filter = is_not_compiled
+    write_entries(archive, entries, file_filter=file_filter)
+    write_entries(archive, bytecode_entries)
+
+
+def get_source_matcher(project):
+    return PathMatcher(includes=project.get_property(PROPERTY_PACKAGE_SOURCE_INCLUDES),
+                       excludes=project.get_property(PROPERTY_PACKAGE_SOURCE_EXCLUDES, DEFAULT_SOURCE_EXCLUDES))
+
+
+def get_dependency_matcher(project, dependencies_directory):
+    """Matcher for the installed dependencies, excludes all files of excluded distributions"""
+    excludes = list(project.get_property(PROPERTY_PACKAGE_DEPENDENCY_FILE_EXCLUDES) or [])
+    excludes.extend(excluded_distributions(dependencies_directory, get_dependency_excludes(project)))
+    return PathMatcher(excludes=excludes)
+
+
+def get_dependency_excludes(project):
+    return project.get_property(PROPERTY_PACKAGE_DEPENDENCY_EXCLUDES, DEFAULT_DEPENDENCY_EXCLUDES)
+
+
+def _get_index_url_option(project):
+    index_url = project.get_property("install_dependencies_index_url")
+    if index_url:
+        return "--index-url {0}".format(index_url)
+    return ""
+
+
+def _find_failed_requirement(dependencies, pip_output):
+    """Map a pip error output back to the requirement that caused it"""
+    for match in _PIP_FAILED_REQUIREMENT.finditer(pip_output):
+        failed = requirement_name(match.group(1))
+        for dependency in dependencies:
+            if requirement_name(dependency) == failed:
+                return dependency
+        return match.group(1)
+    return None
+
+
+def _run_pip(cmd):
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    return process.returncode, "{0}\n{1}".format(stdout or "", stderr or "")
+
+
+def _merge_tree(source_directory, target_directory):
+    """Move all files of source_directory into target_directory, keeping the folder structure"""
+    for root, _, files in os.walk(source_directory):
+        destination = os.path.join(target_directory, os.path.relpath(root, source_directory))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            shutil.move(os.path.join(root, name), os.path.join(destination, name))
+
+
+def _install_distributions_parallel(logger, distributions, target_directory, index_url, workers, pip_options=()):
+    """Install already resolved distributions w/o dependency resolution using a pool of pip processes"""
+    staging_root = tempfile.mkdtemp(prefix="emr-staging-")
+
+    def install(args):
+        index, distribution = args
+        staging_dir = os.path.join(staging_root, str(index))
+        cmd = "pip install --no-deps --target {0} {1}".format(staging_dir, index_url).split() + list(pip_options) + \
+            [distribution]
+        logger.debug("Unpacking distribution {0}: {1}".format(os.path.basename(distribution), " ".join(cmd)))
+        returncode, output = _run_pip(cmd)
+        if returncode != 0:
+            msg = "Command {0} failed to install dependency {1}: {2}\n{3}".format(
+                " ".join(cmd), os.path.basename(distribution), returncode, output)
+            raise Exception(msg)
+        return staging_dir
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            staging_dirs = list(executor.map(install, enumerate(distributions)))
+        for staging_dir in staging_dirs:
+            _merge_tree(staging_dir, target_directory)
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+
+def _prepare_dependencies_dir_batched(logger, dependencies, target_directory, index_url, workers, pip_options=()):
+    """Resolve the whole requirement set in a single pip run, pip_options may select another target platform"""
+    download_dir = None
+    if workers > 1:
+        download_dir = tempfile.mkdtemp(prefix="emr-download-")
+        cmd = "pip download --dest {0} {1}".format(download_dir, index_url).split() + list(pip_options) + dependencies
+    else:
+        cmd = "pip install --target {0} {1}".format(target_directory, index_url).split() + list(pip_options) + \
+            dependencies
+    try:
+        logger.debug("Installing dependencies {0}: {1}".format(", ".join(dependencies), " ".join(cmd)))
+        returncode, output = _run_pip(cmd)
+        if returncode != 0:
+            failed = _find_failed_requirement(dependencies, output)
+            if failed:
+                msg = "Command {0} failed to install dependency {1}: {2}\n{3}".format(
+                    " ".join(cmd), failed, returncode, output)
+            else:
+                msg = "Command {0} failed to install dependencies: {1}\n{2}".format(" ".join(cmd), returncode, output)
+            raise Exception(msg)
+        if download_dir:
+            distributions = [os.path.join(download_dir, item) for item in sorted(os.listdir(download_dir))]
+            _install_distributions_parallel(logger, distributions, target_directory, index_url, workers,
+                                            pip_options=pip_options)
+    finally:
+        if download_dir:
+            shutil.rmtree(download_dir, ignore_errors=True)
 
 
 def prepare_dependencies_dir(logger, project, target_directory, excludes=None):
     """Get all dependencies from project and install them to given dir"""
     excludes = excludes or []
     dependencies = ast.literal_eval(build_install_dependencies_string(project))
+    index_url = _get_index_url_option(project)
 
-    index_url = project.get_property("install_dependencies_index_url")
-    if index_url:
-        index_url = "--index-url {0}".format(index_url)
-    else:
-        index_url = ""
+    if project.get_property(PROPERTY_PACKAGE_BATCH_INSTALL, False):
+        for dependency in [d for d in dependencies if is_excluded_requirement(d, excludes)]:
+            logger.debug("Not installing dependency {0}.".format(dependency))
+        dependencies = [d for d in dependencies if not is_excluded_requirement(d, excludes)]
+        if dependencies:
+            workers = int(project.get_property(PROPERTY_PACKAGE_INSTALL_WORKERS, 1))
+            _prepare_dependencies_dir_batched(logger, dependencies, target_directory, index_url, workers)
+        return
 
     pip_cmd = "pip install --target {0} {1} {2}"
     for dependency in dependencies:
-        if dependency in excludes:
+        if is_excluded_requirement(dependency, excludes):
             logger.debug("Not installing dependency {0}.".format(dependency))
             continue
 
@@ -60,6 +312,23 @@ def prepare_dependencies_dir(logger, project, target_directory, excludes=None):
             raise Exception(msg)
 
 
+def prepare_cached_dependencies_dir(logger, project, target_directory, excludes=None):
+    """Like prepare_dependencies_dir, but reuse installed dependencies from the persistent cache"""
+    excludes = excludes or []
+    cache_dir = os.path.expanduser(project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR))
+    link = project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_LINK, True)
+    dependencies = [d for d in ast.literal_eval(build_install_dependencies_string(project))
+                    if not is_excluded_requirement(d, excludes)]
+    key = dependency_cache_key(dependencies, project.get_property("install_dependencies_index_url"))
+    if not restore_dependencies(logger, cache_dir, key, target_directory, link=link):
+        prepare_dependencies_dir(logger, project, target_directory, excludes=excludes)
+        store_dependencies(logger, cache_dir, key, target_directory, dependencies, link=link)
+    evict_dependency_cache(logger, cache_dir,
+                           max_entries=project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_ENTRIES),
+                           max_size=project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_SIZE),
+                           keep=key)
+
+
 def get_emr_package_dir(project):
     return os.path.join(project.expand_path("$dir_target"), _EMR_PACKAGE_DIR + "-" + project.version)
 
@@ -68,6 +337,192 @@ def get_path_to_zipfile(project):
     return os.path.join(get_emr_package_dir(project), "{0}.zip".format(project.name))
 
 
+def get_installed_dependencies(project):
+    """Requirements of the project which are installed into the emr-package"""
+    excludes = get_dependency_excludes(project)
+    return [d for d in ast.literal_eval(build_install_dependencies_string(project))
+            if not is_excluded_requirement(d, excludes)]
+
+
+def get_dependency_layer_name(project):
+    """File name of the dependency layer, named by the hash of the requirement set and packaging options"""
+    options = {name: project.get_property(name) for name in _DEPENDENCY_LAYER_PROPERTIES}
+    key = dependency_cache_key(get_installed_dependencies(project),
+                               project.get_property("install_dependencies_index_url"),
+                               options=json.loads(json.dumps(options, sort_keys=True, default=str)))
+    return "{0}-dependencies-{1}.zip".format(project.name, key[:16])
+
+
+def get_dependency_layers_dir(project):
+    return os.path.join(get_emr_package_dir(project), _LAYERS_DIR)
+
+
+def get_path_to_layers_manifest(project):
+    return os.path.join(get_emr_package_dir(project), "{0}.layers.json".format(project.name))
+
+
+def get_path_to_file_manifest(project):
+    """Files scanned by emr_package, saved next to the emr-package directory for the later tasks"""
+    return get_emr_package_dir(project) + ".files.json"
+
+
+def get_path_to_venv_archive(project):
+    return os.path.join(get_emr_package_dir(project), "{0}-venv.tar.gz".format(project.name))
+
+
+def get_path_to_checksum_file(project):
+    return get_path_to_zipfile(project) + ".sha256"
+
+
+def get_targets(project):
+    try:
+        return parse_targets(project.get_property(PROPERTY_PACKAGE_TARGETS),
+                             project.get_property(PROPERTY_PACKAGE_TARGET_PYTHONS))
+    except ValueError as e:
+        raise BuildFailedException("{0} for property: '{1}'".format(e, PROPERTY_PACKAGE_TARGETS))
+
+
+def get_target_package_dir(project, target):
+    return os.path.join(get_emr_package_dir(project), target.name)
+
+
+def scan_package_dir(project):
+    """Files of the emr-package directory and of the target directories of a multi-target build to be uploaded"""
+    emr_package_dir = get_emr_package_dir(project)
+    entries = scan_tree(emr_package_dir, recursive=False)
+    for target in get_targets(project):
+        entries.extend(scan_tree(get_target_package_dir(project, target), prefix=target.name + "/", recursive=False))
+    return entries
+
+
+def write_checksum(project, checksum=None):
+    """Write the sha256 of the emr-package-zip in the format of sha256sum next to the VERSION file"""
+    return write_checksum_file(get_path_to_zipfile(project), checksum)
+
+
+def write_checksum_file(path_to_zipfile, checksum=None):
+    checksum = checksum or file_sha256(path_to_zipfile)
+    with open(path_to_zipfile + ".sha256", "w") as checksum_file:
+        checksum_file.write("{0}  {1}\n".format(checksum, os.path.basename(path_to_zipfile)))
+    return checksum
+
+
+def get_venv_python_home(project):
+    """Absolute interpreter directory on the cluster nodes, the packed virtualenv must not link to the build python"""
+    python_home = project.get_property(PROPERTY_PACKAGE_VENV_PYTHON_HOME, DEFAULT_VENV_PYTHON_HOME)
+    if not python_home or not python_home.startswith("/"):
+        raise BuildFailedException("Property '{0}' must be the absolute interpreter directory on the cluster nodes, "
+                                   "got '{1}'".format(PROPERTY_PACKAGE_VENV_PYTHON_HOME, python_home))
+    return python_home
+
+
+def package_venv(logger, project, dependency_entries):
+    """Pack a relocatable virtualenv with the installed dependencies for spark-submit --archives
+
+    Returns a report with the number of files, the size before and after compression and, if
+    enabled, the time to unpack the archive and import all top level modules.
+    """
+    filename = get_path_to_venv_archive(project)
+    venv_dir = os.path.join(get_emr_package_dir(project), "venv")
+    if os.path.isdir(venv_dir):
+        shutil.rmtree(venv_dir)
+    python = project.get_property(PROPERTY_PACKAGE_VENV_PYTHON) or \
+        project.get_property(PROPERTY_PACKAGE_BYTECODE_PYTHON)
+    site_packages = create_venv(logger, python, venv_dir)
+    relocate_venv(venv_dir, get_venv_python_home(project))
+    files = pack_venv(logger, venv_dir, site_packages, dependency_entries, filename,
+                      deterministic=project.get_property(PROPERTY_PACKAGE_DETERMINISTIC, False))
+    shutil.rmtree(venv_dir)
+    report = {"archive": os.path.basename(filename),
+              "files": files,
+              "size": sum(entry.st_size for entry in dependency_entries),
+              "compressed_size": os.path.getsize(filename)}
+    if project.get_property(PROPERTY_PACKAGE_VENV_MEASURE_STARTUP, False):
+        modules = top_level_modules([entry.relpath for entry in dependency_entries])
+        report.update(measure_venv_startup(logger, filename, modules))
+    report_file = os.path.join(project.expand_path("$dir_target"), "reports", "{0}-venv.json".format(project.name))
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    with open(report_file, "w") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    message = "venv archive: {0} files, {1} -> {2} bytes".format(files, report["size"], report["compressed_size"])
+    if "import_seconds" in report:
+        message += ", unpacked in {0:.2f}s, imported in {1:.2f}s".format(
+            report["extract_seconds"], report["import_seconds"])
+    logger.info(message)
+    return report
+
+
+def create_archive(project, path_to_zipfile, incremental_dir=None, fileobj=None):
+    """PackageArchive configured by the project, reusing entries of the last build in incremental_dir
+
+    The archive is written to fileobj instead of path_to_zipfile if given.
+    """
+    workers = int(project.get_property(PROPERTY_PACKAGE_WORKERS, 1))
+    deterministic = project.get_property(PROPERTY_PACKAGE_DETERMINISTIC, False)
+    policy = get_compression_policy(project)
+    layout = get_zipimport_layout(project)
+    if not incremental_dir:
+        return PackageArchive(path_to_zipfile, workers=workers, deterministic=deterministic, policy=policy,
+                              fileobj=fileobj, layout=layout)
+    previous_zipfile = os.path.join(incremental_dir, os.path.basename(path_to_zipfile))
+    return PackageArchive(path_to_zipfile, previous_archive=previous_zipfile,
+                          previous_manifest=previous_zipfile + ".manifest.json", record_manifest=True,
+                          workers=workers, deterministic=deterministic, policy=policy, fileobj=fileobj,
+                          layout=layout)
+
+
+def save_incremental(incremental_dir, path_to_zipfile, archive=None):
+    """Keep the built zip (and the manifest of archive) in incremental_dir for the next build"""
+    previous_zipfile = os.path.join(incremental_dir, os.path.basename(path_to_zipfile))
+    os.makedirs(incremental_dir, exist_ok=True)
+    link_or_copy_file(path_to_zipfile, previous_zipfile)
+    if archive is not None:
+        save_manifest(previous_zipfile + ".manifest.json", archive.manifest)
+
+
+def get_compression_policy(project):
+    try:
+        return CompressionPolicy(project.get_property(PROPERTY_PACKAGE_COMPRESSION_RULES),
+                                 sample=project.get_property(PROPERTY_PACKAGE_COMPRESSION_SAMPLE, False))
+    except ValueError as e:
+        raise BuildFailedException("{0} for property: '{1}'".format(e, PROPERTY_PACKAGE_COMPRESSION_RULES))
+
+
+def get_zipimport_layout(project):
+    if not project.get_property(PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT, False):
+        return None
+    return ZipimportLayout(project.get_property(PROPERTY_PACKAGE_HOT_MODULES))
+
+
+def profile_archive_imports(project, logger, path_to_zipfile, path_to_layer=None):
+    """Import the top level and hot modules from the local emr-zip (and dependency layer) in a fresh interpreter"""
+    filenames = [filename for filename in [path_to_layer, path_to_zipfile] if filename and os.path.isfile(filename)]
+    if path_to_zipfile not in filenames:
+        logger.warn("Can not profile the imports without a local emr-package-zip.")
+        return {}
+    names = []
+    for filename in filenames:
+        with zipfile.ZipFile(filename) as archive:
+            names.extend(archive.namelist())
+    hot_modules = [name for name in project.get_property(PROPERTY_PACKAGE_HOT_MODULES) or []
+                   if not any(char in name for char in "*?[")]
+    modules = sorted(set(top_level_modules(names) + hot_modules))
+    result = profile_zip_imports(logger, filenames, modules,
+                                 python=project.get_property(PROPERTY_PACKAGE_BYTECODE_PYTHON))
+    logger.info("Imported {0} modules from the emr-package-zip: open {1:.1f} ms, import {2:.1f} ms, {3} failed."
+                .format(result["modules"], 1000 * result["open_seconds"], 1000 * result["import_seconds"],
+                        len(result["failed"])))
+    return result
+
+
+def log_compression_statistics(logger, archive):
+    for category, statistics in sorted(archive.statistics.items()):
+        ratio = float(statistics["compressed_size"]) / statistics["size"] if statistics["size"] else 1.0
+        logger.info("compression {0}: {1} files, {2} -> {3} bytes ({4:.1%}) in {5:.2f}s".format(
+            category, statistics["files"], statistics["size"], statistics["compressed_size"], ratio,
+            statistics["seconds"]))
+
+
 def write_version(project, archive):
     """Get the current version and write it to a version file"""
     filename = os.path.join(get_emr_package_dir(project), "VERSION")
@@ -76,6 +531,198 @@ def write_version(project, archive):
     archive.write(filename, "VERSION")
 
 
+def sync_scripts(project, logger, metrics, emr_package_dir):
+    """Sync the scripts into the emr-package directory, copying only the files changed since the last build
+
+    Scripts of the last build (from its file manifest) which do not exist anymore are removed.
+    Returns the scripts directory, its entries and the changes of sync_entries.
+    """
+    scripts = project.expand_path("$dir_source_main_scripts")
+    script_entries = scan_tree(scripts)
+    _, previous = load_file_manifest(get_path_to_file_manifest(project)).get("scripts", (None, []))
+    changes = {"copied": [], "unchanged": [], "removed": []}
+    if script_entries or previous:
+        logger.info("syncing scripts to: {0}".format(emr_package_dir))
+        with metrics.phase("scripts") as record:
+            changes = sync_entries(script_entries, emr_package_dir, [entry.relpath for entry in previous],
+                                   link=project.get_property(PROPERTY_PACKAGE_SCRIPTS_LINK, False),
+                                   checksum=project.get_property(PROPERTY_PACKAGE_SCRIPTS_CHECKSUM, False))
+            copied = set(changes["copied"])
+            record["files"], record["bytes_out"] = \
+                entries_statistics([entry for entry in script_entries if entry.relpath in copied])
+        logger.info("Scripts: {0} copied, {1} unchanged, {2} removed.".format(
+            len(changes["copied"]), len(changes["unchanged"]), len(changes["removed"])))
+    return scripts, script_entries, changes
+
+
+def get_script_trees(emr_package_dir, script_entries, changes):
+    """File manifest trees of the scripts copied and removed by sync_scripts, used by the upload"""
+    copied = set(changes["copied"])
+    return {"scripts_copied": (emr_package_dir, [entry for entry in script_entries if entry.relpath in copied]),
+            "scripts_removed": (emr_package_dir, [FileEntry(relpath, os.path.join(emr_package_dir, relpath), 0, 0, 0)
+                                                  for relpath in changes["removed"]])}
+
+
+def install_target_dependencies(logger, project, target, dependencies, target_directory):
+    """Install the binary distributions of dependencies for target to target_directory, using the dependency cache"""
+    index_url = _get_index_url_option(project)
+    workers = int(project.get_property(PROPERTY_PACKAGE_INSTALL_WORKERS, 1))
+    pip_options = pip_target_options(target)
+    cache_dir = project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR)
+    if not cache_dir:
+        _prepare_dependencies_dir_batched(logger, dependencies, target_directory, index_url, workers, pip_options)
+        return
+    cache_dir = os.path.expanduser(cache_dir)
+    link = project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_LINK, True)
+    key = dependency_cache_key(dependencies, project.get_property("install_dependencies_index_url"),
+                               platform_tag=target.name)
+    if not restore_dependencies(logger, cache_dir, key, target_directory, link=link):
+        _prepare_dependencies_dir_batched(logger, dependencies, target_directory, index_url, workers, pip_options)
+        store_dependencies(logger, cache_dir, key, target_directory, dependencies, link=link)
+
+
+def build_target(job):
+    """Install the dependencies and assemble the emr-zip of one target, runs in a worker process
+
+    job holds the target, a PropertySnapshot of the project, the requirements and the scans of the
+    sources and resources shared by all targets. Returns the statistics and the log messages.
+    """
+    started = time.time()
+    logger = RecordingLogger()
+    project = job["project"]
+    target = job["target"]
+    target_dir = job["directory"]
+    dependencies_dir = os.path.join(target_dir, "dependencies")
+    if os.path.isdir(dependencies_dir):
+        shutil.rmtree(dependencies_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    if job["dependencies"]:
+        install_target_dependencies(logger, project, target, job["dependencies"], dependencies_dir)
+    # before pruning, the RECORD files name the files of excluded distributions
+    dependency_matcher = get_dependency_matcher(project, dependencies_dir)
+    if os.path.isdir(dependencies_dir) and project.get_property(PROPERTY_PACKAGE_PRUNE, False):
+        patterns = project.get_property(PROPERTY_PACKAGE_PRUNE_PATTERNS) or DEFAULT_PRUNE_PATTERNS
+        pruned = prune_tree(logger, dependencies_dir, patterns)
+        logger.info("Pruned {0} files and directories from the dependencies.".format(pruned))
+    dependency_entries = scan_tree(dependencies_dir, dependency_matcher)
+    bytecode_dir = os.path.join(target_dir, "bytecode")
+    path_to_zipfile = os.path.join(target_dir, job["zipfile"])
+    archive = create_archive(project, path_to_zipfile)
+    zip_python_tree(logger, project, archive, dependencies_dir, os.path.join(bytecode_dir, "dependencies"),
+                    matcher=dependency_matcher, entries=dependency_entries)
+    sources, source_entries = job["sources"]
+    zip_python_tree(logger, project, archive, sources, os.path.join(bytecode_dir, "sources"),
+                    matcher=get_source_matcher(project), entries=source_entries)
+    archive.write(job["version_file"], "VERSION")
+    write_entries(archive, job["resources"])
+    archive.close()
+    log_compression_statistics(logger, archive)
+    if project.get_property(PROPERTY_PACKAGE_DETERMINISTIC, False):
+        logger.info("emr-package-zip sha256: {0}".format(write_checksum_file(path_to_zipfile)))
+    return {"target": target.name,
+            "zipfile": path_to_zipfile,
+            "seconds": time.time() - started,
+            "dependencies": len(dependency_entries),
+            "files": sum(statistics["files"] for statistics in archive.statistics.values()),
+            "bytes_in": sum(statistics["size"] for statistics in archive.statistics.values()),
+            "bytes_out": os.path.getsize(path_to_zipfile),
+            "messages": logger.messages}
+
+
+def build_targets(logger, jobs, workers):
+    """Run build_target for all jobs, in a pool of worker processes if workers > 1"""
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    futures = [executor.submit(build_target, job) if executor else None for job in jobs]
+    try:
+        results = []
+        for job, future in zip(jobs, futures):
+            name = job["target"].name
+            try:
+                result = future.result() if future else build_target(job)
+            except Exception as e:
+                raise BuildFailedException("Building target {0} failed: {1}".format(name, e))
+            replay_messages(logger, result["messages"], prefix="[{0}] ".format(name))
+            results.append(result)
+        return results
+    finally:
+        if executor:
+            # do not wait for the targets not started yet after a failure
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+
+def package_targets(project, logger, targets):
+    """emr_package for several python versions/platforms, the targets are built in parallel processes
+
+    Sources, resources and scripts are scanned once and shared, each target gets its own dependencies
+    and emr-zip in a directory named by the target below the emr-package directory.
+    """
+    for name in [PROPERTY_PACKAGE_LAYERED, PROPERTY_PACKAGE_VENV, PROPERTY_PACKAGE_INCREMENTAL_DIR,
+                 PROPERTY_PACKAGE_STREAM_UPLOAD]:
+        if project.get_property(name):
+            raise BuildFailedException("Property '{0}' is not supported together with '{1}'".format(
+                name, PROPERTY_PACKAGE_TARGETS))
+    if project.get_property(PROPERTY_PACKAGE_PRECOMPILE, False):
+        missing = [target.name for target in targets if not target.python]
+        if missing:
+            raise BuildFailedException("Precompiling needs an interpreter for the targets {0} in property: '{1}'"
+                                       .format(", ".join(missing), PROPERTY_PACKAGE_TARGET_PYTHONS))
+    metrics = TaskMetrics("emr_package")
+    emr_package_dir = get_emr_package_dir(project)
+    os.makedirs(emr_package_dir, exist_ok=True)
+    with metrics.phase("sources") as record:
+        sources = project.expand_path("$dir_source_main_python")
+        source_entries = scan_tree(sources, get_source_matcher(project))
+        resource_entries = scan_tree(os.path.join(os.path.dirname(sources), "resources"))
+        record["files"], record["bytes_in"] = entries_statistics(source_entries + resource_entries)
+        version_file = os.path.join(emr_package_dir, "VERSION")
+        with open(version_file, "w") as fp:
+            fp.write(project.version)
+    processes = int(project.get_property(PROPERTY_PACKAGE_TARGET_WORKERS, 0)) or \
+        min(len(targets), os.cpu_count() or 1)
+    properties = {name: project.get_property(name) for name in _TARGET_PROPERTIES}
+    # the compression threads of all processes share the cpus
+    properties[PROPERTY_PACKAGE_WORKERS] = max(1, int(project.get_property(PROPERTY_PACKAGE_WORKERS, 1)) // processes)
+    dependencies = get_installed_dependencies(project)
+    jobs = []
+    for target in targets:
+        target_properties = dict(properties)
+        target_properties[PROPERTY_PACKAGE_BYTECODE_PYTHON] = target.python
+        jobs.append({"target": target,
+                     "project": PropertySnapshot(target_properties),
+                     "directory": get_target_package_dir(project, target),
+                     "zipfile": os.path.basename(get_path_to_zipfile(project)),
+                     "dependencies": dependencies,
+                     "sources": (sources, source_entries),
+                     "resources": resource_entries,
+                     "version_file": version_file})
+    logger.info("Going to build the targets {0} with {1} processes.".format(
+        ", ".join(target.name for target in targets), processes))
+    with metrics.phase("targets") as record:
+        results = build_targets(logger, jobs, processes)
+        for result in results:
+            record["files"] += result["files"]
+            record["bytes_in"] += result["bytes_in"]
+            record["bytes_out"] += result["bytes_out"]
+    for result in results:
+        metrics.add_phase("target " + result["target"], result["seconds"], files=result["files"],
+                          bytes_in=result["bytes_in"], bytes_out=result["bytes_out"])
+        logger.info("emr-package-zip for {0} is available at: {1}".format(result["target"], result["zipfile"]))
+    cache_dir = project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR)
+    if cache_dir:
+        evict_dependency_cache(logger, os.path.expanduser(cache_dir),
+                               max_entries=project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_ENTRIES),
+                               max_size=project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_MAX_SIZE))
+    scripts, script_entries, script_changes = sync_scripts(project, logger, metrics, emr_package_dir)
+    save_file_manifest(get_path_to_file_manifest(project),
+                       dict(get_script_trees(emr_package_dir, script_entries, script_changes),
+                            sources=(sources, source_entries),
+                            scripts=(scripts, script_entries),
+                            package=(emr_package_dir, scan_package_dir(project))))
+    write_report(project, logger, metrics, project.get_property(PROPERTY_METRICS_HOOK))
+
+
 @task("emr_package",
       description="Package the modules, dependencies and scripts into a emr zip")
 @depends("clean",
@@ -83,58 +730,365 @@ def write_version(project, archive):
          "publish",
          "package")
 def emr_package(project, logger):
+    targets = get_targets(project)
+    if targets:
+        package_targets(project, logger, targets)
+        return
+    metrics = TaskMetrics("emr_package")
     emr_package_dir = get_emr_package_dir(project)
     os.makedirs(emr_package_dir, exist_ok=True)
     emr_dependencies_dir = os.path.join(emr_package_dir, "dependencies")
-    excludes = ["boto", "boto3"]
-    logger.info("Going to prepare dependencies.")
-    prepare_dependencies_dir(logger, project, emr_dependencies_dir, excludes=excludes)
+    excludes = get_dependency_excludes(project)
+    incremental_dir = project.get_property(PROPERTY_PACKAGE_INCREMENTAL_DIR)
+    if incremental_dir:
+        incremental_dir = os.path.expanduser(incremental_dir)
+    layered = project.get_property(PROPERTY_PACKAGE_LAYERED, False)
+    venv = project.get_property(PROPERTY_PACKAGE_VENV, False)
+    if venv:
+        get_venv_python_home(project)
+    streaming = project.get_property(PROPERTY_PACKAGE_STREAM_UPLOAD, False)
+    if streaming and incremental_dir and not project.get_property(PROPERTY_PACKAGE_STREAM_KEEP_LOCAL, True):
+        raise BuildFailedException("Property '{0}' needs the local copy of the emr-package-zip ('{1}')".format(
+            PROPERTY_PACKAGE_INCREMENTAL_DIR, PROPERTY_PACKAGE_STREAM_KEEP_LOCAL))
+    path_to_layer = None
+    reused_layer = False
+    dependency_entries = []
+    if layered:
+        path_to_layer = os.path.join(get_dependency_layers_dir(project), get_dependency_layer_name(project))
+        os.makedirs(os.path.dirname(path_to_layer), exist_ok=True)
+        previous_layer = os.path.join(incremental_dir, os.path.basename(path_to_layer)) if incremental_dir else None
+        # the virtualenv archive needs the installed dependencies
+        if previous_layer and os.path.isfile(previous_layer) and not venv:
+            logger.info("Reusing dependency layer {0}.".format(previous_layer))
+            link_or_copy_file(previous_layer, path_to_layer)
+            reused_layer = True
+    with metrics.phase("dependencies") as record:
+        if not reused_layer:
+            logger.info("Going to prepare dependencies.")
+            if project.get_property(PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR):
+                prepare_cached_dependencies_dir(logger, project, emr_dependencies_dir, excludes=excludes)
+            else:
+                prepare_dependencies_dir(logger, project, emr_dependencies_dir, excludes=excludes)
+            # before pruning, the RECORD files name the files of excluded distributions
+            dependency_matcher = get_dependency_matcher(project, emr_dependencies_dir)
+            if os.path.isdir(emr_dependencies_dir) and project.get_property(PROPERTY_PACKAGE_PRUNE, False):
+                patterns = project.get_property(PROPERTY_PACKAGE_PRUNE_PATTERNS) or DEFAULT_PRUNE_PATTERNS
+                pruned = prune_tree(logger, emr_dependencies_dir, patterns)
+                logger.info("Pruned {0} files and directories from the dependencies.".format(pruned))
+            dependency_entries = scan_tree(emr_dependencies_dir, dependency_matcher)
+            record["files"], record["bytes_out"] = entries_statistics(dependency_entries)
     logger.info("Going to assemble the emr-package-zip.")
     path_to_zipfile = get_path_to_zipfile(project)
     logger.debug("Going to assemble the emr-package-zip: {}".format(path_to_zipfile))
-    archive = zipfile.ZipFile(path_to_zipfile, "w")
-    if os.path.isdir(emr_dependencies_dir):
-        zip_recursive(archive, emr_dependencies_dir)
-    sources = project.expand_path("$dir_source_main_python")
-    excludes = ["spark-warehouse"]
-    zip_recursive(archive, sources, excludes=excludes)
-    write_version(project, archive)
-    resources = os.path.join(os.path.dirname(sources), "resources")
-    if os.path.exists(resources) and os.path.isdir(resources):
-        zip_recursive(archive, resources)
-    archive.close()
-    logger.info("emr-package-zip is available at: {0}".format(path_to_zipfile))
-    scripts = project.expand_path("$dir_source_main_scripts")
-    if os.path.exists(scripts) and os.path.isdir(scripts):
-        logger.info("copying scripts to: {0}".format(emr_package_dir))
-        dir_util.copy_tree(scripts, emr_package_dir)
+    bytecode_dir = os.path.join(emr_package_dir, "bytecode")
+    archives = []
+    with metrics.phase("compress") as record:
+        if os.path.isdir(emr_dependencies_dir) and layered and not reused_layer:
+            logger.info("Going to assemble the dependency layer: {0}".format(path_to_layer))
+            layer_archive = create_archive(project, path_to_layer)
+            zip_python_tree(logger, project, layer_archive, emr_dependencies_dir,
+                            os.path.join(bytecode_dir, "dependencies"), matcher=dependency_matcher,
+                            entries=dependency_entries)
+            layer_archive.close()
+            archives.append(layer_archive)
+            if incremental_dir:
+                save_incremental(incremental_dir, path_to_layer)
+        stream = upload = None
+        if streaming:
+            controller = get_transfer_controller(project)
+            stream, upload = start_stream_upload(project, logger, path_to_zipfile, controller)
+        try:
+            archive = create_archive(project, path_to_zipfile, incremental_dir, fileobj=stream)
+            archives.append(archive)
+            if os.path.isdir(emr_dependencies_dir) and not layered:
+                zip_python_tree(logger, project, archive, emr_dependencies_dir,
+                                os.path.join(bytecode_dir, "dependencies"), matcher=dependency_matcher,
+                                entries=dependency_entries)
+            sources = project.expand_path("$dir_source_main_python")
+            source_matcher = get_source_matcher(project)
+            source_entries = scan_tree(sources, source_matcher)
+            zip_python_tree(logger, project, archive, sources, os.path.join(bytecode_dir, "sources"),
+                            matcher=source_matcher, entries=source_entries)
+            write_version(project, archive)
+            resources = os.path.join(os.path.dirname(sources), "resources")
+            if os.path.exists(resources) and os.path.isdir(resources):
+                zip_recursive(archive, resources)
+            archive.close()
+        except Exception as e:
+            if stream is not None:
+                # aborts the multipart upload
+                stream.fail(e)
+            raise
+        finally:
+            if stream is not None:
+                stream.close()
+        for statistics in [s for a in archives for s in a.statistics.values()]:
+            record["files"] += statistics["files"]
+            record["bytes_in"] += statistics["size"]
+        record["bytes_out"] = sum(os.path.getsize(a.filename) for a in archives if a is not archive) + \
+            (stream.tell() if stream is not None else os.path.getsize(path_to_zipfile))
+        if record["bytes_in"]:
+            record["compression_ratio"] = float(record["bytes_out"]) / record["bytes_in"]
+    for package_archive in archives:
+        log_compression_statistics(logger, package_archive)
+        if package_archive.dropped:
+            logger.info("Dropped {0} entries of {1} not used by zipimport.".format(
+                package_archive.dropped, os.path.basename(package_archive.filename)))
+    if incremental_dir:
+        logger.info("Reused {0} and compressed {1} archive entries.".format(archive.reused, archive.compressed))
+        save_incremental(incremental_dir, path_to_zipfile, archive)
+    if os.path.isfile(path_to_zipfile):
+        logger.info("emr-package-zip is available at: {0}".format(path_to_zipfile))
+    if layered and os.path.isfile(path_to_layer):
+        logger.info("dependency layer is available at: {0}".format(path_to_layer))
+    deterministic = project.get_property(PROPERTY_PACKAGE_DETERMINISTIC, False)
+    if deterministic:
+        checksum = write_checksum(project, stream.sha256 if stream is not None else None)
+        logger.info("emr-package-zip sha256: {0}".format(checksum))
+    if project.get_property(PROPERTY_PACKAGE_PROFILE_IMPORTS, False):
+        with metrics.phase("imports") as record:
+            record.update(profile_archive_imports(project, logger, path_to_zipfile, path_to_layer))
+    if venv:
+        logger.info("Going to pack the virtualenv archive.")
+        with metrics.phase("venv") as record:
+            report = package_venv(logger, project, dependency_entries)
+            record["files"], record["bytes_in"], record["bytes_out"] = \
+                report["files"], report["size"], report["compressed_size"]
+    scripts, script_entries, script_changes = sync_scripts(project, logger, metrics, emr_package_dir)
+    streamed = []
+    if upload is not None:
+        # only the part of the upload not overlapping with packaging
+        with metrics.phase("upload") as record:
+            try:
+                result = upload.result()
+            except Exception as e:
+                raise BuildFailedException("Streaming upload of {0} failed: {1}".format(path_to_zipfile, e))
+            finally:
+                record["transfer"] = log_transfer_statistics(logger, controller)
+            record_transfers(metrics, record, [result])
+            record["writer_blocked_seconds"] = stream.blocked_seconds
+        logger.info("streamed: {0} to {1}, compression waited {2:.2f}s for the upload".format(
+            os.path.basename(path_to_zipfile), result["key"], stream.blocked_seconds))
+        streamed.append(FileEntry(os.path.basename(path_to_zipfile), path_to_zipfile, result["size"], 0, 0))
+    save_file_manifest(get_path_to_file_manifest(project),
+                       dict(get_script_trees(emr_package_dir, script_entries, script_changes),
+                            dependencies=(emr_dependencies_dir, dependency_entries),
+                            sources=(sources, source_entries),
+                            scripts=(scripts, script_entries),
+                            package=(emr_package_dir, scan_package_dir(project)),
+                            streamed=(emr_package_dir, streamed)))
+    write_report(project, logger, metrics, project.get_property(PROPERTY_METRICS_HOOK))
 
 
-@task("emr_upload_to_s3", description="Upload a packaged lambda-zip to S3")
-@depends("emr_package")
-def emr_upload_to_s3(project, logger):
-    emr_package_dir = get_emr_package_dir(project)
-    bucket_prefix = project.get_property(PROPERTY_S3_BUCKET_PREFIX)
-    bucket_name = project.get_mandatory_property(PROPERTY_S3_BUCKET_NAME)
+def record_transfers(metrics, record, results):
+    """Fill the phase record with the totals of the per object results of an upload or copy"""
+    transferred = [result for result in results if not result.get("skipped")]
+    record["files"] = len(transferred)
+    record["bytes_in"] = record["bytes_out"] = sum(result["size"] for result in transferred)
+    for result in results:
+        metrics.add_object(result["key"], result["size"], result["seconds"], skipped=result.get("skipped", False))
+
+
+def get_transfer_controller(project):
+    """TransferController limiting the S3 requests in flight to the configured concurrency"""
+    concurrency = int(project.get_property(PROPERTY_S3_UPLOAD_CONCURRENCY, DEFAULT_CONCURRENCY))
+    files_concurrency = int(project.get_property(PROPERTY_S3_UPLOAD_FILES_CONCURRENCY, DEFAULT_FILES_CONCURRENCY))
+    return TransferController(concurrency * files_concurrency,
+                              max_attempts=int(project.get_property(PROPERTY_S3_RETRY_MAX_ATTEMPTS,
+                                                                    DEFAULT_MAX_ATTEMPTS)),
+                              base_delay=float(project.get_property(PROPERTY_S3_RETRY_BASE_DELAY, DEFAULT_BASE_DELAY)),
+                              max_delay=float(project.get_property(PROPERTY_S3_RETRY_MAX_DELAY, DEFAULT_MAX_DELAY)))
+
+
+def log_transfer_statistics(logger, controller):
+    statistics = controller.statistics()
+    logger.info("S3 requests: {0}, retries: {1}, throttled: {2}, concurrency {3}..{4}, now {5}.".format(
+        statistics["requests"], statistics["retries"], statistics["throttled"], statistics["min_limit"],
+        statistics["max_limit"], statistics["limit"]))
+    return statistics
+
+
+def get_keyname_prefix(project):
+    """Versioned key prefix the emr-package is uploaded to"""
+    return "{0}v{1}/".format(project.get_property(PROPERTY_S3_BUCKET_PREFIX), project.version)
+
+
+def get_upload_settings(project):
+    """Validated S3 upload settings of the project"""
     acl = project.get_property(PROPERTY_S3_FILE_ACCESS_CONTROL)
     check_acl_parameter_validity(PROPERTY_S3_FILE_ACCESS_CONTROL, acl)
     server_side_encryption = project.get_property(PROPERTY_S3_SERVER_SIDE_ENCRYPTION)
     check_sse_parameter_validity(PROPERTY_S3_SERVER_SIDE_ENCRYPTION, server_side_encryption)
-    sse_kms_keyid = project.get_property(PROPERTY_S3_SERVER_SIDE_ENCRYPTION)
-    for item in os.listdir(get_emr_package_dir(project)):
-        filepath = os.path.join(emr_package_dir, item)
-        if os.path.isfile(filepath):
-            logger.debug("Found file to upload: {0}".format(item))
-            with open(filepath, "rb") as fp:
-                data = fp.read()
-            keyname_version = "{0}v{1}/{2}".format(bucket_prefix, project.version, item)
-            upload_helper(logger, bucket_name, keyname_version, data, acl, server_side_encryption, sse_kms_keyid)
-            logger.info("uploaded: {0} to {1}".format(item, keyname_version))
+    return {"bucket_name": project.get_mandatory_property(PROPERTY_S3_BUCKET_NAME),
+            "acl": acl,
+            "server_side_encryption": server_side_encryption,
+            "sse_kms_keyid": project.get_property(PROPERTY_S3_SSE_KMS_KEY_ID),
+            "part_size": int(project.get_property(PROPERTY_S3_UPLOAD_PART_SIZE, DEFAULT_PART_SIZE)),
+            "concurrency": int(project.get_property(PROPERTY_S3_UPLOAD_CONCURRENCY, DEFAULT_CONCURRENCY)),
+            "files_concurrency": int(project.get_property(PROPERTY_S3_UPLOAD_FILES_CONCURRENCY,
+                                                          DEFAULT_FILES_CONCURRENCY))}
+
+
+def start_stream_upload(project, logger, path_to_zipfile, controller=None):
+    """Upload everything written to the returned StreamBuffer to S3 in a background thread
+
+    The buffer holds at most one upload part, a slow upload blocks the archive writer. The local
+    copy is written to path_to_zipfile if enabled. Returns (stream, future), the future yields the
+    result of the upload like upload_files.
+    """
+    settings = get_upload_settings(project)
+    keyname = get_keyname_prefix(project) + os.path.basename(path_to_zipfile)
+    if os.path.lexists(path_to_zipfile):
+        os.remove(path_to_zipfile)
+    copy_to = None
+    if project.get_property(PROPERTY_PACKAGE_STREAM_KEEP_LOCAL, True):
+        copy_to = open(path_to_zipfile, "wb")
+    stream = StreamBuffer(settings["part_size"], copy_to=copy_to)
+
+    def upload():
+        started = time.time()
+        try:
+            upload_helper(logger, settings["bucket_name"], keyname, stream, settings["acl"],
+                          settings["server_side_encryption"], settings["sse_kms_keyid"],
+                          part_size=settings["part_size"], concurrency=settings["concurrency"],
+                          controller=controller)
+        except Exception as e:
+            # the archive writer fails with the upload error instead of blocking forever
+            stream.fail(e)
+            raise
+        return {"file": path_to_zipfile, "key": keyname, "size": stream.tell(), "seconds": time.time() - started,
+                "skipped": False, "error": None}
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(upload)
+    executor.shutdown(wait=False)
+    return stream, future
+
+
+def upload_files(project, logger, files, skip_unchanged=False, controller=None):
+    """Upload the (filepath, keyname) pairs in files concurrently with the S3 settings of the project"""
+    settings = get_upload_settings(project)
+    results = upload_files_helper(logger, settings["bucket_name"], files, settings["acl"],
+                                  settings["server_side_encryption"], settings["sse_kms_keyid"],
+                                  part_size=settings["part_size"], concurrency=settings["concurrency"],
+                                  files_concurrency=settings["files_concurrency"],
+                                  skip_unchanged=skip_unchanged, controller=controller)
+    for result in results:
+        if result["skipped"]:
+            logger.info("skipped unchanged: {0} at {1}".format(os.path.basename(result["file"]), result["key"]))
+        else:
+            logger.info("uploaded: {0} to {1}".format(os.path.basename(result["file"]), result["key"]))
+    return results
+
+
+def upload_package_dir(project, logger, keyname_prefix, controller=None, extra_files=()):
+    """Upload all files of the emr-package directory concurrently to keys below keyname_prefix
+
+    The files are taken from the file manifest of emr_package if it exists, extra_files are files
+    written into the emr-package directory afterwards. Files streamed to S3 by emr_package are skipped.
+    """
+    manifest = load_file_manifest(get_path_to_file_manifest(project))
+    _, entries = manifest.get("package", (None, None))
+    if entries is None:
+        entries = scan_package_dir(project)
+    streamed = set(entry.relpath for entry in manifest.get("streamed", (None, []))[1])
+    skip_unchanged = project.get_property(PROPERTY_S3_UPLOAD_SKIP_UNCHANGED, False)
+    removed = [entry.relpath for entry in manifest.get("scripts_removed", (None, []))[1]]
+    if skip_unchanged and removed:
+        # the versioned prefix mirrors the emr-package directory
+        keys = ["{0}{1}".format(keyname_prefix, relpath) for relpath in removed]
+        delete_objects_helper(logger, project.get_mandatory_property(PROPERTY_S3_BUCKET_NAME), keys,
+                              controller=controller)
+        for key in keys:
+            logger.info("deleted removed script: {0}".format(key))
+    files = []
+    for entry in entries:
+        if entry.relpath in streamed:
+            logger.debug("Already uploaded by emr_package: {0}".format(entry.relpath))
+            continue
+        logger.debug("Found file to upload: {0}".format(entry.relpath))
+        files.append((entry.path, "{0}{1}".format(keyname_prefix, entry.relpath)))
+    for filepath in extra_files:
+        if filepath not in [path for path, _ in files]:
+            files.append((filepath, "{0}{1}".format(keyname_prefix, os.path.basename(filepath))))
+    results = upload_files(project, logger, files, skip_unchanged=skip_unchanged, controller=controller)
+    if skip_unchanged:
+        logger.info("Uploaded {0} files, skipped {1} unchanged files.".format(
+            len([r for r in results if not r["skipped"]]), len([r for r in results if r["skipped"]])))
+    return results
+
+
+def get_dependency_layer_keyname(project, filename):
+    return "{0}{1}/{2}".format(project.get_property(PROPERTY_S3_BUCKET_PREFIX), DEPENDENCY_LAYER_PREFIX, filename)
+
+
+def upload_dependency_layers(project, logger, controller=None):
+    """Upload the dependency layers of a layered build which are not yet in S3
+
+    Layers are named by the hash of their content defining settings, an existing key is never
+    uploaded again. Returns the results like upload_files, existing layers as skipped.
+    """
+    layers_dir = get_dependency_layers_dir(project)
+    if not os.path.isdir(layers_dir):
+        return []
+    bucket_name = project.get_mandatory_property(PROPERTY_S3_BUCKET_NAME)
+    client = get_s3_client()
+    existing = []
+    missing = []
+    for item in sorted(os.listdir(layers_dir)):
+        filepath = os.path.join(layers_dir, item)
+        keyname = get_dependency_layer_keyname(project, item)
+        if object_exists(client, bucket_name, keyname, controller=controller):
+            logger.info("dependency layer exists: {0}".format(keyname))
+            existing.append({"file": filepath, "key": keyname, "size": os.path.getsize(filepath), "seconds": 0.0,
+                             "skipped": True, "error": None})
+        else:
+            missing.append((filepath, keyname))
+    return existing + upload_files(project, logger, missing, controller=controller)
+
+
+def write_layers_manifest(project, keyname_prefix):
+    """Write the manifest of a layered build listing the S3 urls of all archives to pass with --py-files"""
+    bucket_name = project.get_mandatory_property(PROPERTY_S3_BUCKET_NAME)
+    layers_dir = get_dependency_layers_dir(project)
+    layers = sorted(os.listdir(layers_dir)) if os.path.isdir(layers_dir) else []
+    dependencies = ["s3://{0}/{1}".format(bucket_name, get_dependency_layer_keyname(project, item)) for item in layers]
+    sources = "s3://{0}/{1}{2}".format(bucket_name, keyname_prefix, os.path.basename(get_path_to_zipfile(project)))
+    manifest = {"version": project.version,
+                "dependencies": dependencies,
+                "sources": sources,
+                "py_files": ",".join(dependencies + [sources])}
+    with open(get_path_to_layers_manifest(project), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+
+@task("emr_upload_to_s3", description="Upload a packaged lambda-zip to S3")
+@depends("emr_package")
+def emr_upload_to_s3(project, logger):
+    metrics = TaskMetrics("emr_upload_to_s3")
+    keyname_prefix = get_keyname_prefix(project)
+    controller = get_transfer_controller(project)
+    extra_files = []
+    if project.get_property(PROPERTY_PACKAGE_LAYERED, False):
+        with metrics.phase("upload-layers") as record:
+            record_transfers(metrics, record, upload_dependency_layers(project, logger, controller=controller))
+        manifest = write_layers_manifest(project, keyname_prefix)
+        logger.info("spark-submit --py-files {0}".format(manifest["py_files"]))
+        extra_files.append(get_path_to_layers_manifest(project))
+    with metrics.phase("upload") as record:
+        try:
+            results = upload_package_dir(project, logger, keyname_prefix, controller=controller,
+                                         extra_files=extra_files)
+        finally:
+            record["transfer"] = log_transfer_statistics(logger, controller)
+        record_transfers(metrics, record, results)
+    write_report(project, logger, metrics, project.get_property(PROPERTY_METRICS_HOOK))
 
 
 @task("emr_release", description="Copy emr zip file from versioned path to latest path in S3")
 def emr_release(project, logger):
-    emr_package_dir = get_emr_package_dir(project)
+    metrics = TaskMetrics("emr_release")
     bucket_prefix = project.get_property(PROPERTY_S3_BUCKET_PREFIX)
     bucket_name = project.get_mandatory_property(PROPERTY_S3_BUCKET_NAME)
     release_prefix = project.get_property(PROPERTY_S3_RELEASE_PREFIX, RELEASE_PREFIX_DEFAULT)
@@ -142,13 +1096,22 @@ def emr_release(project, logger):
     check_acl_parameter_validity(PROPERTY_S3_FILE_ACCESS_CONTROL, acl)
     server_side_encryption = project.get_property(PROPERTY_S3_SERVER_SIDE_ENCRYPTION)
     check_sse_parameter_validity(PROPERTY_S3_SERVER_SIDE_ENCRYPTION, server_side_encryption)
-    sse_kms_keyid = project.get_property(PROPERTY_S3_SERVER_SIDE_ENCRYPTION)
-    for item in os.listdir(get_emr_package_dir(project)):
-        filepath = os.path.join(emr_package_dir, item)
-        if os.path.isfile(filepath):
-            logger.debug("Found file to upload: {0}".format(item))
-            with open(filepath, "rb") as fp:
-                data = fp.read()
-            keyname_version = "{0}{1}/{2}".format(bucket_prefix, release_prefix, item)
-            upload_helper(logger, bucket_name, keyname_version, data, acl, server_side_encryption, sse_kms_keyid)
-            logger.info("uploaded: {0} to {1}".format(item, keyname_version))
+    sse_kms_keyid = project.get_property(PROPERTY_S3_SSE_KMS_KEY_ID)
+    part_size = int(project.get_property(PROPERTY_S3_UPLOAD_PART_SIZE, DEFAULT_PART_SIZE))
+    concurrency = int(project.get_property(PROPERTY_S3_UPLOAD_CONCURRENCY, DEFAULT_CONCURRENCY))
+    files_concurrency = int(project.get_property(PROPERTY_S3_UPLOAD_FILES_CONCURRENCY, DEFAULT_FILES_CONCURRENCY))
+    source_prefix = "{0}v{1}/".format(bucket_prefix, project.version)
+    destination_prefix = "{0}{1}/".format(bucket_prefix, release_prefix)
+    controller = get_transfer_controller(project)
+    with metrics.phase("copy") as record:
+        try:
+            results = copy_prefix_helper(logger, bucket_name, source_prefix, destination_prefix, acl,
+                                         server_side_encryption, sse_kms_keyid, part_size=part_size,
+                                         concurrency=concurrency, files_concurrency=files_concurrency,
+                                         controller=controller)
+        finally:
+            record["transfer"] = log_transfer_statistics(logger, controller)
+        record_transfers(metrics, record, results)
+    for result in results:
+        logger.info("copied: {0} to {1}".format(result["source"], result["key"]))
+    write_report(project, logger, metrics, project.get_property(PROPERTY_METRICS_HOOK))
@@ -1,9 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import boto3
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from pybuilder.errors import BuildFailedException
 
+from .transfer import TransferController
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_DELETE_KEYS = 1000
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+DEFAULT_FILES_CONCURRENCY = 4
+CHECKSUM_METADATA_KEY = "sha256"
+
+# boto3 is imported on first use, importing it takes longer than most pyb tasks which do not need it
+_session = None
+_s3_client = None
+_s3_client_pool_size = 0
+_s3_client_lock = threading.Lock()
+
 permissible_acl_values = [
     "private",
     "public-read",
@@ -15,25 +38,321 @@ permissible_acl_values = [
 permissible_sse_values = ["aws:kms", "AES256"]
 
 
-def upload_helper(logger, bucket_name, keyname, data, acl, server_side_encryption=None, sse_kms_keyid=None):
-    s3 = boto3.resource("s3")
-    logger.info("Uploading to bucket '{0}' key {1}".format(bucket_name, keyname))
-    kwargs = {"Key": keyname,
-              "Body": data,
-              "ACL": acl
-              }
+def get_session():
+    """Return the boto3 session shared by all tasks of the build"""
+    global _session
+    with _s3_client_lock:
+        if _session is None:
+            import boto3.session
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_s3_client(max_pool_connections=None):
+    """Return the shared S3 client, it is only replaced if a larger connection pool is requested
+
+    botocore does not retry any request of the client, retries and backoff are left to the TransferController.
+    """
+    global _s3_client, _s3_client_pool_size
+    session = get_session()
+    with _s3_client_lock:
+        if _s3_client is None or (max_pool_connections or 0) > _s3_client_pool_size:
+            from botocore.config import Config
+            pool_size = max(max_pool_connections or 0, _s3_client_pool_size)
+            config = Config(retries={"max_attempts": 0})
+            if pool_size:
+                config = config.merge(Config(max_pool_connections=pool_size))
+            _s3_client = session.client("s3", config=config)
+            _s3_client_pool_size = pool_size
+        return _s3_client
+
+
+def _get_upload_kwargs(acl, server_side_encryption=None, sse_kms_keyid=None, metadata=None):
+    kwargs = {"ACL": acl}
+    if metadata:
+        kwargs.update({"Metadata": metadata})
     if server_side_encryption:
         kwargs.update({"ServerSideEncryption": server_side_encryption})
     if sse_kms_keyid:
         kwargs.update({"SSEKMSKeyId": sse_kms_keyid})
-    logger.debug("using put_object kwargs: {}".format(kwargs))
-    s3.Bucket(bucket_name).put_object(**kwargs)
+    return kwargs
+
+
+def _read_part(fileobj, part_size):
+    """Read exactly part_size bytes unless the end of fileobj is reached"""
+    chunks = []
+    remaining = part_size
+    while remaining > 0:
+        chunk = fileobj.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def _get_file_size(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _get_part_size(part_size, size=None):
+    """Part size actually used for an object of size bytes"""
+    part_size = max(part_size, MIN_PART_SIZE)
+    if size is not None:
+        part_size = max(part_size, -(-size // MAX_PARTS))
+    return part_size
+
+
+def compute_checksums(filepath, part_size=DEFAULT_PART_SIZE):
+    """Return (ETag, sha256) of filepath, the ETag as S3 computes it for an upload with multipart_upload"""
+    size = os.path.getsize(filepath)
+    part_size = _get_part_size(part_size, size)
+    sha256 = hashlib.sha256()
+    part_digests = [hashlib.md5()]
+    with open(filepath, "rb") as fp:
+        for part in iter(lambda: _read_part(fp, part_size), b""):
+            sha256.update(part)
+            part_digests[-1].update(part)
+            part_digests.append(hashlib.md5())
+    if size < part_size:
+        # uploaded with a single put_object
+        etag = part_digests[0].hexdigest()
+    else:
+        etag = "{0}-{1}".format(hashlib.md5(b"".join(d.digest() for d in part_digests[:-1])).hexdigest(),
+                                len(part_digests) - 1)
+    return '"{0}"'.format(etag), sha256.hexdigest()
+
+
+def list_objects_helper(client, bucket_name, prefix, controller=None):
+    """Return {key: {"ETag": ..., "Size": ...}} for all objects below prefix with a single listing
+
+    Every page is requested by the TransferController controller, which retries throttled requests.
+    """
+    controller = controller or TransferController(1)
+    objects = {}
+    kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+    while True:
+        page = controller.call(client.list_objects_v2, **kwargs)
+        for item in page.get("Contents", []):
+            objects[item["Key"]] = {"ETag": item["ETag"], "Size": item["Size"]}
+        if not page.get("IsTruncated"):
+            return objects
+        kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+def object_exists(client, bucket_name, keyname, controller=None):
+    from botocore.exceptions import ClientError
+    controller = controller or TransferController(1)
+    try:
+        controller.call(client.head_object, Bucket=bucket_name, Key=keyname)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def delete_objects_helper(logger, bucket_name, keys, controller=None):
+    """Delete keys from bucket_name with one request per 1000 keys"""
+    client = get_s3_client()
+    controller = controller or TransferController(1)
+    for start in range(0, len(keys), MAX_DELETE_KEYS):
+        batch = keys[start:start + MAX_DELETE_KEYS]
+        logger.debug("Deleting {0} objects from bucket '{1}'".format(len(batch), bucket_name))
+        response = controller.call(client.delete_objects, Bucket=bucket_name,
+                                   Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+        errors = response.get("Errors", [])
+        if errors:
+            raise BuildFailedException("Failed to delete {0} objects: {1}".format(
+                len(errors), ", ".join("{0} ({1})".format(e.get("Key"), e.get("Code")) for e in errors)))
+
 
+def is_unchanged(client, bucket_name, keyname, existing, size, etag, sha256, controller=None):
+    """Check if the existing object (from list_objects_helper) has the given content"""
+    if existing is None or existing["Size"] != size:
+        return False
+    if existing["ETag"] == etag:
+        return True
+    # ETags of SSE-KMS objects or of objects uploaded with another part size are no md5 sums
+    controller = controller or TransferController(1)
+    metadata = controller.call(client.head_object, Bucket=bucket_name, Key=keyname).get("Metadata", {})
+    return metadata.get(CHECKSUM_METADATA_KEY) == sha256
 
-def copy_helper(logger, bucket_name, source_key, destination_key, acl, server_side_encryption=None, sse_kms_keyid=None):
+
+def multipart_upload(logger, client, bucket_name, keyname, fileobj, extra_args,
+                     part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, controller=None):
+    """Upload fileobj in parts of part_size bytes with at most concurrency parts in memory/in flight
+
+    Objects smaller than one part are uploaded with a single put_object. All requests are run
+    by the TransferController controller, which retries throttled requests.
+    """
+    controller = controller or TransferController(concurrency)
+    part_size = _get_part_size(part_size, _get_file_size(fileobj))
+    data = _read_part(fileobj, part_size)
+    if len(data) < part_size:
+        logger.debug("using put_object kwargs: {}".format(extra_args))
+        controller.call(client.put_object, Bucket=bucket_name, Key=keyname, Body=data, **extra_args)
+        return
+
+    logger.debug("using create_multipart_upload kwargs: {}".format(extra_args))
+    upload_id = controller.call(client.create_multipart_upload, Bucket=bucket_name, Key=keyname,
+                                **extra_args)["UploadId"]
+    slots = threading.BoundedSemaphore(concurrency)
+    failed = threading.Event()
+
+    def upload_part(part_number, body):
+        try:
+            response = controller.call(client.upload_part, Bucket=bucket_name, Key=keyname, UploadId=upload_id,
+                                       PartNumber=part_number, Body=body)
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            slots.release()
+
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            part_number = 0
+            while True:
+                # blocks while concurrency parts are in flight, the next part is only read once a slot is free
+                slots.acquire()
+                if part_number and not failed.is_set():
+                    data = _read_part(fileobj, part_size)
+                if failed.is_set() or not data:
+                    slots.release()
+                    break
+                part_number += 1
+                futures.append(executor.submit(upload_part, part_number, data))
+                data = None
+        parts = [future.result() for future in futures]
+        logger.debug("Uploaded {0} parts of {1} to {2}".format(len(parts), keyname, bucket_name))
+        controller.call(client.complete_multipart_upload, Bucket=bucket_name, Key=keyname, UploadId=upload_id,
+                        MultipartUpload={"Parts": parts})
+    except Exception:
+        controller.call(client.abort_multipart_upload, Bucket=bucket_name, Key=keyname, UploadId=upload_id)
+        raise
+
+
+def upload_helper(logger, bucket_name, keyname, data, acl, server_side_encryption=None, sse_kms_keyid=None,
+                  part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, client=None, metadata=None,
+                  controller=None):
+    """Upload data (bytes or a binary file object, which is streamed in parts) to bucket_name/keyname"""
+    logger.info("Uploading to bucket '{0}' key {1}".format(bucket_name, keyname))
+    kwargs = _get_upload_kwargs(acl, server_side_encryption, sse_kms_keyid, metadata)
+    if not hasattr(data, "read"):
+        data = io.BytesIO(data)
+    multipart_upload(logger, client or get_s3_client(), bucket_name, keyname, data, kwargs,
+                     part_size=part_size, concurrency=concurrency, controller=controller)
+
+
+def _run_per_file(function, items, concurrency, action):
+    """Call function(*item) for all items in a thread pool, fail after all calls if some failed"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda item: function(*item), items))
+    failed = [result for result in results if result["error"] is not None]
+    if failed:
+        raise BuildFailedException("Failed to {0} {1} of {2} files: {3}".format(
+            action, len(failed), len(results),
+            ", ".join("{0} ({1})".format(result["key"], result["error"]) for result in failed)))
+    return results
+
+
+def upload_files_helper(logger, bucket_name, files, acl, server_side_encryption=None, sse_kms_keyid=None,
+                        part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                        files_concurrency=DEFAULT_FILES_CONCURRENCY, skip_unchanged=False, controller=None):
+    """Upload the (filepath, keyname) pairs in files concurrently over one pooled client
+
+    Returns one result dict per file with the keys file, key, size, seconds, skipped and error. With
+    skip_unchanged, files whose content equals the existing object are not uploaded again.
+    Raises a BuildFailedException listing all failed files after every upload has finished.
+    All requests share the TransferController controller, which limits the requests in flight.
+    """
+    client = get_s3_client(max_pool_connections=files_concurrency * concurrency)
+    controller = controller or TransferController(files_concurrency * concurrency)
+    existing_objects = {}
+    if skip_unchanged and files:
+        prefix = os.path.commonprefix([keyname for _, keyname in files])
+        existing_objects = list_objects_helper(client, bucket_name, prefix[:prefix.rfind("/") + 1],
+                                               controller=controller)
+
+    def upload(filepath, keyname):
+        result = {"file": filepath, "key": keyname, "size": os.path.getsize(filepath), "skipped": False,
+                  "error": None}
+        started = time.time()
+        try:
+            metadata = None
+            if skip_unchanged:
+                etag, sha256 = compute_checksums(filepath, part_size)
+                if is_unchanged(client, bucket_name, keyname, existing_objects.get(keyname), result["size"],
+                                etag, sha256, controller=controller):
+                    logger.debug("Skipping unchanged {0}".format(keyname))
+                    result["skipped"] = True
+                    return result
+                metadata = {CHECKSUM_METADATA_KEY: sha256}
+            with open(filepath, "rb") as fp:
+                upload_helper(logger, bucket_name, keyname, fp, acl, server_side_encryption, sse_kms_keyid,
+                              part_size=part_size, concurrency=concurrency, client=client, metadata=metadata,
+                              controller=controller)
+        except Exception as e:
+            logger.error("Failed to upload {0} to {1}: {2}".format(filepath, keyname, e))
+            result["error"] = e
+        finally:
+            result["seconds"] = time.time() - started
+        return result
+
+    return _run_per_file(upload, files, files_concurrency, "upload")
+
+
+def multipart_copy(logger, client, bucket_name, source_key, destination_key, size, extra_args,
+                   part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, controller=None):
+    """Server side copy of objects larger than the copy_object limit with upload_part_copy"""
+    controller = controller or TransferController(concurrency)
+    part_size = _get_part_size(part_size, size)
+    source = controller.call(client.head_object, Bucket=bucket_name, Key=source_key)
+    extra_args = dict(extra_args, Metadata=source.get("Metadata", {}))
+    if source.get("ContentType"):
+        extra_args["ContentType"] = source["ContentType"]
+    logger.debug("using create_multipart_upload kwargs: {}".format(extra_args))
+    upload_id = controller.call(client.create_multipart_upload, Bucket=bucket_name, Key=destination_key,
+                                **extra_args)["UploadId"]
+
+    def copy_part(part_number):
+        first_byte = (part_number - 1) * part_size
+        last_byte = min(first_byte + part_size, size) - 1
+        response = controller.call(client.upload_part_copy, Bucket=bucket_name, Key=destination_key,
+                                   UploadId=upload_id, PartNumber=part_number,
+                                   CopySource={"Bucket": bucket_name, "Key": source_key},
+                                   CopySourceRange="bytes={0}-{1}".format(first_byte, last_byte))
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            parts = list(executor.map(copy_part, range(1, -(-size // part_size) + 1)))
+        controller.call(client.complete_multipart_upload, Bucket=bucket_name, Key=destination_key,
+                        UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except Exception:
+        controller.call(client.abort_multipart_upload, Bucket=bucket_name, Key=destination_key,
+                        UploadId=upload_id)
+        raise
+
+
+def copy_helper(logger, bucket_name, source_key, destination_key, acl, server_side_encryption=None, sse_kms_keyid=None,
+                size=None, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, client=None,
+                multipart_threshold=MAX_COPY_SIZE, controller=None):
     """Copy S3 source_key to destination_key in bucket_name applying acl"""
     logger.info('Copying in {0} from {1} to {2}'.format(bucket_name, source_key, destination_key))
-    client = boto3.client("s3")
+    client = client or get_s3_client()
+    controller = controller or TransferController(concurrency)
+    if size is not None and size > multipart_threshold:
+        kwargs = _get_upload_kwargs(acl, server_side_encryption, sse_kms_keyid)
+        multipart_copy(logger, client, bucket_name, source_key, destination_key, size, kwargs,
+                       part_size=part_size, concurrency=concurrency, controller=controller)
+        return
     kwargs = {"ACL": acl,
               "Bucket": bucket_name,
               "CopySource": {"Bucket": bucket_name, "Key": source_key},
@@ -45,7 +364,39 @@ def copy_helper(logger, bucket_name, source_key, destination_key, acl, server_si
     if sse_kms_keyid:
         kwargs.update({"SSEKMSKeyId": sse_kms_keyid})
     logger.debug("using copy_object kwargs: {}".format(kwargs))
-    client.copy_object(**kwargs)
+    controller.call(client.copy_object, **kwargs)
+
+
+def copy_prefix_helper(logger, bucket_name, source_prefix, destination_prefix, acl, server_side_encryption=None,
+                       sse_kms_keyid=None, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                       files_concurrency=DEFAULT_FILES_CONCURRENCY, controller=None):
+    """Server side copy of all objects below source_prefix to destination_prefix
+
+    Returns one result dict per object with the keys source, key, size, seconds and error.
+    """
+    client = get_s3_client(max_pool_connections=files_concurrency * concurrency)
+    controller = controller or TransferController(files_concurrency * concurrency)
+    objects = list_objects_helper(client, bucket_name, source_prefix, controller=controller)
+    if not objects:
+        raise BuildFailedException("No objects found in bucket '{0}' below {1}".format(bucket_name, source_prefix))
+
+    def copy(source_key, size):
+        destination_key = destination_prefix + source_key[len(source_prefix):]
+        result = {"source": source_key, "key": destination_key, "size": size, "error": None}
+        started = time.time()
+        try:
+            copy_helper(logger, bucket_name, source_key, destination_key, acl, server_side_encryption,
+                        sse_kms_keyid, size=size, part_size=part_size, concurrency=concurrency, client=client,
+                        controller=controller)
+        except Exception as e:
+            logger.error("Failed to copy {0} to {1}: {2}".format(source_key, destination_key, e))
+            result["error"] = e
+        finally:
+            result["seconds"] = time.time() - started
+        return result
+
+    items = [(key, objects[key]["Size"]) for key in sorted(objects)]
+    return _run_per_file(copy, items, files_concurrency, "copy")
 
 
 def check_acl_parameter_validity(property_, acl_value):
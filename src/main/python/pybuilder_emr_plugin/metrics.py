@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from pybuilder.errors import BuildFailedException
+
+REPORT_FILE = "emr_plugin_metrics.json"
+_MB = 1024.0 * 1024.0
+
+
+def _add_rates(record):
+    transferred = max(record.get("bytes_in", 0), record.get("bytes_out", 0))
+    if record["seconds"] > 0 and transferred:
+        record["mb_per_second"] = transferred / _MB / record["seconds"]
+
+
+class TaskMetrics(object):
+    """Wall time, bytes in/out and file counts of the phases and objects of one plugin task"""
+
+    def __init__(self, task_name):
+        self.task = task_name
+        self.phases = []
+        self.objects = []
+        self._started = time.time()
+        self.seconds = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block, the yielded record can be filled with files, bytes_in and bytes_out"""
+        record = {"name": name, "files": 0, "bytes_in": 0, "bytes_out": 0}
+        started = time.time()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.time() - started
+            _add_rates(record)
+            self.phases.append(record)
+
+    def add_phase(self, name, seconds, files=0, bytes_in=0, bytes_out=0):
+        """Add a phase timed elsewhere, e.g. in a worker process"""
+        record = {"name": name, "files": files, "bytes_in": bytes_in, "bytes_out": bytes_out, "seconds": seconds}
+        _add_rates(record)
+        self.phases.append(record)
+
+    def add_object(self, key, size, seconds, skipped=False):
+        record = {"key": key, "size": size, "seconds": seconds, "skipped": skipped}
+        if not skipped and seconds > 0:
+            record["mb_per_second"] = size / _MB / seconds
+        self.objects.append(record)
+
+    def finish(self):
+        self.seconds = time.time() - self._started
+
+    def to_dict(self):
+        return {"seconds": self.seconds, "phases": self.phases, "objects": self.objects}
+
+    def summary(self):
+        phases = []
+        for record in self.phases:
+            details = ["{0:.2f}s".format(record["seconds"])]
+            if "compression_ratio" in record:
+                details.append("ratio {0:.1%}".format(record["compression_ratio"]))
+            if "mb_per_second" in record:
+                details.append("{0:.1f} MB/s".format(record["mb_per_second"]))
+            phases.append("{0} {1}".format(record["name"], ", ".join(details)))
+        return "{0} took {1:.2f}s: {2}".format(self.task, self.seconds or 0.0, "; ".join(phases))
+
+
+def get_report_path(project):
+    return os.path.join(project.expand_path("$dir_target"), "reports", REPORT_FILE)
+
+
+def write_report(project, logger, metrics, hook=None):
+    """Add the metrics of a finished task to the JSON report under $dir_target and call hook(task, metrics)
+
+    The report keeps the metrics of the last run of every task, e.g. of emr_package and emr_upload_to_s3.
+    Errors of the hook are logged, they do not fail the build.
+    """
+    if hook is not None and not callable(hook):
+        raise BuildFailedException("Metrics hook {0!r} is not callable".format(hook))
+    metrics.finish()
+    path = get_report_path(project)
+    report = {"tasks": {}}
+    try:
+        with open(path) as report_file:
+            report = json.load(report_file)
+    except (IOError, OSError, ValueError):
+        pass
+    report.setdefault("tasks", {})[metrics.task] = metrics.to_dict()
+    report["project"] = project.name
+    report["version"] = project.version
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    logger.info(metrics.summary())
+    if hook is not None:
+        try:
+            hook(metrics.task, metrics.to_dict())
+        except Exception as e:
+            logger.warn("Metrics hook failed: {0}".format(e))
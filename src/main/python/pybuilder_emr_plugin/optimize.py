@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from pybuilder.errors import BuildFailedException
+
+from .patterns import PathMatcher
+
+# files and directories of installed dependencies which are not needed at runtime. directories like tests
+# or docs are not pruned by default, packages may import them (e.g. botocore.docs)
+DEFAULT_PRUNE_PATTERNS = ["__pycache__",
+                          "*.pyc",
+                          "*.pyo",
+                          "/*.dist-info/RECORD",
+                          "/*.dist-info/INSTALLER",
+                          "/*.dist-info/REQUESTED",
+                          "/*.dist-info/direct_url.json"]
+
+# executed by the target interpreter, compiles all modules below argv[1] to legacy .pyc files below argv[2].
+# zipimport only finds .pyc files next to the module, not in __pycache__. unchecked hash based pycs are
+# independent of the timestamps in the zip file.
+_COMPILE_SCRIPT = """
+import os, py_compile, sys
+source, target = sys.argv[1], sys.argv[2]
+for root, dirs, files in os.walk(source):
+    dirs.sort()
+    for name in sorted(files):
+        if not name.endswith(".py"):
+            continue
+        relative = os.path.relpath(os.path.join(root, name), source)
+        try:
+            py_compile.compile(os.path.join(root, name), cfile=os.path.join(target, relative + "c"),
+                               dfile=relative, doraise=True,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        except py_compile.PyCompileError:
+            sys.stdout.write(relative + "\\n")
+"""
+
+# executed by the target interpreter, imports the modules argv[2:] from the zip files in argv[1] (separated
+# by os.pathsep) and prints the seconds to read the central directories and to import as JSON
+_IMPORT_SCRIPT = """
+import json, os, sys, time, zipimport
+paths, modules = sys.argv[1].split(os.pathsep), sys.argv[2:]
+started = time.perf_counter()
+for path in paths:
+    zipimport.zipimporter(path)
+opened = time.perf_counter() - started
+sys.path[0:0] = paths
+failed = []
+started = time.perf_counter()
+for name in modules:
+    try:
+        __import__(name)
+    except Exception:
+        failed.append(name)
+imported = time.perf_counter() - started
+sys.stdout.write(json.dumps({"open_seconds": opened, "import_seconds": imported, "failed": failed}))
+"""
+
+
+def prune_tree(logger, directory, patterns):
+    """Delete all files and directories below directory matching one of the glob patterns
+
+    Patterns are matched like the excludes of a PathMatcher against the path relative to
+    directory. Returns the number of deleted files and directories.
+    """
+    matcher = PathMatcher(excludes=patterns)
+    pruned = 0
+    for root, dirs, files in os.walk(directory):
+        relative_root = os.path.relpath(root, directory).replace(os.sep, "/")
+        relative_root = "" if relative_root == "." else relative_root + "/"
+        for name in list(dirs):
+            if matcher.excludes_dir(relative_root + name):
+                logger.debug("Pruning directory {0}{1}".format(relative_root, name))
+                shutil.rmtree(os.path.join(root, name))
+                dirs.remove(name)
+                pruned += 1
+        for name in files:
+            if not matcher.includes_file(relative_root + name):
+                logger.debug("Pruning file {0}{1}".format(relative_root, name))
+                os.remove(os.path.join(root, name))
+                pruned += 1
+    return pruned
+
+
+def compile_tree(logger, source_directory, target_directory, python=None):
+    """Compile all modules below source_directory with python to .pyc files below target_directory
+
+    Returns the relative paths of all modules which could not be compiled, e.g. because they
+    are written for another python version.
+    """
+    cmd = [python or sys.executable, "-c", _COMPILE_SCRIPT, source_directory, target_directory]
+    logger.debug("Compiling {0} to {1} with {2}".format(source_directory, target_directory, cmd[0]))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise BuildFailedException("Failed to compile {0} with {1}: {2}".format(source_directory, cmd[0], stderr))
+    failed = [line for line in stdout.splitlines() if line]
+    for relative in failed:
+        logger.debug("Could not compile {0}, keeping the source only".format(relative))
+    return failed
+
+
+def top_level_modules(names):
+    """Names of the importable top level packages and modules in a list of relative paths (posix)"""
+    modules = set()
+    for name in names:
+        parts = name.split("/")
+        if len(parts) == 1 and parts[0].endswith((".py", ".pyc")) and not parts[0].startswith("__init__."):
+            modules.add(parts[0].rsplit(".", 1)[0])
+        elif len(parts) == 2 and parts[1] in ("__init__.py", "__init__.pyc") and "." not in parts[0] \
+                and "-" not in parts[0]:
+            modules.add(parts[0])
+    return sorted(modules)
+
+
+def profile_zip_imports(logger, filenames, modules, python=None, repeat=3):
+    """Import modules from the zip files filenames (like --py-files) in a fresh interpreter
+
+    Runs repeat times and returns the best times to open the archives (read the central directories)
+    and to import the modules in seconds, as well as the modules which could not be imported.
+    """
+    cmd = [python or sys.executable, "-I", "-c", _IMPORT_SCRIPT, os.pathsep.join(filenames)] + list(modules)
+    best = None
+    for _ in range(max(1, repeat)):
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise BuildFailedException("Failed to profile the imports from {0} with {1}: {2}".format(
+                ", ".join(filenames), cmd[0], stderr))
+        result = json.loads(stdout)
+        if best is None:
+            best = result
+        else:
+            best["open_seconds"] = min(best["open_seconds"], result["open_seconds"])
+            best["import_seconds"] = min(best["import_seconds"], result["import_seconds"])
+    for name in best["failed"]:
+        logger.debug("Could not import {0} from {1}".format(name, ", ".join(filenames)))
+    best["modules"] = len(modules)
+    return best
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import fnmatch
+import os
+import re
+
+_REQUIREMENT_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+_TOP_LEVEL_NAME = re.compile(r"[A-Za-z0-9_]+")
+
+
+def _translate_segment(segment):
+    """Regex for one path segment of a glob, '*' and '?' do not match '/'"""
+    result = []
+    index = 0
+    while index < len(segment):
+        char = segment[index]
+        if char == "*":
+            result.append("[^/]*")
+        elif char == "?":
+            result.append("[^/]")
+        elif char == "[":
+            end = segment.find("]", index + 2)
+            if end == -1:
+                result.append(re.escape(char))
+            else:
+                content = segment[index + 1:end]
+                if content.startswith("!"):
+                    content = "^" + content[1:]
+                result.append("[" + content.replace("\\", "\\\\") + "]")
+                index = end
+        else:
+            result.append(re.escape(char))
+        index += 1
+    return "".join(result)
+
+
+def glob_to_regex(pattern):
+    """Regex for a glob matched against relative posix paths
+
+    '**' matches any number of directories, '*' and '?' stay within one directory level.
+    Patterns without a '/' match the name of a file or directory at any level, a leading '/'
+    anchors a pattern at the top level.
+    """
+    anchored = pattern.startswith("/")
+    pattern = pattern.strip("/")
+    if "/" not in pattern and not anchored:
+        pattern = "**/" + pattern
+    segments = pattern.split("/")
+    result = []
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == "**":
+            result.append(".*" if last else "(?:[^/]+/)*")
+        else:
+            result.append(_translate_segment(segment) + ("" if last else "/"))
+    return "".join(result)
+
+
+def escape_glob(name):
+    return re.sub(r"([*?[])", r"[\1]", name)
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    return re.compile("(?:{0})\\Z".format("|".join("(?:{0})".format(glob_to_regex(p)) for p in patterns)))
+
+
+class PathMatcher(object):
+    """Include/exclude glob patterns compiled once into a single regex each
+
+    Excluded directories are pruned completely. If includes are given, only files matching
+    one of them are included.
+    """
+
+    def __init__(self, includes=None, excludes=None):
+        self.includes = list(includes or [])
+        self.excludes = list(excludes or [])
+        self._includes = _compile(self.includes)
+        self._excludes = _compile(self.excludes)
+        # a directory is pruned if the exclude matches the directory itself or everything below it
+        self._excluded_dirs = _compile([p[:-3] if p.endswith("/**") else p for p in self.excludes])
+
+    def excludes_dir(self, path):
+        return bool(self._excluded_dirs and self._excluded_dirs.match(path))
+
+    def includes_file(self, path):
+        if self._excludes and self._excludes.match(path):
+            return False
+        return not self._includes or bool(self._includes.match(path))
+
+
+class BytecodeMatcher(object):
+    """Matcher for a tree of compiled modules, includes a .pyc file if its module is included by matcher"""
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+
+    def excludes_dir(self, path):
+        return self.matcher.excludes_dir(path)
+
+    def includes_file(self, path):
+        return path.endswith(".pyc") and self.matcher.includes_file(path[:-1])
+
+
+def normalize_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def requirement_name(requirement):
+    """Normalized project name of a requirement string like 'Foo_Bar>=1.0'"""
+    match = _REQUIREMENT_NAME.match(requirement.strip())
+    return normalize_name(match.group(0) if match else requirement)
+
+
+def is_excluded_requirement(requirement, patterns):
+    """True if the project name of requirement matches one of the glob patterns"""
+    if not patterns:
+        return False
+    name = requirement_name(requirement)
+    return requirement in patterns or any(fnmatch.fnmatchcase(name, normalize_name(p)) for p in patterns)
+
+
+def _entry_name(entry):
+    match = _TOP_LEVEL_NAME.match(entry)
+    return normalize_name(match.group(0) if match else entry)
+
+
+def distribution_files(directory, dist_info, entries):
+    """Relative posix paths of the files of the distribution installed to directory with the dist_info directory
+
+    Read from its RECORD, paths outside of directory (e.g. ../../bin/script) are skipped. Without a RECORD
+    (pruned or not written) the top level entries named in top_level.txt are used.
+    """
+    record = os.path.join(directory, dist_info, "RECORD")
+    if os.path.isfile(record):
+        with open(record, newline="") as fp:
+            paths = [row[0].replace("\\", "/") for row in csv.reader(fp) if row and row[0]]
+        return [path for path in paths if not path.startswith(("../", "/"))]
+    top_level = os.path.join(directory, dist_info, "top_level.txt")
+    names = [dist_info]
+    if os.path.isfile(top_level):
+        with open(top_level) as fp:
+            names.extend(line.strip().replace("\\", "/") for line in fp if line.strip())
+    return [entry for entry in entries for name in names if entry == name or entry.startswith(name + ".")]
+
+
+def excluded_distributions(directory, patterns):
+    """Anchored exclude globs for all files of an installed dependency tree which belong to a
+    distribution matching one of the requirement patterns
+
+    For the pattern 'numpy' these are e.g. 'numpy', 'numpy.libs' and 'numpy-1.0.dist-info'. The files of
+    distributions with another import name (e.g. 'yaml' of 'pyyaml') are taken from their RECORD.
+    Top level directories shared with other distributions (e.g. 'bin') are only excluded file by file.
+    """
+    normalized = [normalize_name(p) for p in patterns or []]
+    if not normalized or not os.path.isdir(directory):
+        return []
+    entries = sorted(os.listdir(directory))
+    excludes = set()
+    excluded = set()
+    files = {}
+    owners = {}
+    for entry in entries:
+        is_excluded = any(fnmatch.fnmatchcase(_entry_name(entry), pattern) for pattern in normalized)
+        if is_excluded:
+            excludes.add("/" + escape_glob(entry))
+        if entry.endswith(".dist-info"):
+            files[entry] = distribution_files(directory, entry, entries)
+            for path in files[entry]:
+                owners.setdefault(path.split("/")[0], set()).add(entry)
+            if is_excluded:
+                excluded.add(entry)
+    for dist_info in sorted(excluded):
+        for path in files[dist_info]:
+            top_level = path.split("/")[0]
+            if owners[top_level] <= excluded:
+                excludes.add("/" + escape_glob(top_level))
+            else:
+                excludes.add("/" + escape_glob(path))
+    return sorted(excludes)
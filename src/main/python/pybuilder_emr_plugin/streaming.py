@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import io
+import threading
+import time
+
+
+class StreamBuffer(object):
+    """Bounded pipe from a writer (the archive) to a reader (the multipart upload) in another thread
+
+    write() blocks while max_size bytes are buffered, so compression can not run ahead of the upload by
+    more than max_size bytes. Written bytes are hashed and also written to copy_to (an open binary file,
+    closed with the stream) if given. The stream is not seekable, a ZipFile writes it sequentially.
+    """
+
+    def __init__(self, max_size, copy_to=None):
+        self.max_size = max(1, max_size)
+        self.blocked_seconds = 0.0
+        self._copy_to = copy_to
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._position = 0
+        self._closed = False
+        self._error = None
+        self._sha256 = hashlib.sha256()
+        self._condition = threading.Condition()
+
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        if self._copy_to is not None:
+            self._copy_to.flush()
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        if self._copy_to is not None:
+            self._copy_to.write(data)
+        self._sha256.update(data)
+        # large entries are split, a single write never exceeds the buffer
+        for start in range(0, len(data), self.max_size):
+            chunk = bytes(data[start:start + self.max_size])
+            with self._condition:
+                started = time.time()
+                while self._buffered + len(chunk) > self.max_size and self._buffered and self._error is None:
+                    self._condition.wait()
+                self.blocked_seconds += time.time() - started
+                if self._error is not None:
+                    raise self._error
+                self._chunks.append(chunk)
+                self._buffered += len(chunk)
+                self._condition.notify_all()
+        self._position += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        """Read up to size bytes, blocks until data is written or the stream is closed"""
+        with self._condition:
+            while not self._chunks and not self._closed and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+            parts = []
+            remaining = size if size is not None and size >= 0 else self._buffered
+            while self._chunks and remaining > 0:
+                chunk = self._chunks.popleft()
+                if len(chunk) > remaining:
+                    self._chunks.appendleft(chunk[remaining:])
+                    chunk = chunk[:remaining]
+                parts.append(chunk)
+                remaining -= len(chunk)
+                self._buffered -= len(chunk)
+            self._condition.notify_all()
+            return b"".join(parts)
+
+    def close(self):
+        """Signal the end of the data to the reader"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._copy_to is not None:
+            self._copy_to.close()
+            self._copy_to = None
+
+    def fail(self, error):
+        """Abort the transfer, the next write() or read() raises error"""
+        with self._condition:
+            if self._error is None:
+                self._error = error
+            self._condition.notify_all()
+
+    @property
+    def sha256(self):
+        """sha256 of all bytes written so far"""
+        return self._sha256.hexdigest()
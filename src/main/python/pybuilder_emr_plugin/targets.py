@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import re
+
+# a build target, python is the interpreter used to compile bytecode for it
+Target = collections.namedtuple("Target", ["name", "python_version", "platform", "python"])
+
+_TARGET_TAG = re.compile(r"^(?P<python_version>[0-9]+\.[0-9]+)(?:-(?P<platform>[A-Za-z0-9_.]+))?$")
+
+
+def parse_targets(tags, pythons=None):
+    """Targets of tags like '3.7' or '3.9-manylinux2014_x86_64' (python version and pip platform tag)
+
+    pythons maps a tag to the interpreter compiling the bytecode of the target. Raises ValueError for
+    malformed or duplicate tags.
+    """
+    pythons = pythons or {}
+    targets = []
+    for tag in tags or []:
+        match = _TARGET_TAG.match(tag)
+        if not match:
+            raise ValueError("Invalid target '{0}', expected <python version>[-<platform>]".format(tag))
+        if tag in [target.name for target in targets]:
+            raise ValueError("Duplicate target '{0}'".format(tag))
+        targets.append(Target(tag, match.group("python_version"), match.group("platform"), pythons.get(tag, "")))
+    return targets
+
+
+def pip_target_options(target):
+    """pip install options selecting the binary distributions for target instead of the build interpreter"""
+    options = ["--python-version", target.python_version, "--only-binary=:all:"]
+    if target.platform:
+        options.extend(["--platform", target.platform])
+    return options
+
+
+class PropertySnapshot(object):
+    """Picklable stand-in for the project with a copy of some of its properties, used in worker processes"""
+
+    def __init__(self, properties):
+        self.properties = dict(properties)
+
+    def get_property(self, key, default_value=None):
+        return self.properties.get(key, default_value)
+
+
+class RecordingLogger(object):
+    """Collects the messages of a worker process to be logged by the build process"""
+
+    def __init__(self):
+        self.messages = []
+
+    def debug(self, message, *args):
+        self.messages.append(("debug", message % args if args else message))
+
+    def info(self, message, *args):
+        self.messages.append(("info", message % args if args else message))
+
+    def warn(self, message, *args):
+        self.messages.append(("warn", message % args if args else message))
+
+    def error(self, message, *args):
+        self.messages.append(("error", message % args if args else message))
+
+
+def replay_messages(logger, messages, prefix=""):
+    """Log the (level, message) pairs recorded by a RecordingLogger with logger"""
+    for level, message in messages:
+        getattr(logger, level)(prefix + message)
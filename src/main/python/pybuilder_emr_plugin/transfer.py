@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 20.0
+THROTTLING_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                          "ServiceUnavailable", "503"}
+TRANSIENT_ERROR_CODES = {"InternalError", "RequestTimeout", "500"}
+# latency above this factor of the best observed latency (and at least _MIN_LATENCY_INCREASE seconds above it)
+# stops the concurrency from growing
+_LATENCY_FACTOR = 3.0
+_MIN_LATENCY_INCREASE = 0.05
+_EWMA_WEIGHT = 0.2
+
+
+def _error_response(error):
+    """Response dict of a botocore ClientError, checked w/o importing botocore"""
+    response = getattr(error, "response", None)
+    return response if isinstance(response, dict) else {}
+
+
+def is_throttling_error(error):
+    response = _error_response(error)
+    if str(response.get("Error", {}).get("Code", "")) in THROTTLING_ERROR_CODES:
+        return True
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 503
+
+
+def is_retryable_error(error):
+    from botocore.exceptions import ConnectionError, ReadTimeoutError
+    return is_throttling_error(error) or \
+        str(_error_response(error).get("Error", {}).get("Code", "")) in TRANSIENT_ERROR_CODES or \
+        isinstance(error, (ConnectionError, ReadTimeoutError))
+
+
+class TransferController(object):
+    """Runs S3 requests with retries and an adaptive limit of requests in flight
+
+    Throttling errors (SlowDown, 503) halve the limit, max_concurrency successful requests in a row
+    without rising latency increase it by one again. Retryable errors are retried up to max_attempts
+    times with jittered exponential backoff (full jitter).
+    """
+
+    def __init__(self, max_concurrency, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, min_concurrency=1, sleep=time.sleep, rnd=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limit = self.max_concurrency
+        self._sleep = sleep
+        self._random = rnd or random.Random()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._successes = 0
+        self._latency = None
+        self._best_latency = None
+        self._statistics = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0, "backoff_seconds": 0.0,
+                            "min_limit": self.limit, "max_limit": self.limit}
+
+    def _acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _on_success(self, seconds):
+        with self._condition:
+            self._statistics["requests"] += 1
+            self._latency = seconds if self._latency is None else \
+                _EWMA_WEIGHT * seconds + (1 - _EWMA_WEIGHT) * self._latency
+            self._best_latency = self._latency if self._best_latency is None else \
+                min(self._best_latency, self._latency)
+            self._successes += 1
+            if self._latency > max(_LATENCY_FACTOR * self._best_latency,
+                                   self._best_latency + _MIN_LATENCY_INCREASE):
+                self._successes = 0
+            elif self._successes >= self.limit and self.limit < self.max_concurrency:
+                self._successes = 0
+                self.limit += 1
+                self._statistics["max_limit"] = max(self._statistics["max_limit"], self.limit)
+                self._condition.notify_all()
+
+    def _on_error(self, error):
+        with self._condition:
+            self._statistics["requests"] += 1
+            self._successes = 0
+            if is_throttling_error(error):
+                self._statistics["throttled"] += 1
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._statistics["min_limit"] = min(self._statistics["min_limit"], self.limit)
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number attempt (starting at 1)"""
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, function, *args, **kwargs):
+        """Call function (a client operation) within the concurrency limit, retrying retryable errors"""
+        attempt = 0
+        while True:
+            attempt += 1
+            self._acquire()
+            started = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                self._on_error(e)
+                if not is_retryable_error(e) or attempt >= self.max_attempts:
+                    with self._condition:
+                        self._statistics["failed"] += 1
+                    raise
+                delay = self.backoff(attempt)
+                with self._condition:
+                    self._statistics["retries"] += 1
+                    self._statistics["backoff_seconds"] += delay
+                self._sleep(delay)
+                continue
+            self._release()
+            self._on_success(time.time() - started)
+            return result
+
+    def statistics(self):
+        with self._condition:
+            statistics = dict(self._statistics)
+            statistics["limit"] = self.limit
+            statistics["latency_seconds"] = self._latency
+            return statistics
+
+
+class FaultInjectingClient(object):
+    """Stub around an S3 client failing a fraction of the calls of some operations, e.g. with SlowDown
+
+    All other attributes are delegated to the wrapped client. Used to test the behaviour under throttling
+    without a real bucket.
+    """
+
+    def __init__(self, client, failure_rate=0.5, error_code="SlowDown", status_code=503,
+                 operations=("put_object", "upload_part", "copy_object", "upload_part_copy"), latency=0.0,
+                 seed=None):
+        self._client = client
+        self.failure_rate = failure_rate
+        self.error_code = error_code
+        self.status_code = status_code
+        self.operations = set(operations)
+        self.latency = latency
+        self.injected = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _should_fail(self):
+        with self._lock:
+            if self._random.random() < self.failure_rate:
+                self.injected += 1
+                return True
+            return False
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in self.operations:
+            return attribute
+
+        def operation(*args, **kwargs):
+            from botocore.exceptions import ClientError
+            if self.latency:
+                time.sleep(self.latency)
+            if self._should_fail():
+                raise ClientError({"Error": {"Code": self.error_code, "Message": "injected fault"},
+                                   "ResponseMetadata": {"HTTPStatusCode": self.status_code}}, name)
+            return attribute(*args, **kwargs)
+
+        return operation
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import calendar
+import glob
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from pybuilder.errors import BuildFailedException
+
+from .archive import get_deterministic_date_time
+
+# sh activate script, independent of the directory the archive is unpacked to
+_RELOCATABLE_VIRTUAL_ENV = 'VIRTUAL_ENV="$(cd "$(dirname "${BASH_SOURCE[0]:-$0}")/.." && pwd)"'
+_NOT_RELOCATABLE = ["activate.csh", "activate.fish", "Activate.ps1"]
+_SHEBANG = re.compile(br"^#!.*python[0-9.]*(?P<args>[ \t][^\r\n]*)?(?P<eol>\r?\n)")
+
+
+def create_venv(logger, python, directory):
+    """Create a virtualenv w/o pip with the interpreter python, returns the relative path of site-packages"""
+    cmd = [python or sys.executable, "-m", "venv", "--without-pip", directory]
+    logger.debug("Creating virtualenv: {0}".format(" ".join(cmd)))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise BuildFailedException("Failed to create virtualenv with {0}: {1}".format(cmd[0], stderr))
+    site_packages = glob.glob(os.path.join(directory, "lib", "python*", "site-packages"))
+    if len(site_packages) != 1:
+        raise BuildFailedException("Could not find site-packages of the virtualenv {0}".format(directory))
+    return os.path.relpath(site_packages[0], directory).replace(os.sep, "/")
+
+
+def rewrite_shebang(filename):
+    """Replace an absolute python shebang of filename by '/usr/bin/env python', returns True if changed"""
+    with open(filename, "rb") as fp:
+        content = fp.read()
+    match = _SHEBANG.match(content)
+    if not match or content.startswith(b"#!/usr/bin/env python"):
+        return False
+    with open(filename, "wb") as fp:
+        fp.write(b"#!/usr/bin/env python" + (match.group("args") or b"") + match.group("eol") + content[match.end():])
+    return True
+
+
+def relocate_venv(directory, python_home):
+    """Make the virtualenv in directory independent of its location
+
+    The interpreter symlinks and pyvenv.cfg point to the python in the directory python_home on the
+    cluster nodes instead of the build interpreter.
+    """
+    config_file = os.path.join(directory, "pyvenv.cfg")
+    with open(config_file) as fp:
+        config = [line.rstrip("\n") for line in fp]
+    version = next((line.split("=", 1)[1].strip() for line in config if line.startswith("version")), "")
+    executable = "python" + ".".join(version.split(".")[:2])
+    lines = []
+    for line in config:
+        key = line.split("=", 1)[0].strip()
+        if key == "command":
+            continue
+        if key == "home":
+            line = "home = {0}".format(python_home)
+        elif key == "executable":
+            line = "executable = {0}".format(os.path.join(python_home, executable))
+        lines.append(line)
+    with open(config_file, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+
+    bin_dir = os.path.join(directory, "bin")
+    for name in sorted(os.listdir(bin_dir)):
+        path = os.path.join(bin_dir, name)
+        if name in _NOT_RELOCATABLE:
+            os.remove(path)
+        elif name == "activate":
+            with open(path) as fp:
+                content = fp.read()
+            with open(path, "w") as fp:
+                fp.write(re.sub(r'^VIRTUAL_ENV=.*$', lambda _: _RELOCATABLE_VIRTUAL_ENV, content, flags=re.M))
+        elif os.path.islink(path):
+            if os.path.isabs(os.readlink(path)):
+                os.remove(path)
+                os.symlink(os.path.join(python_home, executable), path)
+        elif os.path.isfile(path):
+            rewrite_shebang(path)
+
+
+def _add(tar, path, arcname, mtime):
+    info = tar.gettarinfo(path, arcname)
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    if mtime is not None:
+        info.mtime = mtime
+    if info.isreg():
+        with open(path, "rb") as fp:
+            tar.addfile(info, fp)
+    else:
+        tar.addfile(info)
+
+
+def pack_venv(logger, venv_dir, site_packages, dependency_entries, filename, deterministic=False):
+    """Write the virtualenv and the installed dependencies (FileEntry list) as tar.gz to filename
+
+    Scripts installed by pip into bin/ of the dependencies are moved to bin/ of the virtualenv with a
+    relocatable shebang. Returns the number of files in the archive.
+    """
+    mtime = calendar.timegm(get_deterministic_date_time()) if deterministic else None
+    scripts_dir = tempfile.mkdtemp(prefix="emr-venv-scripts-")
+    files = 0
+    try:
+        # mtime=0 keeps the gzip header independent of the build time
+        with gzip.GzipFile(filename, "wb", compresslevel=6, mtime=0 if deterministic else None) as fileobj, \
+                tarfile.open(fileobj=fileobj, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for root, dirs, names in os.walk(venv_dir):
+                dirs.sort()
+                for name in sorted(names) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                    path = os.path.join(root, name)
+                    _add(tar, path, os.path.relpath(path, venv_dir).replace(os.sep, "/"), mtime)
+                    files += 1
+            for entry in dependency_entries:
+                path = entry.path
+                if entry.relpath.startswith("bin/"):
+                    path = os.path.join(scripts_dir, entry.relpath)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    shutil.copy2(entry.path, path)
+                    rewrite_shebang(path)
+                    arcname = entry.relpath
+                else:
+                    arcname = "{0}/{1}".format(site_packages, entry.relpath)
+                _add(tar, path, arcname, mtime)
+                files += 1
+    finally:
+        shutil.rmtree(scripts_dir, ignore_errors=True)
+    logger.debug("Packed {0} files of the virtualenv to {1}".format(files, filename))
+    return files
+
+
+def measure_venv_startup(logger, filename, modules):
+    """Unpack the archive and import modules with its interpreter, returns timings in seconds
+
+    Only meaningful if the interpreter the virtualenv points to exists on the build machine.
+    """
+    directory = tempfile.mkdtemp(prefix="emr-venv-startup-")
+    try:
+        started = time.time()
+        with tarfile.open(filename, "r:gz") as tar:
+            # our own archive, the default data filter of newer pythons rejects the absolute bin/python symlink
+            if hasattr(tarfile, "fully_trusted_filter"):
+                tar.extractall(directory, filter="fully_trusted")
+            else:
+                tar.extractall(directory)
+        extract_seconds = time.time() - started
+        code = "import importlib, sys\nfor name in sys.argv[1:]:\n    importlib.import_module(name)\n"
+        cmd = [os.path.join(directory, "bin", "python"), "-c", code] + list(modules)
+        started = time.time()
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        _, stderr = process.communicate()
+        import_seconds = time.time() - started
+        if process.returncode != 0:
+            logger.warn("Importing the dependencies from {0} failed: {1}".format(filename, stderr.strip()))
+        return {"extract_seconds": extract_seconds,
+                "import_seconds": import_seconds,
+                "imported_modules": len(modules),
+                "import_succeeded": process.returncode == 0}
+    except (OSError, tarfile.TarError) as e:
+        logger.warn("Could not measure the startup of {0}: {1}".format(filename, e))
+        return {}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import os
+import shutil
+import stat as stat_module
+
+from .archive import file_sha256
+from .dependency_cache import link_or_copy_file
+
+# a scanned file, st_size, st_mtime_ns and st_mode make it usable in place of an os.stat_result
+FileEntry = collections.namedtuple("FileEntry", ["relpath", "path", "st_size", "st_mtime_ns", "st_mode"])
+
+
+def _scan(directory, prefix, matcher, recursive, follow_symlinks, visited, entries):
+    with os.scandir(directory) as iterator:
+        items = sorted(iterator, key=lambda item: item.name)
+    for item in items:
+        relpath = prefix + item.name
+        if item.is_symlink() and not follow_symlinks:
+            continue
+        try:
+            # a single stat per entry, following symlinks
+            stat = item.stat()
+        except FileNotFoundError:
+            # broken symlink
+            continue
+        if stat_module.S_ISDIR(stat.st_mode):
+            if not recursive or matcher is not None and matcher.excludes_dir(relpath):
+                continue
+            key = (stat.st_dev, stat.st_ino)
+            if key in visited:
+                # symlink to a parent directory
+                continue
+            visited.add(key)
+            _scan(item.path, relpath + "/", matcher, recursive, follow_symlinks, visited, entries)
+            visited.discard(key)
+        elif stat_module.S_ISREG(stat.st_mode):
+            if matcher is None or matcher.includes_file(relpath):
+                entries.append(FileEntry(relpath, item.path, stat.st_size, stat.st_mtime_ns, stat.st_mode))
+
+
+def scan_tree(directory, matcher=None, prefix="", recursive=True, follow_symlinks=True):
+    """Return a FileEntry for every regular file below directory, stating each entry once
+
+    Entries are sorted by name within each directory, depth first. Paths relative to directory
+    (with prefix prepended) are matched against the PathMatcher matcher, excluded directories
+    are not traversed. Symlinks are followed unless follow_symlinks is False, broken symlinks and
+    symlinks to a parent directory are skipped.
+    """
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    root = os.stat(directory)
+    _scan(directory, prefix, matcher, recursive, follow_symlinks, {(root.st_dev, root.st_ino)}, entries)
+    return entries
+
+
+def entries_statistics(entries):
+    """Return (files, bytes) of entries"""
+    return len(entries), sum(entry.st_size for entry in entries)
+
+
+def _is_unchanged(entry, destination, checksum):
+    try:
+        stat = os.stat(destination)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != entry.st_size:
+        return False
+    if stat.st_mtime_ns == entry.st_mtime_ns:
+        return True
+    if checksum and file_sha256(destination) == file_sha256(entry.path):
+        # same content, the times of the next build match again
+        shutil.copystat(entry.path, destination)
+        return True
+    return False
+
+
+def sync_entries(entries, target_directory, previous=(), link=False, checksum=False):
+    """Make the files below target_directory match the scanned entries, touching only changed files
+
+    A file is unchanged if size and mtime are equal or, with checksum, if the content is equal.
+    Changed files are hardlinked (with link) or reflinked where the filesystem supports it, else
+    copied. Files of the relative paths previous (of the last sync) which are no entries anymore are
+    removed. Returns {"copied": [...], "unchanged": [...], "removed": [...]} with relative paths.
+    """
+    changes = {"copied": [], "unchanged": [], "removed": []}
+    created = set()
+    for entry in entries:
+        destination = os.path.join(target_directory, entry.relpath)
+        if _is_unchanged(entry, destination, checksum):
+            changes["unchanged"].append(entry.relpath)
+            continue
+        folder = os.path.dirname(destination)
+        if folder not in created:
+            os.makedirs(folder, exist_ok=True)
+            created.add(folder)
+        link_or_copy_file(entry.path, destination, link=link)
+        changes["copied"].append(entry.relpath)
+    current = set(entry.relpath for entry in entries)
+    for relpath in sorted(set(previous) - current):
+        destination = os.path.join(target_directory, relpath)
+        if os.path.isfile(destination):
+            os.remove(destination)
+            changes["removed"].append(relpath)
+        folder = os.path.dirname(destination)
+        # remove the folders emptied by the sync, never target_directory itself
+        while folder != target_directory.rstrip(os.sep) and os.path.isdir(folder) and not os.listdir(folder):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+    return changes
+
+
+def save_file_manifest(filename, trees):
+    """Save the FileEntry lists of trees ({name: (directory, entries)}) as JSON"""
+    content = {name: {"directory": directory,
+                      "files": [[entry.relpath, entry.st_size, entry.st_mtime_ns, entry.st_mode] for entry in entries]}
+               for name, (directory, entries) in trees.items()}
+    with open(filename, "w") as fp:
+        json.dump(content, fp, sort_keys=True)
+
+
+def load_file_manifest(filename):
+    """Load the trees saved with save_file_manifest, returns an empty dict if filename does not exist"""
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as fp:
+        content = json.load(fp)
+    trees = {}
+    for name, tree in content.items():
+        directory = tree["directory"]
+        trees[name] = (directory, [FileEntry(relpath, os.path.join(directory, relpath), size, mtime_ns, mode)
+                                   for relpath, size, mtime_ns, mode in tree["files"]])
+    return trees
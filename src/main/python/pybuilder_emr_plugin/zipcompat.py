@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""All accesses to private zipfile internals, which may change between python releases
+
+PackageArchive only compresses in parallel and copies entries of a previous archive if
+supports_raw_entries() is True for its ZipFile, otherwise it writes every entry with ZipFile.open.
+"""
+
+import os
+import struct
+import zipfile
+
+_MODULE_ATTRIBUTES = ["_get_compressor", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH", "_MASK_COMPRESS_OPTION_1",
+                      "structFileHeader", "sizeFileHeader"]
+_ARCHIVE_ATTRIBUTES = ["_lock", "_writing", "_writecheck", "_didModify", "_seekable", "start_dir", "fp"]
+# renamed in python 3.13
+_COMPRESSLEVEL_ATTRIBUTE = "compress_level" if hasattr(zipfile.ZipInfo, "compress_level") else "_compresslevel"
+
+
+def supports_raw_entries(archive):
+    """True if compressed entries can be read and written for the ZipFile archive with this python"""
+    return all(hasattr(zipfile, name) for name in _MODULE_ATTRIBUTES) and \
+        all(hasattr(archive, name) for name in _ARCHIVE_ATTRIBUTES) and \
+        hasattr(zipfile.ZipInfo, _COMPRESSLEVEL_ATTRIBUTE)
+
+
+def get_compresslevel(zinfo):
+    return getattr(zinfo, _COMPRESSLEVEL_ATTRIBUTE, None)
+
+
+def set_compresslevel(zinfo, compresslevel):
+    """Compression level used by ZipFile.open(zinfo, "w"), ignored if this python has no such attribute"""
+    try:
+        setattr(zinfo, _COMPRESSLEVEL_ATTRIBUTE, compresslevel)
+    except AttributeError:
+        pass
+
+
+def get_compressor(compress_type, compresslevel=None):
+    """Compressor object ZipFile uses for compress_type, None for stored entries"""
+    return zipfile._get_compressor(compress_type, compresslevel)
+
+
+def read_raw_entry(fp, zinfo):
+    """Read the still compressed bytes of the entry zinfo from the open zip file object fp"""
+    fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    return fp.read(zinfo.compress_size)
+
+
+def write_raw_entry(archive, zinfo, data):
+    """Append an already compressed entry to the ZipFile archive
+
+    zinfo must carry CRC, file_size, compress_size and compress_type matching data. The
+    written bytes are the same ZipFile.write would produce for the uncompressed content.
+    """
+    with archive._lock:
+        if archive._writing:
+            raise ValueError("Can't write to ZIP archive while an open writing handle exists")
+        zinfo.flag_bits = 0x00
+        if zinfo.compress_type == zipfile.ZIP_LZMA:
+            zinfo.flag_bits |= zipfile._MASK_COMPRESS_OPTION_1
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        if archive._seekable:
+            archive.fp.seek(archive.start_dir)
+        zinfo.header_offset = archive.fp.tell()
+        archive._writecheck(zinfo)
+        archive._didModify = True
+        archive.fp.write(zinfo.FileHeader(zip64))
+        archive.fp.write(data)
+        archive.start_dir = archive.fp.tell()
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
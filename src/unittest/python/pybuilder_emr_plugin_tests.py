@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import filecmp
+import functools
+import hashlib
+import importlib
+import io
+import json
 import os
 import shutil
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import unittest
 import zipfile
 from pprint import pprint
@@ -13,12 +21,25 @@ import boto3
 import mock
 from moto import mock_s3
 from pybuilder.core import Logger, Project
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
 from pybuilder.errors import BuildFailedException
 from unittest2 import TestCase
 
 from pybuilder_emr_plugin import emr_package, emr_upload_to_s3, initialize_plugin, emr_release, emr_tasks
-from pybuilder_emr_plugin.emr_tasks import prepare_dependencies_dir
-from pybuilder_emr_plugin.helpers import check_acl_parameter_validity, permissible_acl_values
+from pybuilder_emr_plugin.archive import CompressionPolicy, PackageArchive, ZipimportLayout, save_manifest
+from pybuilder_emr_plugin.metrics import get_report_path
+from pybuilder_emr_plugin.optimize import top_level_modules
+from pybuilder_emr_plugin.dependency_cache import dependency_cache_key, evict_dependency_cache, \
+    restore_dependencies, store_dependencies
+from pybuilder_emr_plugin.emr_tasks import prepare_cached_dependencies_dir, prepare_dependencies_dir
+from pybuilder_emr_plugin.patterns import excluded_distributions, is_excluded_requirement, PathMatcher
+from pybuilder_emr_plugin.helpers import check_acl_parameter_validity, compute_checksums, copy_helper, \
+    delete_objects_helper, get_s3_client, multipart_upload, permissible_acl_values, upload_helper, MIN_PART_SIZE
+from pybuilder_emr_plugin.streaming import StreamBuffer
+from pybuilder_emr_plugin.targets import pip_target_options
+from pybuilder_emr_plugin.transfer import FaultInjectingClient, TransferController
+from pybuilder_emr_plugin.walker import load_file_manifest, scan_tree, sync_entries
 
 
 class TestCheckACLParameterValidity(TestCase):
@@ -30,6 +51,14 @@ class TestCheckACLParameterValidity(TestCase):
             check_acl_parameter_validity("some_acl_property", v)
 
 
+class TestImport(TestCase):
+    def test_plugin_import_does_not_load_boto3(self):
+        code = "import sys, pybuilder_emr_plugin; " \
+               "print(sorted(m for m in sys.modules if m.split('.')[0] in ('boto3', 'botocore')))"
+        output = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        self.assertEqual(output.strip(), "[]")
+
+
 class TestInitializePlugin(TestCase):
     def test_initialize_sets_variables_correctly(self):
         project = Project(".")
@@ -75,6 +104,535 @@ class PackageTest(TestCase):
             self.assertTrue(filecmp.cmp(os.path.join(scripts_dir, file),
                                         os.path.join(self.dir_target, file)), "missing " + file)
 
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_writes_metrics_report(self, prepare_dependencies_dir_mock):
+        emr_package(self.project, mock.MagicMock(Logger))
+        with open(get_report_path(self.project)) as fp:
+            report = json.load(fp)
+        phases = {p["name"]: p for p in report["tasks"]["emr_package"]["phases"]}
+        self.assertEqual(sorted(phases), ["compress", "dependencies", "scripts"])
+        self.assertEqual(phases["compress"]["files"], 8)
+        self.assertEqual(phases["compress"]["bytes_out"], os.path.getsize(self.zipfile))
+        self.assertIn("compression_ratio", phases["compress"])
+        self.assertEqual(phases["scripts"]["files"], 2)
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_zipimport_layout(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_HOT_MODULES, ["test_package_directory.package_file"])
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_PROFILE_IMPORTS, True)
+        emr_package(self.project, mock.MagicMock(Logger))
+        with zipfile.ZipFile(self.zipfile) as zf:
+            infos = zf.infolist()
+            self.assertIsNone(zf.testzip())
+        self.assertEqual([info.filename for info in infos[:3]],
+                         ["test_dependency_package/__init__.py", "test_package_directory/__init__.py",
+                          "test_package_directory/package_file.py"])
+        self.assertEqual([info.compress_type for info in infos[:3]], [zipfile.ZIP_STORED] * 3)
+        with open(get_report_path(self.project)) as fp:
+            report = json.load(fp)
+        phases = {p["name"]: p for p in report["tasks"]["emr_package"]["phases"]}
+        self.assertEqual(phases["imports"]["modules"], 5)
+        self.assertEqual(phases["imports"]["failed"], [])
+        self.assertIn("import_seconds", phases["imports"])
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_upload_uses_file_manifest_of_emr_package(self, prepare_dependencies_dir_mock):
+        emr_package(self.project, mock.MagicMock(Logger))
+        _, entries = load_file_manifest(emr_tasks.get_path_to_file_manifest(self.project))["package"]
+        self.assertEqual([e.relpath for e in entries], ["VERSION", "bash-script.sh", "palp.zip", "python-script.py"])
+        with mock.patch("pybuilder_emr_plugin.emr_tasks.upload_files") as upload_files_mock, \
+                mock.patch("pybuilder_emr_plugin.emr_tasks.scan_tree") as scan_tree_mock:
+            emr_tasks.upload_package_dir(self.project, mock.MagicMock(Logger), "v123/")
+        self.assertFalse(scan_tree_mock.called)
+        self.assertEqual([key for _, key in upload_files_mock.call_args[0][2]],
+                         ["v123/VERSION", "v123/bash-script.sh", "v123/palp.zip", "v123/python-script.py"])
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_incremental_is_identical_to_full_build(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_INCREMENTAL_DIR, os.path.join(self.tempdir, "previous"))
+        emr_package(self.project, mock.MagicMock(Logger))
+        with open(os.path.join(self.testdir, "src/main/python/test_module_file.py"), "a") as fp:
+            fp.write("changed = True\n")
+        logger = mock.MagicMock(Logger)
+        emr_package(self.project, logger)
+        logger.info.assert_any_call("Reused 7 and compressed 1 archive entries.")
+        with open(self.zipfile, "rb") as fp:
+            incremental = fp.read()
+
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_INCREMENTAL_DIR, "")
+        emr_package(self.project, mock.MagicMock(Logger))
+        with open(self.zipfile, "rb") as fp:
+            full = fp.read()
+        self.assertEqual(incremental, full)
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_layered(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_LAYERED, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_INCREMENTAL_DIR, os.path.join(self.tempdir, "previous"))
+        emr_package(self.project, mock.MagicMock(Logger))
+        layer_name = emr_tasks.get_dependency_layer_name(self.project)
+        layer = os.path.join(self.dir_target, "layers", layer_name)
+        self.assertEqual(sorted(zipfile.ZipFile(layer).namelist()),
+                         ["test_dependency_module.py", "test_dependency_package/__init__.py"])
+        self.assertEqual(sorted(zipfile.ZipFile(self.zipfile).namelist()),
+                         ["VERSION", "resources.txt", "resources_subfolder/sub_resources.txt",
+                          "test_module_file.py", "test_package_directory/__init__.py",
+                          "test_package_directory/package_file.py"])
+
+        os.remove(layer)
+        emr_package(self.project, mock.MagicMock(Logger))
+        self.assertEqual(prepare_dependencies_dir_mock.call_count, 1, "unchanged layer is not rebuilt")
+        self.assertTrue(os.path.isfile(layer))
+        self.project.depends_on("requests")
+        self.assertNotEqual(emr_tasks.get_dependency_layer_name(self.project), layer_name)
+
+    def test_dependency_layer_name_depends_on_archive_options(self):
+        names = [emr_tasks.get_dependency_layer_name(self.project)]
+        for name, value in [(emr_tasks.PROPERTY_PACKAGE_COMPRESSION_RULES, ["*.py=stored"]),
+                            (emr_tasks.PROPERTY_PACKAGE_COMPRESSION_SAMPLE, True),
+                            (emr_tasks.PROPERTY_PACKAGE_DETERMINISTIC, True),
+                            (emr_tasks.PROPERTY_PACKAGE_ZIPIMPORT_LAYOUT, True),
+                            (emr_tasks.PROPERTY_PACKAGE_HOT_MODULES, ["test_dependency_package.*"])]:
+            self.project.set_property(name, value)
+            names.append(emr_tasks.get_dependency_layer_name(self.project))
+        self.assertEqual(len(set(names)), len(names), names)
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_venv(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV_MEASURE_STARTUP, True)
+        emr_package(self.project, mock.MagicMock(Logger))
+        archive = emr_tasks.get_path_to_venv_archive(self.project)
+        site_packages = "lib/python{0}.{1}/site-packages".format(*sys.version_info[:2])
+        with tarfile.open(archive) as tar:
+            names = tar.getnames()
+            config = tar.extractfile("pyvenv.cfg").read().decode("utf-8")
+            python = tar.getmember("bin/python")
+            links = [member.linkname for member in tar.getmembers() if member.issym()]
+        self.assertIn(site_packages + "/test_dependency_module.py", names)
+        self.assertIn(site_packages + "/test_dependency_package/__init__.py", names)
+        self.assertNotIn("bin/activate.csh", names)
+        self.assertNotIn("command", config)
+        self.assertIn("home = /usr/bin", config)
+        self.assertTrue(python.issym() and python.linkname.startswith("/usr/bin/python"))
+        build_home = os.path.dirname(os.path.realpath(sys.executable))
+        self.assertEqual([link for link in links if link.startswith("/") and not link.startswith("/usr/bin/")], [])
+        self.assertEqual([link for link in links if build_home in link], [])
+        with open(os.path.join(os.path.dirname(get_report_path(self.project)), "palp-venv.json")) as fp:
+            report = json.load(fp)
+        self.assertEqual(report["files"], len(names))
+        self.assertIn("import_seconds", report)
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_venv_startup_measurement_failure_is_not_fatal(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV_MEASURE_STARTUP, True)
+        logger = mock.MagicMock(Logger)
+        with mock.patch("tarfile.TarFile.extractall", side_effect=tarfile.TarError("link outside destination")):
+            emr_package(self.project, logger)
+        with open(os.path.join(os.path.dirname(get_report_path(self.project)), "palp-venv.json")) as fp:
+            self.assertNotIn("import_seconds", json.load(fp))
+        self.assertIn("link outside destination", " ".join(call[0][0] for call in logger.warn.call_args_list))
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_venv_needs_cluster_python_home(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_VENV_PYTHON_HOME, "")
+        self.assertRaises(BuildFailedException, emr_package, self.project, mock.MagicMock(Logger))
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.install_target_dependencies")
+    def test_emr_package_targets(self, install_target_dependencies_mock):
+        def install(logger, project, target, dependencies, target_directory):
+            self.assertEqual(dependencies, ["requests"])
+            shutil.copytree(os.path.join(self.dir_target, "dependencies"), target_directory)
+        install_target_dependencies_mock.side_effect = install
+        self.project.depends_on("requests")
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGETS, ["3.7", "3.9-manylinux2014_x86_64"])
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGET_WORKERS, 2)
+        emr_package(self.project, mock.MagicMock(Logger))
+        for name in ["3.7", "3.9-manylinux2014_x86_64"]:
+            zf = zipfile.ZipFile(os.path.join(self.dir_target, name, "palp.zip"))
+            self.assertEqual(sorted(zf.namelist()),
+                             ["VERSION", "resources.txt", "resources_subfolder/sub_resources.txt",
+                              "test_dependency_module.py", "test_dependency_package/__init__.py",
+                              "test_module_file.py", "test_package_directory/__init__.py",
+                              "test_package_directory/package_file.py"])
+        self.assertFalse(os.path.exists(self.zipfile))
+        package = [entry.relpath for entry in load_file_manifest(self.dir_target + ".files.json")["package"][1]]
+        self.assertEqual(package, ["VERSION", "bash-script.sh", "python-script.py",
+                                   "3.7/palp.zip", "3.9-manylinux2014_x86_64/palp.zip"])
+
+    def test_emr_package_targets_are_validated(self):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGETS, ["py3"])
+        self.assertRaises(BuildFailedException, emr_package, self.project, mock.MagicMock(Logger))
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_TARGETS, ["3.7"])
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_PRECOMPILE, True)
+        self.assertRaises(BuildFailedException, emr_package, self.project, mock.MagicMock(Logger))
+        self.assertEqual(pip_target_options(emr_tasks.get_targets(self.project)[0]),
+                         ["--python-version", "3.7", "--only-binary=:all:"])
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_streams_zip_to_s3(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_S3_BUCKET_NAME, "palp-lambda-zips")
+        self.project.set_property(emr_tasks.PROPERTY_S3_BUCKET_PREFIX, "")
+        self.project.set_property(emr_tasks.PROPERTY_S3_FILE_ACCESS_CONTROL, "bucket-owner-full-control")
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_STREAM_UPLOAD, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_DETERMINISTIC, True)
+        with mock_s3():
+            s3 = boto3.resource("s3")
+            s3.create_bucket(Bucket="palp-lambda-zips")
+            emr_package(self.project, mock.MagicMock(Logger))
+            uploaded = s3.Object("palp-lambda-zips", "v123/palp.zip").get()["Body"].read()
+            with open(self.zipfile, "rb") as fp:
+                self.assertEqual(uploaded, fp.read())
+            self.assertEqual(zipfile.ZipFile(self.zipfile).testzip(), None)
+            with open(self.zipfile + ".sha256") as fp:
+                self.assertEqual(fp.read().split()[0], hashlib.sha256(uploaded).hexdigest())
+
+            self.project.set_property(emr_tasks.PROPERTY_PACKAGE_STREAM_KEEP_LOCAL, False)
+            emr_package(self.project, mock.MagicMock(Logger))
+            self.assertFalse(os.path.exists(self.zipfile))
+            with mock.patch("pybuilder_emr_plugin.emr_tasks.upload_files") as upload_files_mock:
+                emr_tasks.upload_package_dir(self.project, mock.MagicMock(Logger), "v123/")
+            self.assertEqual([key for _, key in upload_files_mock.call_args[0][2]],
+                             ["v123/VERSION", "v123/bash-script.sh", "v123/palp.zip.sha256",
+                              "v123/python-script.py"])
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_syncs_changed_scripts(self, prepare_dependencies_dir_mock):
+        emr_package(self.project, mock.MagicMock(Logger))
+        os.remove(os.path.join(self.testdir, "src/main/scripts/bash-script.sh"))
+        logger = mock.MagicMock(Logger)
+        emr_package(self.project, logger)
+        logger.info.assert_any_call("Scripts: 0 copied, 1 unchanged, 1 removed.")
+        self.assertFalse(os.path.exists(os.path.join(self.dir_target, "bash-script.sh")))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_target, "python-script.py")))
+
+        self.project.set_property(emr_tasks.PROPERTY_S3_BUCKET_NAME, "palp-lambda-zips")
+        self.project.set_property(emr_tasks.PROPERTY_S3_UPLOAD_SKIP_UNCHANGED, True)
+        with mock.patch("pybuilder_emr_plugin.emr_tasks.upload_files") as upload_files_mock, \
+                mock.patch("pybuilder_emr_plugin.emr_tasks.delete_objects_helper") as delete_mock:
+            emr_tasks.upload_package_dir(self.project, mock.MagicMock(Logger), "v123/")
+        self.assertEqual(delete_mock.call_args[0][2], ["v123/bash-script.sh"])
+        self.assertNotIn("v123/bash-script.sh", [key for _, key in upload_files_mock.call_args[0][2]])
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_deterministic(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_DETERMINISTIC, True)
+        emr_package(self.project, mock.MagicMock(Logger))
+        with open(self.zipfile, "rb") as fp:
+            first = fp.read()
+        for root, _, files in os.walk(os.path.join(self.testdir, "src")):
+            for name in files:
+                os.utime(os.path.join(root, name), (1234567890, 1234567890))
+        os.chmod(os.path.join(self.testdir, "src/main/python/test_module_file.py"), 0o600)
+        emr_package(self.project, mock.MagicMock(Logger))
+        with open(self.zipfile, "rb") as fp:
+            second = fp.read()
+        self.assertEqual(first, second)
+        zf = zipfile.ZipFile(self.zipfile)
+        self.assertEqual(zf.namelist(), ["test_dependency_module.py",
+                                         "test_dependency_package/__init__.py",
+                                         "test_module_file.py",
+                                         "test_package_directory/__init__.py",
+                                         "test_package_directory/package_file.py",
+                                         "VERSION",
+                                         "resources.txt",
+                                         "resources_subfolder/sub_resources.txt"])
+        self.assertEqual({info.date_time for info in zf.infolist()}, {(1980, 1, 1, 0, 0, 0)})
+        with open(os.path.join(self.dir_target, "palp.zip.sha256")) as fp:
+            self.assertEqual(fp.read(), "{0}  palp.zip\n".format(hashlib.sha256(second).hexdigest()))
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_precompiled_sourceless_and_pruned(self, prepare_dependencies_dir_mock):
+        dependencies_dir = os.path.join(self.dir_target, "dependencies")
+        os.makedirs(os.path.join(dependencies_dir, "test_dependency_package", "__pycache__"))
+        open(os.path.join(dependencies_dir, "test_dependency_package", "__pycache__", "x.cpython-37.pyc"), "w").close()
+        os.makedirs(os.path.join(dependencies_dir, "dep-1.0.dist-info"))
+        for name in ["METADATA", "RECORD"]:
+            open(os.path.join(dependencies_dir, "dep-1.0.dist-info", name), "w").close()
+        with open(os.path.join(self.testdir, "src/main/python/test_module_file.py"), "w") as fp:
+            fp.write("answer = 42\n")
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_PRUNE, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_PRECOMPILE, True)
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_SOURCELESS, True)
+        emr_package(self.project, mock.MagicMock(Logger))
+        zf = zipfile.ZipFile(self.zipfile)
+        expected = sorted(["dep-1.0.dist-info/METADATA",
+                           "test_dependency_module.pyc",
+                           "test_dependency_package/__init__.pyc",
+                           "test_package_directory/__init__.pyc",
+                           "test_package_directory/package_file.pyc",
+                           "test_module_file.pyc",
+                           "resources.txt",
+                           "resources_subfolder/sub_resources.txt",
+                           "VERSION"])
+        self.assertEqual(sorted(zf.namelist()), expected)
+        zf.close()
+        sys.path.insert(0, self.zipfile)
+        try:
+            module = importlib.import_module("test_module_file")
+            self.assertEqual(module.answer, 42)
+            self.assertTrue(module.__file__.endswith(".pyc"), module.__file__)
+        finally:
+            sys.path.remove(self.zipfile)
+            sys.modules.pop("test_module_file", None)
+            sys.path_importer_cache.pop(self.zipfile, None)
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_prune_keeps_imported_subpackages(self, prepare_dependencies_dir_mock):
+        package_dir = os.path.join(self.dir_target, "dependencies", "palp_docs_dependency")
+        for directory in ["docs", "tests"]:
+            os.makedirs(os.path.join(package_dir, directory))
+            open(os.path.join(package_dir, directory, "__init__.py"), "w").close()
+        with open(os.path.join(package_dir, "__init__.py"), "w") as fp:
+            fp.write("from palp_docs_dependency.docs import __name__ as docs\n")
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_PRUNE, True)
+        emr_package(self.project, mock.MagicMock(Logger))
+        sys.path.insert(0, self.zipfile)
+        try:
+            module = importlib.import_module("palp_docs_dependency")
+            self.assertEqual(module.docs, "palp_docs_dependency.docs")
+        finally:
+            sys.path.remove(self.zipfile)
+            for name in ["palp_docs_dependency", "palp_docs_dependency.docs"]:
+                sys.modules.pop(name, None)
+            sys.path_importer_cache.pop(self.zipfile, None)
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_emr_package_with_include_and_exclude_patterns(self, prepare_dependencies_dir_mock):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_EXCLUDES, ["test-dependency-pack*"])
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_SOURCE_INCLUDES, ["**/*.py"])
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_SOURCE_EXCLUDES, ["test_package_directory/package_*"])
+        emr_package(self.project, mock.MagicMock(Logger))
+        zf = zipfile.ZipFile(self.zipfile)
+        expected = sorted(["test_dependency_module.py",
+                           "test_package_directory/__init__.py",
+                           "test_module_file.py",
+                           "resources.txt",
+                           "resources_subfolder/sub_resources.txt",
+                           "VERSION"])
+        self.assertEqual(sorted(zf.namelist()), expected, "zipfile")
+        self.assertEqual(prepare_dependencies_dir_mock.call_args[1]["excludes"], ["test-dependency-pack*"])
+
+
+class PackageArchiveTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="palp-")
+        self.files = []
+        for index in range(20):
+            filename = os.path.join(self.tempdir, "file{0}.txt".format(index))
+            with open(filename, "wb") as fp:
+                fp.write(os.urandom(100 * index) + b"some compressible text " * 500 * index)
+            self.files.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def build(self, name, compress_type, workers):
+        filename = os.path.join(self.tempdir, name)
+        archive = PackageArchive(filename, workers=workers)
+        for path in self.files:
+            archive.write(path, os.path.basename(path), compress_type)
+        archive.close()
+        with open(filename, "rb") as fp:
+            return fp.read()
+
+    def test_parallel_compression_is_identical_to_serial(self):
+        for compress_type in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA]:
+            serial = self.build("serial.zip", compress_type, workers=1)
+            parallel = self.build("parallel.zip", compress_type, workers=4)
+            self.assertEqual(serial, parallel, "compress_type {0}".format(compress_type))
+            with zipfile.ZipFile(os.path.join(self.tempdir, "parallel.zip")) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.namelist(), [os.path.basename(path) for path in self.files])
+
+    def test_fallback_without_zipfile_internals(self):
+        previous = os.path.join(self.tempdir, "previous.zip")
+        archive = PackageArchive(previous, record_manifest=True)
+        for path in self.files:
+            archive.write(path, os.path.basename(path), zipfile.ZIP_DEFLATED)
+        archive.close()
+        save_manifest(previous + ".manifest.json", archive.manifest)
+        with open(previous, "rb") as fp:
+            serial = fp.read()
+        # as if a python release renamed one of the private attributes of ZipFile
+        with mock.patch("pybuilder_emr_plugin.zipcompat._ARCHIVE_ATTRIBUTES", ["_writing", "_renamed_internal"]):
+            filename = os.path.join(self.tempdir, "fallback.zip")
+            archive = PackageArchive(filename, previous_archive=previous, previous_manifest=previous + ".manifest.json",
+                                     workers=4)
+            self.assertFalse(archive.raw_entries)
+            for path in self.files:
+                archive.write(path, os.path.basename(path), zipfile.ZIP_DEFLATED)
+            archive.close()
+        self.assertEqual(archive.reused, 0)
+        with open(filename, "rb") as fp:
+            self.assertEqual(fp.read(), serial)
+
+    def test_compression_policy(self):
+        incompressible = os.path.join(self.tempdir, "random.bin")
+        with open(incompressible, "wb") as fp:
+            fp.write(os.urandom(10000))
+        policy = CompressionPolicy(["*.parquet=stored", "data/*.txt=lzma", "*.txt=deflated:9"], sample=True)
+        filename = os.path.join(self.tempdir, "policy.zip")
+        archive = PackageArchive(filename, policy=policy)
+        archive.write(self.files[1], "x.parquet", zipfile.ZIP_DEFLATED)
+        archive.write(self.files[2], "data/x.txt", zipfile.ZIP_DEFLATED)
+        archive.write(self.files[3], "other/x.txt", zipfile.ZIP_DEFLATED)
+        archive.write(incompressible, "random.bin", zipfile.ZIP_DEFLATED)
+        archive.write(self.files[4], "x.py", zipfile.ZIP_DEFLATED)
+        archive.close()
+        with zipfile.ZipFile(filename) as zf:
+            self.assertEqual([info.compress_type for info in zf.infolist()],
+                             [zipfile.ZIP_STORED, zipfile.ZIP_LZMA, zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED,
+                              zipfile.ZIP_DEFLATED])
+            self.assertIsNone(zf.testzip())
+        self.assertEqual(sorted(archive.statistics),
+                         ["*.parquet", "*.txt", "data/*.txt", "default", "incompressible"])
+        self.assertEqual(archive.statistics["incompressible"]["files"], 1)
+
+    def test_zipimport_layout(self):
+        names = ["other.py", "pkg/__init__.py", "pkg/util.py", "pkg/jobs/", "pkg/jobs/__init__.py", "pkg/jobs/etl.py",
+                 "pkg/__pycache__/util.cpython-39.pyc", "pkg-nspkg.pth"]
+        filename = os.path.join(self.tempdir, "layout.zip")
+        archive = PackageArchive(filename, layout=ZipimportLayout(["pkg.jobs.e*"]))
+        for name in names:
+            archive.write(self.tempdir if name.endswith("/") else self.files[5], name, zipfile.ZIP_DEFLATED)
+        archive.close()
+        with zipfile.ZipFile(filename) as zf:
+            infos = zf.infolist()
+            self.assertIsNone(zf.testzip())
+        self.assertEqual([info.filename for info in infos],
+                         ["pkg/__init__.py", "pkg/jobs/__init__.py", "pkg/jobs/etl.py", "other.py", "pkg/util.py"])
+        self.assertEqual([info.compress_type for info in infos],
+                         [zipfile.ZIP_STORED] * 3 + [zipfile.ZIP_DEFLATED] * 2)
+        self.assertEqual(archive.dropped, 3)
+        self.assertEqual(top_level_modules(names), ["other", "pkg"])
+
+    def test_invalid_compression_rule(self):
+        self.assertRaises(ValueError, CompressionPolicy, ["*.txt=gzip"])
+        self.assertRaises(ValueError, CompressionPolicy, ["*.txt"])
+        self.assertRaises(ValueError, CompressionPolicy, ["*.py=lzma"])
+
+    def test_compression_rules_keep_modules_importable(self):
+        module = os.path.join(self.tempdir, "palp_rule_module.py")
+        with open(module, "w") as fp:
+            fp.write("VALUE = 42\n")
+        policy = CompressionPolicy(["data/*.txt=bzip2", "**=lzma"])
+        filename = os.path.join(self.tempdir, "rules.zip")
+        archive = PackageArchive(filename, policy=policy)
+        archive.write(module, "palp_rule_module.py", zipfile.ZIP_DEFLATED)
+        archive.write(self.files[1], "data/x.txt", zipfile.ZIP_DEFLATED)
+        archive.write(self.files[2], "data/sub/x.txt", zipfile.ZIP_DEFLATED)
+        archive.close()
+        with zipfile.ZipFile(filename) as zf:
+            self.assertEqual([info.compress_type for info in zf.infolist()],
+                             [zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA])
+        output = subprocess.check_output([sys.executable, "-c", "import sys; sys.path.insert(0, sys.argv[1]); "
+                                          "import palp_rule_module; print(palp_rule_module.VALUE)", filename])
+        self.assertEqual(output.strip(), b"42")
+
+
+class PathMatcherTest(TestCase):
+    def test_patterns(self):
+        matcher = PathMatcher(excludes=["**/*.pyc", "pyspark*", "**/tests/**", "/docs", "a/*/c.txt"])
+        for path in ["x.pyc", "a/b/x.pyc", "pyspark", "a/pyspark-3.0.dist-info", "a/tests/x.py", "a/b/c.txt"]:
+            self.assertFalse(matcher.includes_file(path), path)
+        for path in ["x.py", "a/my_pyspark", "a/tests.py", "a/docs/x.txt", "a/b/b/c.txt"]:
+            self.assertTrue(matcher.includes_file(path), path)
+        for path in ["pyspark", "a/tests", "docs"]:
+            self.assertTrue(matcher.excludes_dir(path), path)
+        for path in ["a", "a/docs", "b/test"]:
+            self.assertFalse(matcher.excludes_dir(path), path)
+
+    def test_includes(self):
+        matcher = PathMatcher(includes=["**/*.py"], excludes=["setup.py"])
+        self.assertTrue(matcher.includes_file("a/b.py"))
+        self.assertFalse(matcher.includes_file("a/b.txt"))
+        self.assertFalse(matcher.includes_file("a/setup.py"))
+        self.assertFalse(matcher.excludes_dir("a"))
+
+    def test_excluded_requirements(self):
+        self.assertTrue(is_excluded_requirement("NumPy>=1.0", ["numpy"]))
+        self.assertTrue(is_excluded_requirement("pyspark-stubs==1.0", ["pyspark*"]))
+        self.assertTrue(is_excluded_requirement("boto_3", ["boto-3"]))
+        self.assertFalse(is_excluded_requirement("boto3", ["boto"]))
+
+    def test_excluded_distributions_with_other_import_names(self):
+        directory = tempfile.mkdtemp(prefix="palp-")
+        try:
+            files = {"PyYAML-6.0.dist-info/RECORD": "yaml/__init__.py,sha256=x,1\n_yaml/__init__.py,,\n"
+                                                    "PyYAML-6.0.dist-info/RECORD,,\nbin/yaml-lint,,\n"
+                                                    "../../share/yaml.txt,,\n",
+                     "scikit_learn-1.0.dist-info/top_level.txt": "sklearn\n",
+                     "other-1.0.dist-info/RECORD": "other.py,,\nbin/other,,\n",
+                     "yaml/__init__.py": "", "_yaml/__init__.py": "", "bin/yaml-lint": "", "bin/other": "",
+                     "sklearn/__init__.py": "", "other.py": ""}
+            for relpath, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(directory, relpath)), exist_ok=True)
+                with open(os.path.join(directory, relpath), "w") as fp:
+                    fp.write(content)
+            excludes = excluded_distributions(directory, ["pyyaml", "scikit-learn"])
+            self.assertEqual(excludes, ["/PyYAML-6.0.dist-info", "/_yaml", "/bin/yaml-lint",
+                                        "/scikit_learn-1.0.dist-info", "/sklearn", "/yaml"])
+            matcher = PathMatcher(excludes=excludes)
+            self.assertEqual([e.relpath for e in scan_tree(directory, matcher)],
+                             ["bin/other", "other-1.0.dist-info/RECORD", "other.py"])
+        finally:
+            shutil.rmtree(directory)
+
+
+class ScanTreeTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="palp-")
+        for path in ["b/c.py", "a.py", "b/d.txt", "e/f.py"]:
+            os.makedirs(os.path.dirname(os.path.join(self.tempdir, path)), exist_ok=True)
+            with open(os.path.join(self.tempdir, path), "w") as fp:
+                fp.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_scan_tree(self):
+        entries = scan_tree(self.tempdir, PathMatcher(excludes=["*.txt", "e"]), prefix="x/")
+        self.assertEqual([e.relpath for e in entries], ["x/a.py", "x/b/c.py"])
+        self.assertEqual(entries[1].st_size, len("b/c.py"))
+        self.assertEqual(entries[1].path, os.path.join(self.tempdir, "b", "c.py"))
+
+    def test_symlinks(self):
+        os.symlink(os.path.join(self.tempdir, "a.py"), os.path.join(self.tempdir, "link.py"))
+        os.symlink(os.path.join(self.tempdir, "missing.py"), os.path.join(self.tempdir, "broken.py"))
+        os.symlink(self.tempdir, os.path.join(self.tempdir, "b", "loop"))
+        self.assertEqual([e.relpath for e in scan_tree(self.tempdir)],
+                         ["a.py", "b/c.py", "b/d.txt", "e/f.py", "link.py"])
+        self.assertEqual([e.relpath for e in scan_tree(self.tempdir, follow_symlinks=False)],
+                         ["a.py", "b/c.py", "b/d.txt", "e/f.py"])
+
+    def test_sync_entries(self):
+        target = os.path.join(self.tempdir, "target")
+        entries = scan_tree(self.tempdir, PathMatcher(excludes=["target"]))
+        changes = sync_entries(entries, target)
+        self.assertEqual(changes["copied"], ["a.py", "b/c.py", "b/d.txt", "e/f.py"])
+        self.assertEqual(sync_entries(entries, target)["unchanged"], ["a.py", "b/c.py", "b/d.txt", "e/f.py"])
+
+        with open(os.path.join(self.tempdir, "a.py"), "w") as fp:
+            fp.write("changed")
+        os.utime(os.path.join(self.tempdir, "b/c.py"), (1234567890, 1234567890))
+        os.remove(os.path.join(self.tempdir, "e/f.py"))
+        previous = [e.relpath for e in entries]
+        entries = scan_tree(self.tempdir, PathMatcher(excludes=["target"]))
+        changes = sync_entries(entries, target, previous, checksum=True)
+        self.assertEqual(changes, {"copied": ["a.py"], "unchanged": ["b/c.py", "b/d.txt"], "removed": ["e/f.py"]})
+        self.assertFalse(os.path.exists(os.path.join(target, "e")))
+        with open(os.path.join(target, "a.py")) as fp:
+            self.assertEqual(fp.read(), "changed")
+
+    def test_sync_entries_with_hardlinks(self):
+        target = os.path.join(self.tempdir, "target")
+        sync_entries(scan_tree(self.tempdir, PathMatcher(excludes=["target"])), target, link=True)
+        self.assertTrue(os.path.samefile(os.path.join(self.tempdir, "b/c.py"), os.path.join(target, "b/c.py")))
+
 
 class TestsWithS3(TestCase):
     def setUp(self):
@@ -133,11 +691,256 @@ class UploadToS3Test(TestsWithS3):
         self.project.set_property(emr_tasks.PROPERTY_S3_SERVER_SIDE_ENCRYPTION, "no_such_value")
         self.assertRaises(BuildFailedException, emr_upload_to_s3, self.project, mock.MagicMock(Logger))
 
+    def test_delete_objects(self):
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        delete_objects_helper(mock.MagicMock(Logger), self.bucket_name, ["v123/bash-script.sh", "v123/palp.zip"])
+        self.assertEqual([o.key for o in self.s3.Bucket(self.bucket_name).objects.all()], ["v123/python-script.py"])
+
+    def test_upload_reuses_client(self):
+        self.assertIs(get_s3_client(16), get_s3_client(16))
+        self.assertIs(get_s3_client(8), get_s3_client(16), "a smaller pool reuses the larger client")
+
+    def test_client_does_not_retry_throttled_requests(self):
+        sent = []
+
+        def slow_down(request, **kwargs):
+            sent.append(request)
+            raw = mock.MagicMock()
+            raw.stream.return_value = [b"<Error><Code>SlowDown</Code><Message>Reduce your request rate.</Message>"
+                                       b"</Error>"]
+            return AWSResponse(request.url, 503, {}, raw)
+        client = get_s3_client()
+        client.meta.events.register("before-send.s3.PutObject", slow_down)
+        try:
+            with self.assertRaises(ClientError) as context:
+                client.put_object(Bucket=self.bucket_name, Key="x", Body=b"x")
+        finally:
+            client.meta.events.unregister("before-send.s3.PutObject", slow_down)
+        self.assertEqual(context.exception.response["Error"]["Code"], "SlowDown")
+        self.assertEqual(len(sent), 1)
+
+    def test_failed_files_are_reported_after_all_uploads(self):
+        real_upload_helper = upload_helper
+
+        def failing_upload_helper(logger, bucket_name, keyname, *args, **kwargs):
+            if keyname.endswith("bash-script.sh"):
+                raise Exception("upload failed")
+            return real_upload_helper(logger, bucket_name, keyname, *args, **kwargs)
+
+        with mock.patch("pybuilder_emr_plugin.helpers.upload_helper", side_effect=failing_upload_helper):
+            with self.assertRaises(BuildFailedException) as context:
+                emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        self.assertIn("v123/bash-script.sh (upload failed)", str(context.exception))
+        s3_keys = sorted(o.key for o in self.s3.Bucket(self.bucket_name).objects.all())
+        self.assertEqual(s3_keys, ["v123/palp.zip", "v123/python-script.py"])
+
+    def test_upload_metrics_are_reported_to_hook(self):
+        hook = mock.MagicMock()
+        self.project.set_property(emr_tasks.PROPERTY_METRICS_HOOK, hook)
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        task, metrics = hook.call_args[0]
+        self.assertEqual(task, "emr_upload_to_s3")
+        self.assertEqual(sorted(o["key"] for o in metrics["objects"]),
+                         ["v123/bash-script.sh", "v123/palp.zip", "v123/python-script.py"])
+        self.assertEqual(metrics["phases"][0]["files"], 3)
+        self.assertEqual(metrics["phases"][0]["bytes_out"], sum(o["size"] for o in metrics["objects"]))
+        with open(get_report_path(self.project)) as fp:
+            self.assertEqual(json.load(fp)["tasks"]["emr_upload_to_s3"], metrics)
+
+    def test_layered_upload_skips_existing_dependency_layer(self):
+        self.project.set_property(emr_tasks.PROPERTY_PACKAGE_LAYERED, True)
+        os.makedirs(os.path.join(self.dir_target, "layers"))
+        with open(os.path.join(self.dir_target, "layers", "palp-dependencies-abc.zip"), "wb") as fp:
+            fp.write(b"dependencies")
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        with open(os.path.join(self.dir_target, "palp.layers.json")) as fp:
+            manifest = json.load(fp)
+        self.assertEqual(manifest["py_files"], "s3://palp-lambda-zips/dependencies/palp-dependencies-abc.zip,"
+                                               "s3://palp-lambda-zips/v123/palp.zip")
+        s3_keys = sorted(o.key for o in self.s3.Bucket(self.bucket_name).objects.all())
+        self.assertEqual(s3_keys, ["dependencies/palp-dependencies-abc.zip", "v123/bash-script.sh",
+                                   "v123/palp.layers.json", "v123/palp.zip", "v123/python-script.py"])
+
+        with mock.patch("pybuilder_emr_plugin.helpers.upload_helper") as upload_helper_mock:
+            emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        uploaded = sorted(call[0][2] for call in upload_helper_mock.call_args_list)
+        self.assertEqual(uploaded, ["v123/bash-script.sh", "v123/palp.layers.json", "v123/palp.zip",
+                                    "v123/python-script.py"])
+
+    def test_upload_with_injected_throttling(self):
+        self.project.set_property(emr_tasks.PROPERTY_S3_RETRY_BASE_DELAY, 0.001)
+        client = FaultInjectingClient(get_s3_client(), failure_rate=0.5, seed=1)
+        logger = mock.MagicMock(Logger)
+        with mock.patch("pybuilder_emr_plugin.helpers.get_s3_client", return_value=client):
+            emr_upload_to_s3(self.project, logger)
+        s3_keys = sorted(o.key for o in self.s3.Bucket(self.bucket_name).objects.all())
+        self.assertEqual(s3_keys, ["v123/bash-script.sh", "v123/palp.zip", "v123/python-script.py"])
+        self.assertGreater(client.injected, 0)
+        messages = [call[0][0] for call in logger.info.call_args_list]
+        self.assertIn("retries: {0}, throttled: {0},".format(client.injected), " ".join(messages))
+
     @mock_s3
     def test_handle_failure_if_no_such_bucket(self):
         pass
 
 
+class StreamBufferTest(TestCase):
+    def test_reader_gets_all_data_with_bounded_buffer(self):
+        stream = StreamBuffer(1000)
+        data = os.urandom(50000)
+        received = []
+
+        def read():
+            while True:
+                chunk = stream.read(300)
+                self.assertLessEqual(stream._buffered, 1000)
+                if not chunk:
+                    return
+                received.append(chunk)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        for start in range(0, len(data), 7000):
+            stream.write(data[start:start + 7000])
+        stream.close()
+        reader.join()
+        self.assertEqual(b"".join(received), data)
+        self.assertEqual(stream.tell(), len(data))
+        self.assertEqual(stream.sha256, hashlib.sha256(data).hexdigest())
+
+    def test_failure_stops_writer(self):
+        stream = StreamBuffer(10)
+        stream.write(b"0123456789")
+        stream.fail(IOError("upload failed"))
+        self.assertRaises(IOError, stream.write, b"more")
+        self.assertRaises(IOError, stream.read, 5)
+
+
+class TransferControllerTest(TestCase):
+    def setUp(self):
+        self.sleep = mock.MagicMock()
+        self.controller = TransferController(8, max_attempts=4, sleep=self.sleep)
+
+    def test_throttled_requests_are_retried_and_reduce_concurrency(self):
+        operation = mock.MagicMock(side_effect=[ClientError({"Error": {"Code": "SlowDown"}}, "PutObject"),
+                                                ClientError({"Error": {"Code": "503"}}, "PutObject"),
+                                                "done"])
+        self.assertEqual(self.controller.call(operation, Key="a"), "done")
+        statistics = self.controller.statistics()
+        self.assertEqual((statistics["retries"], statistics["throttled"], statistics["limit"]), (2, 2, 2))
+        self.assertEqual(self.sleep.call_count, 2)
+        for _ in range(10):
+            self.controller.call(mock.MagicMock())
+        self.assertGreater(self.controller.statistics()["limit"], 2)
+
+    def test_other_errors_are_not_retried(self):
+        operation = mock.MagicMock(side_effect=ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject"))
+        with self.assertRaises(ClientError):
+            self.controller.call(operation)
+        self.assertEqual(operation.call_count, 1)
+
+    def test_gives_up_after_max_attempts(self):
+        operation = mock.MagicMock(side_effect=ClientError({"Error": {"Code": "SlowDown"}}, "PutObject"))
+        with self.assertRaises(ClientError):
+            self.controller.call(operation)
+        self.assertEqual(operation.call_count, 4)
+        self.assertEqual(self.controller.statistics()["limit"], 1)
+
+
+class MultipartUploadTest(TestsWithS3):
+    def setUp(self):
+        super(MultipartUploadTest, self).setUp()
+        self.data = os.urandom(2 * MIN_PART_SIZE + 1024)
+        self.filepath = os.path.join(self.dir_target, "palp.zip")
+        with open(self.filepath, "wb") as fp:
+            fp.write(self.data)
+
+    def test_upload_in_parts(self):
+        with open(self.filepath, "rb") as fp:
+            upload_helper(mock.Mock(), self.bucket_name, "big.zip", fp, "bucket-owner-full-control", "AES256",
+                          part_size=MIN_PART_SIZE, concurrency=2)
+        s3_object = self.s3.Object(self.bucket_name, "big.zip")
+        self.assertEqual(s3_object.get()["Body"].read(), self.data)
+        self.assertTrue(s3_object.e_tag.endswith('-3"'), s3_object.e_tag)
+        self.assertEqual(s3_object.server_side_encryption, "AES256")
+
+    def test_upload_holds_at_most_concurrency_parts(self):
+        client = boto3.client("s3")
+        upload_part = client.upload_part
+        counts = {"read": 0, "uploaded": 0, "held": 0}
+
+        class CountingFile(io.BytesIO):
+            def read(self, size=-1):
+                data = super(CountingFile, self).read(size)
+                if data:
+                    counts["read"] += 1
+                    counts["held"] = max(counts["held"], counts["read"] - counts["uploaded"])
+                return data
+
+        def counting_upload_part(**kwargs):
+            response = upload_part(**kwargs)
+            counts["uploaded"] += 1
+            return response
+        client.upload_part = counting_upload_part
+        multipart_upload(mock.Mock(), client, self.bucket_name, "big.zip", CountingFile(self.data), {},
+                         part_size=MIN_PART_SIZE, concurrency=1)
+        self.assertEqual(counts["read"], 3)
+        self.assertEqual(counts["held"], 1)
+        self.assertEqual(self.s3.Object(self.bucket_name, "big.zip").get()["Body"].read(), self.data)
+
+    def test_small_upload_uses_single_put(self):
+        upload_helper(mock.Mock(), self.bucket_name, "small.txt", b"testdata", "bucket-owner-full-control")
+        s3_object = self.s3.Object(self.bucket_name, "small.txt")
+        self.assertEqual(s3_object.get()["Body"].read(), b"testdata")
+        self.assertFalse("-" in s3_object.e_tag)
+
+    def test_failed_part_aborts_upload(self):
+        client = boto3.client("s3")
+        client.upload_part = mock.Mock(side_effect=Exception("part failed"))
+        with open(self.filepath, "rb") as fp:
+            self.assertRaises(Exception, multipart_upload, mock.Mock(), client, self.bucket_name, "big.zip", fp,
+                              {"ACL": "private"}, part_size=MIN_PART_SIZE, concurrency=2)
+        self.assertEqual(client.list_multipart_uploads(Bucket=self.bucket_name).get("Uploads", []), [])
+        self.assertEqual([o.key for o in self.s3.Bucket(self.bucket_name).objects.filter(Prefix="big")], [])
+
+    def test_computed_etag_matches_s3(self):
+        with open(self.filepath, "rb") as fp:
+            upload_helper(mock.Mock(), self.bucket_name, "big.zip", fp, "private", part_size=MIN_PART_SIZE)
+        upload_helper(mock.Mock(), self.bucket_name, "small.txt", b"testdata", "private")
+        small_file = os.path.join(self.dir_target, "bash-script.sh")
+        self.assertEqual(compute_checksums(self.filepath, MIN_PART_SIZE)[0],
+                         self.s3.Object(self.bucket_name, "big.zip").e_tag)
+        self.assertEqual(compute_checksums(small_file, MIN_PART_SIZE)[0],
+                         self.s3.Object(self.bucket_name, "small.txt").e_tag)
+
+
+class DifferentialUploadTest(TestsWithS3):
+    def setUp(self):
+        super(DifferentialUploadTest, self).setUp()
+        self.project.set_property(emr_tasks.PROPERTY_S3_UPLOAD_SKIP_UNCHANGED, True)
+
+    def test_only_changed_files_are_uploaded(self):
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        with open(os.path.join(self.dir_target, "python-script.py"), "wb") as fp:
+            fp.write(b"changed")
+        logger = mock.MagicMock(Logger)
+        emr_upload_to_s3(self.project, logger)
+        logger.info.assert_any_call("skipped unchanged: palp.zip at v123/palp.zip")
+        logger.info.assert_any_call("uploaded: python-script.py to v123/python-script.py")
+        logger.info.assert_any_call("Uploaded 1 files, skipped 2 unchanged files.")
+        self.assertEqual(self.s3.Object(self.bucket_name, "v123/python-script.py").get()["Body"].read(), b"changed")
+
+    def test_stored_checksum_is_used_if_etag_differs(self):
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        s3_object = self.s3.Object(self.bucket_name, "v123/palp.zip")
+        self.assertEqual(s3_object.metadata, {"sha256": compute_checksums(self.filepath)[1]})
+        with mock.patch("pybuilder_emr_plugin.helpers.compute_checksums",
+                        side_effect=lambda filepath, part_size: ('"other-etag"', compute_checksums(filepath)[1])):
+            logger = mock.MagicMock(Logger)
+            emr_upload_to_s3(self.project, logger)
+        logger.info.assert_any_call("Uploaded 0 files, skipped 3 unchanged files.")
+
+
 class ReleaseTest(TestsWithS3):
     def test_release_successful(self):
         emr_upload_to_s3(self.project, mock.MagicMock(Logger))
@@ -168,6 +971,44 @@ class ReleaseTest(TestsWithS3):
             self.assertDictContainsSubset({"Permission": "FULL_CONTROL"}, s3_grants[0],
                                           "Default ACL of FULL_CONTROL not found!")
 
+    def test_release_does_not_need_local_files(self):
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        shutil.rmtree(self.dir_target)
+        emr_release(self.project, mock.MagicMock(Logger))
+        s3_keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.filter(Prefix="release/")]
+        self.assertEqual(sorted(s3_keys), ["release/bash-script.sh", "release/palp.zip", "release/python-script.py"])
+
+    def test_release_fails_without_uploaded_version(self):
+        self.assertRaises(BuildFailedException, emr_release, self.project, mock.MagicMock(Logger))
+
+    def test_release_with_throttled_listing_and_head_requests(self):
+        self.project.set_property(emr_tasks.PROPERTY_S3_RETRY_BASE_DELAY, 0.001)
+        emr_upload_to_s3(self.project, mock.MagicMock(Logger))
+        data = os.urandom(2 * MIN_PART_SIZE + 1024)
+        upload_helper(mock.Mock(), self.bucket_name, "v123/big.zip", data, "private")
+        client = FaultInjectingClient(get_s3_client(), failure_rate=0.5, seed=3,
+                                      operations=("list_objects_v2", "head_object"))
+        multipart_copy_helper = functools.partial(copy_helper, multipart_threshold=MIN_PART_SIZE)
+        with mock.patch("pybuilder_emr_plugin.helpers.get_s3_client", return_value=client), \
+                mock.patch("pybuilder_emr_plugin.helpers.copy_helper", multipart_copy_helper):
+            for _ in range(3):
+                emr_release(self.project, mock.MagicMock(Logger))
+        self.assertGreater(client.injected, 1)
+        s3_keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.filter(Prefix="release/")]
+        self.assertEqual(sorted(s3_keys), ["release/bash-script.sh", "release/big.zip", "release/palp.zip",
+                                           "release/python-script.py"])
+        self.assertEqual(self.s3.Object(self.bucket_name, "release/big.zip").get()["Body"].read(), data)
+
+    def test_large_objects_are_copied_in_parts(self):
+        data = os.urandom(2 * MIN_PART_SIZE + 1024)
+        upload_helper(mock.Mock(), self.bucket_name, "v123/big.zip", data, "private", metadata={"sha256": "x"})
+        copy_helper(mock.Mock(), self.bucket_name, "v123/big.zip", "release/big.zip", "private", size=len(data),
+                    part_size=MIN_PART_SIZE, multipart_threshold=MIN_PART_SIZE)
+        s3_object = self.s3.Object(self.bucket_name, "release/big.zip")
+        self.assertEqual(s3_object.get()["Body"].read(), data)
+        self.assertTrue(s3_object.e_tag.endswith('-3"'), s3_object.e_tag)
+        self.assertEqual(s3_object.metadata, {"sha256": "x"})
+
 
 class TestPrepareDependenciesDir(TestCase):
     """Testcases for prepare_dependencies_dir()"""
@@ -239,5 +1080,124 @@ class TestPrepareDependenciesDir(TestCase):
         self.assertRaises(Exception, prepare_dependencies_dir, self.mock_logger, self.input_project, "targetdir")
 
 
+class TestPrepareDependenciesDirBatched(TestCase):
+    """Testcases for prepare_dependencies_dir() in batch install mode"""
+
+    def setUp(self):
+        self.patch_popen = mock.patch("pybuilder_emr_plugin.emr_tasks.subprocess.Popen")
+        self.mock_popen = self.patch_popen.start()
+        self.mock_process = mock.Mock()
+        self.mock_process.returncode = 0
+        self.mock_process.communicate.return_value = ("", "")
+        self.mock_popen.return_value = self.mock_process
+        self.input_project = Project(".")
+        self.input_project.set_property(emr_tasks.PROPERTY_PACKAGE_BATCH_INSTALL, True)
+        self.mock_logger = mock.Mock()
+
+    def tearDown(self):
+        self.patch_popen.stop()
+
+    def test_prepare_dependencies_in_one_pip_run(self):
+        for dependency in ["a", "b", "boto3", "c"]:
+            self.input_project.depends_on(dependency)
+        prepare_dependencies_dir(self.mock_logger, self.input_project, "targetdir", excludes=["boto3"])
+        self.assertEqual(self.mock_popen.call_count, 1)
+        self.assertEqual(self.mock_popen.call_args[0][0],
+                         ["pip", "install", "--target", "targetdir", "a", "b", "c"])
+
+    def test_prepare_dependencies_with_custom_index_url(self):
+        self.input_project.depends_on("a")
+        self.input_project.set_property("install_dependencies_index_url", "http://example.domain")
+        prepare_dependencies_dir(self.mock_logger, self.input_project, "targetdir")
+        self.assertEqual(self.mock_popen.call_args[0][0],
+                         ["pip", "install", "--target", "targetdir", "--index-url", "http://example.domain", "a"])
+
+    def test_prepare_dependencies_reports_failed_requirement(self):
+        for dependency in ["a", "Some_Package>=1.0"]:
+            self.input_project.depends_on(dependency)
+        self.mock_process.returncode = 1
+        self.mock_process.communicate.return_value = (
+            "", "ERROR: No matching distribution found for some-package>=1.0")
+        with self.assertRaises(Exception) as context:
+            prepare_dependencies_dir(self.mock_logger, self.input_project, "targetdir")
+        self.assertIn("failed to install dependency Some_Package>=1.0", str(context.exception))
+
+    def test_prepare_dependencies_parallel_unpack(self):
+        tempdir = tempfile.mkdtemp(prefix="palp-")
+        self.addCleanup(shutil.rmtree, tempdir)
+        target_dir = os.path.join(tempdir, "dependencies")
+        for dependency in ["a", "b"]:
+            self.input_project.depends_on(dependency)
+        self.input_project.set_property(emr_tasks.PROPERTY_PACKAGE_INSTALL_WORKERS, 2)
+
+        def fake_pip(cmd, **kwargs):
+            if cmd[1] == "download":
+                for name in ["a-1.0-py3-none-any.whl", "b-1.0-py3-none-any.whl"]:
+                    open(os.path.join(cmd[3], name), "w").close()
+            else:
+                package = os.path.basename(cmd[-1]).split("-")[0]
+                os.makedirs(os.path.join(cmd[4], package))
+                open(os.path.join(cmd[4], package, "__init__.py"), "w").close()
+            return self.mock_process
+
+        self.mock_popen.side_effect = fake_pip
+        prepare_dependencies_dir(self.mock_logger, self.input_project, target_dir)
+        commands = [c[0][0][:2] for c in self.mock_popen.call_args_list]
+        self.assertEqual(commands, [["pip", "download"], ["pip", "install"], ["pip", "install"]])
+        self.assertTrue(os.path.isfile(os.path.join(target_dir, "a", "__init__.py")))
+        self.assertTrue(os.path.isfile(os.path.join(target_dir, "b", "__init__.py")))
+
+
+class TestDependencyCache(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="palp-")
+        self.cache_dir = os.path.join(self.tempdir, "cache")
+        self.installed_dir = os.path.join(self.tempdir, "installed")
+        os.makedirs(os.path.join(self.installed_dir, "pkg"))
+        with open(os.path.join(self.installed_dir, "pkg", "__init__.py"), "w") as fp:
+            fp.write("x = 1")
+        self.logger = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_key_ignores_order_but_not_index_url(self):
+        self.assertEqual(dependency_cache_key(["a", "b"], "", "tag"), dependency_cache_key(["b", "a"], "", "tag"))
+        self.assertNotEqual(dependency_cache_key(["a"], "", "tag"), dependency_cache_key(["a"], "http://x", "tag"))
+        self.assertNotEqual(dependency_cache_key(["a"], "", "tag"), dependency_cache_key(["a"], "", "other"))
+
+    def test_store_and_restore(self):
+        target_dir = os.path.join(self.tempdir, "target")
+        self.assertFalse(restore_dependencies(self.logger, self.cache_dir, "k", target_dir))
+        store_dependencies(self.logger, self.cache_dir, "k", self.installed_dir, ["pkg"])
+        self.assertTrue(restore_dependencies(self.logger, self.cache_dir, "k", target_dir))
+        with open(os.path.join(target_dir, "pkg", "__init__.py")) as fp:
+            self.assertEqual(fp.read(), "x = 1")
+
+    def test_evicts_least_recently_used(self):
+        for index, key in enumerate(["old", "middle", "new"]):
+            store_dependencies(self.logger, self.cache_dir, key, self.installed_dir, ["pkg"])
+            os.utime(os.path.join(self.cache_dir, key + ".json"), (index, index))
+        evicted = evict_dependency_cache(self.logger, self.cache_dir, max_entries=2)
+        self.assertEqual(evicted, ["old"])
+        evicted = evict_dependency_cache(self.logger, self.cache_dir, max_size=0, keep="middle")
+        self.assertEqual(evicted, ["new"])
+        self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, "middle")))
+
+    @mock.patch("pybuilder_emr_plugin.emr_tasks.prepare_dependencies_dir")
+    def test_unchanged_requirements_skip_install(self, prepare_dependencies_dir_mock):
+        project = Project(".")
+        project.depends_on("a")
+        project.set_property(emr_tasks.PROPERTY_PACKAGE_DEPENDENCY_CACHE_DIR, self.cache_dir)
+        target_dir = os.path.join(self.tempdir, "target")
+        prepare_dependencies_dir_mock.side_effect = \
+            lambda logger, project, directory, excludes: shutil.copytree(self.installed_dir, directory)
+        prepare_cached_dependencies_dir(self.logger, project, target_dir)
+        shutil.rmtree(target_dir)
+        prepare_cached_dependencies_dir(self.logger, project, target_dir)
+        self.assertEqual(prepare_dependencies_dir_mock.call_count, 1)
+        self.assertTrue(os.path.isfile(os.path.join(target_dir, "pkg", "__init__.py")))
+
+
 if __name__ == "__main__":
     unittest.main()